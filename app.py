@@ -1,35 +1,444 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-from routes.image_routes import image_bp
+from routes.image_routes import image_bp, run_edit_job, run_generate_job
 from routes.caption_routes import caption_bp
+from services.cache_service import ResultCache
+from services.file_index import FileIndex
+from services.preprocess import ImagePreprocessor
+from services.encoder import ImageEncoder
+from services.similarity import PerceptualIndex
+from services.rate_limiter import RateLimiter
+from services.call_policy import CallPolicy
+from services.single_flight import SingleFlight
+from services.janitor import InFlightRegistry, StorageJanitor
+from services.storage import create_storage
+from services.shared_state import create_shared_state
+from services.job_service import get_job_queue
+from services.metrics import HTTP_IN_FLIGHT, HTTP_LATENCY, HTTP_REQUESTS, REGISTRY
 import logging
+import threading
+import time
+
+# Load environment variables (first, so .env settings such as LOG_LEVEL apply below)
+load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'ERROR').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load environment variables
-load_dotenv()
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16777216))
-app.config['UPLOAD_FOLDER'] = os.path.normpath(os.environ.get('UPLOAD_FOLDER', 'uploads'))
-app.config['GENERATED_FOLDER'] = os.path.normpath(os.environ.get('GENERATED_FOLDER', 'generated'))
+_runtime_lock = threading.Lock()
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() == 'true'
+
+
+def create_app(config=None):
+    """Application factory; config overrides the environment-derived settings."""
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16777216))
+    app.config['UPLOAD_FOLDER'] = os.path.normpath(os.environ.get('UPLOAD_FOLDER', 'uploads'))
+    app.config['GENERATED_FOLDER'] = os.path.normpath(os.environ.get('GENERATED_FOLDER', 'generated'))
+    app.config['STATE_FOLDER'] = os.path.normpath(os.environ.get('STATE_FOLDER', 'state'))
+    app.config['VARIANT_FOLDER'] = os.path.normpath(os.environ.get('VARIANT_FOLDER', 'variants'))
+
+    # Uploads are rejected from their header above these dimensions (0 = no limit)
+    app.config['UPLOAD_MAX_SIDE'] = int(os.environ.get('UPLOAD_MAX_SIDE', 12000))
+    app.config['UPLOAD_MAX_PIXELS'] = int(os.environ.get('UPLOAD_MAX_PIXELS', 50_000_000))
+
+    # Generation result cache (opt-in)
+    app.config['GENERATION_CACHE_ENABLED'] = _env_flag('GENERATION_CACHE_ENABLED', 'false')
+    app.config['GENERATION_CACHE_TTL'] = int(os.environ.get('GENERATION_CACHE_TTL', 3600))
+    app.config['GENERATION_CACHE_MAX_ENTRIES'] = int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', 512))
+
+    # Caption memoization keyed on image digest, platform, tone and model
+    app.config['CAPTION_CACHE_ENABLED'] = _env_flag('CAPTION_CACHE_ENABLED', 'true')
+    app.config['CAPTION_CACHE_TTL'] = int(os.environ.get('CAPTION_CACHE_TTL', 86400))
+    app.config['CAPTION_CACHE_MAX_ENTRIES'] = int(os.environ.get('CAPTION_CACHE_MAX_ENTRIES', 2048))
+
+    # Shared GeminiService: one genai client per worker process
+    app.config['GEMINI_POOL_SIZE'] = int(os.environ.get('GEMINI_POOL_SIZE', 10))
+    app.config['GEMINI_KEEPALIVE'] = int(os.environ.get('GEMINI_KEEPALIVE', 60))
+    app.config['GEMINI_BASE_URL'] = os.environ.get('GEMINI_BASE_URL', '')
+    app.config['GEMINI_CLIENT_FACTORY'] = None  # callable returning a (fake) genai client
+
+    # Upstream admission control per model: token bucket (requests/s, burst) + adaptive concurrency
+    app.config['RATE_LIMIT_ENABLED'] = _env_flag('RATE_LIMIT_ENABLED', 'true')
+    app.config['IMAGE_MODEL_RPS'] = float(os.environ.get('IMAGE_MODEL_RPS', 2))
+    app.config['IMAGE_MODEL_BURST'] = int(os.environ.get('IMAGE_MODEL_BURST', 4))
+    app.config['CAPTION_MODEL_RPS'] = float(os.environ.get('CAPTION_MODEL_RPS', 10))
+    app.config['CAPTION_MODEL_BURST'] = int(os.environ.get('CAPTION_MODEL_BURST', 20))
+    app.config['UPSTREAM_MAX_CONCURRENCY'] = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 16))
+    app.config['UPSTREAM_MAX_QUEUE'] = int(os.environ.get('UPSTREAM_MAX_QUEUE', 50))
+    app.config['UPSTREAM_MAX_WAIT'] = float(os.environ.get('UPSTREAM_MAX_WAIT', 10))
+
+    # Model call deadlines (seconds, retries included), socket timeouts, retries and caption hedging
+    app.config['IMAGE_CALL_DEADLINE'] = float(os.environ.get('IMAGE_CALL_DEADLINE', 180))
+    app.config['CAPTION_CALL_DEADLINE'] = float(os.environ.get('CAPTION_CALL_DEADLINE', 30))
+    app.config['GEMINI_IDLE_TIMEOUT'] = float(os.environ.get('GEMINI_IDLE_TIMEOUT', 30))
+    app.config['GEMINI_CONNECT_TIMEOUT'] = float(os.environ.get('GEMINI_CONNECT_TIMEOUT', 10))
+    app.config['GEMINI_MAX_RETRIES'] = int(os.environ.get('GEMINI_MAX_RETRIES', 2))
+    app.config['GEMINI_BACKOFF_BASE'] = float(os.environ.get('GEMINI_BACKOFF_BASE', 0.5))
+    app.config['GEMINI_BACKOFF_MAX'] = float(os.environ.get('GEMINI_BACKOFF_MAX', 8))
+    app.config['CAPTION_HEDGE_ENABLED'] = _env_flag('CAPTION_HEDGE_ENABLED', 'false')
+    app.config['CAPTION_HEDGE_AFTER'] = os.environ.get('CAPTION_HEDGE_AFTER', '')  # seconds; empty = observed p95
+
+    # Images sent to the model: longest side per operation (0 = send the original) and the re-encoding
+    # used when an image is downscaled or carries EXIF; images already within the cap go unchanged
+    app.config['MODEL_INPUT_MAX_SIDE_EDIT'] = int(os.environ.get('MODEL_INPUT_MAX_SIDE_EDIT', 2048))
+    app.config['MODEL_INPUT_MAX_SIDE_CAPTION'] = int(os.environ.get('MODEL_INPUT_MAX_SIDE_CAPTION', 768))
+    app.config['MODEL_INPUT_FORMAT'] = os.environ.get('MODEL_INPUT_FORMAT', 'webp')  # or 'jpeg'
+    app.config['MODEL_INPUT_QUALITY'] = int(os.environ.get('MODEL_INPUT_QUALITY', 85))
+    app.config['MODEL_INPUT_CACHE_BYTES'] = int(os.environ.get('MODEL_INPUT_CACHE_BYTES', 64 * 1024 ** 2))
+
+    # Output encoding: rendition format ('jpeg' is written progressive, or 'webp'/'avif'), qualities,
+    # re-encoding of generated images ('original' keeps the model's bytes; 'png' = optimized PNG, 'webp', ...)
+    # and the formats downloads are negotiated to from the Accept header, in server preference order
+    app.config['RENDITION_FORMAT'] = os.environ.get('RENDITION_FORMAT', 'jpeg')
+    app.config['JPEG_PROGRESSIVE'] = _env_flag('JPEG_PROGRESSIVE', 'true')
+    app.config['JPEG_QUALITY'] = int(os.environ.get('JPEG_QUALITY', 90))
+    app.config['WEBP_QUALITY'] = int(os.environ.get('WEBP_QUALITY', 82))
+    app.config['AVIF_QUALITY'] = int(os.environ.get('AVIF_QUALITY', 60))
+    app.config['GENERATED_FORMAT'] = os.environ.get('GENERATED_FORMAT', 'original')
+    app.config['NEGOTIATE_FORMATS'] = os.environ.get('NEGOTIATE_FORMATS', 'avif,webp')  # empty disables
+    app.config['VARIANT_MAX_BYTES'] = int(os.environ.get('VARIANT_MAX_BYTES', 1024 ** 3))
+
+    # Perceptual-hash (dHash) index of uploads and generated images: /api/images/similar, and caption /
+    # edit cache entries shared between images within PHASH_REUSE_DISTANCE bits (0 = exact matches only;
+    # reuse also requires matching colours and aspect ratio)
+    app.config['PHASH_ENABLED'] = _env_flag('PHASH_ENABLED', 'true')
+    app.config['PHASH_REUSE_DISTANCE'] = int(os.environ.get('PHASH_REUSE_DISTANCE', 0))
+    # Hash files stored before the index in a background thread at startup (imports Pillow and reads
+    # every stored image); otherwise run `flask --app app phash-backfill` once
+    app.config['PHASH_BACKFILL'] = _env_flag('PHASH_BACKFILL', 'false')
+
+    # Identical concurrent generate / edit / caption calls share one model call (use_cache=false opts out)
+    app.config['SINGLE_FLIGHT_ENABLED'] = _env_flag('SINGLE_FLIGHT_ENABLED', 'true')
+
+    # Asynchronous jobs for /generate and /edit (persisted in STATE_FOLDER/jobs.sqlite3)
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))
+    app.config['JOB_MAX_PENDING'] = int(os.environ.get('JOB_MAX_PENDING', 100))
+    # a running job whose worker stops heartbeating for this many seconds is requeued
+    app.config['JOB_LEASE_TTL'] = int(os.environ.get('JOB_LEASE_TTL', 30))
+    app.config['JOB_HANDLERS'] = {'generate': run_generate_job, 'edit': run_edit_job}
+    # callback_url must be http(s); loopback / private / link-local hosts only when this is true
+    app.config['JOB_CALLBACK_ALLOW_PRIVATE'] = _env_flag('JOB_CALLBACK_ALLOW_PRIVATE', 'false')
+
+    # Renditions in GENERATED_FOLDER are evicted LRU-first once they total this many bytes (0 = no cap);
+    # model output there doesn't count and is never evicted
+    app.config['GENERATED_MAX_BYTES'] = int(os.environ.get('GENERATED_MAX_BYTES', 1024 ** 3))
+
+    # Storage janitor: TTL (seconds) and quota (bytes) per folder, 0 disables either
+    app.config['JANITOR_ENABLED'] = _env_flag('JANITOR_ENABLED', 'true')
+    app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 300))
+    app.config['UPLOAD_TTL'] = int(os.environ.get('UPLOAD_TTL', 30 * 86400))
+    app.config['UPLOAD_QUOTA_BYTES'] = int(os.environ.get('UPLOAD_QUOTA_BYTES', 5 * 1024 ** 3))
+    app.config['GENERATED_TTL'] = int(os.environ.get('GENERATED_TTL', 30 * 86400))
+    app.config['GENERATED_QUOTA_BYTES'] = int(os.environ.get('GENERATED_QUOTA_BYTES', 5 * 1024 ** 3))
+
+    # State shared by worker processes (rate-limit buckets, result caches, coalesced calls, in-flight
+    # markers, janitor lease): 'sqlite' (WAL database in STATE_FOLDER, one machine), 'redis', or 'local'
+    # (per-process only). Job status is always in STATE_FOLDER/jobs.sqlite3.
+    app.config['SHARED_STATE_BACKEND'] = os.environ.get('SHARED_STATE_BACKEND', 'sqlite')
+    app.config['SHARED_STATE_PATH'] = os.environ.get('SHARED_STATE_PATH', '')  # '' = STATE_FOLDER/shared_state.sqlite3
+    app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    app.config['REDIS_PREFIX'] = os.environ.get('REDIS_PREFIX', 'social-media-generator:')
+
+    # Storage backend: 'local', or 's3' to share files between nodes (local folders become a cache).
+    # The janitor and GENERATED_MAX_BYTES only evict local copies; expire bucket objects with a lifecycle rule.
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+    app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET', '')
+    app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', '')
+    app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL', '')  # e.g. a local MinIO
+    app.config['S3_REGION'] = os.environ.get('S3_REGION', '')
+    app.config['S3_PRESIGN_DOWNLOADS'] = _env_flag('S3_PRESIGN_DOWNLOADS', 'true')
+    app.config['S3_PRESIGN_TTL'] = int(os.environ.get('S3_PRESIGN_TTL', 3600))
+
+    # Batch generation fan-out
+    app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+    app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 4))
+    app.config['BATCH_MAX_CONCURRENCY'] = int(os.environ.get('BATCH_MAX_CONCURRENCY', 8))
+
+    # Import the genai SDK and Pillow and load on-disk state in create_app (e.g. a pre-fork master)
+    # instead of on first use in every worker; see warmup()
+    app.config['APP_PRELOAD'] = _env_flag('APP_PRELOAD', 'false')
+
+    if config:
+        app.config.update(config)
+
+    CORS(app)
+
+    # Only in-memory objects here: folders, on-disk state and Pillow are set up per process by
+    # _init_runtime() on the first request (or earlier by warmup()), so importing the app stays cheap
+    # Opens no connection until first used, in each process
+    shared_state = app.extensions['shared_state'] = create_shared_state(app.config)
+    app.extensions['image_preprocessor'] = ImagePreprocessor(
+        max_sides={
+            'edit': app.config['MODEL_INPUT_MAX_SIDE_EDIT'],
+            'caption': app.config['MODEL_INPUT_MAX_SIDE_CAPTION'],
+        },
+        output_format=app.config['MODEL_INPUT_FORMAT'],
+        quality=app.config['MODEL_INPUT_QUALITY'],
+        cache_bytes=app.config['MODEL_INPUT_CACHE_BYTES'],
+    )
+    app.extensions['rate_limiter'] = (
+        RateLimiter(
+            settings={
+                'image': {'rate': app.config['IMAGE_MODEL_RPS'], 'burst': app.config['IMAGE_MODEL_BURST']},
+                'caption': {'rate': app.config['CAPTION_MODEL_RPS'], 'burst': app.config['CAPTION_MODEL_BURST']},
+            },
+            defaults={
+                'max_limit': app.config['UPSTREAM_MAX_CONCURRENCY'],
+                'max_queue': app.config['UPSTREAM_MAX_QUEUE'],
+                'max_wait': app.config['UPSTREAM_MAX_WAIT'],
+            },
+            state=shared_state,
+        )
+        if app.config['RATE_LIMIT_ENABLED'] else None
+    )
+    app.extensions['call_policy'] = CallPolicy(
+        deadlines={'image': app.config['IMAGE_CALL_DEADLINE'], 'caption': app.config['CAPTION_CALL_DEADLINE']},
+        idle_timeout=app.config['GEMINI_IDLE_TIMEOUT'],
+        connect_timeout=app.config['GEMINI_CONNECT_TIMEOUT'],
+        max_retries=app.config['GEMINI_MAX_RETRIES'],
+        backoff_base=app.config['GEMINI_BACKOFF_BASE'],
+        backoff_max=app.config['GEMINI_BACKOFF_MAX'],
+        hedge_captions=app.config['CAPTION_HEDGE_ENABLED'],
+        hedge_after=float(app.config['CAPTION_HEDGE_AFTER']) if app.config['CAPTION_HEDGE_AFTER'] else None,
+    )
+    app.extensions['in_flight'] = InFlightRegistry(state=shared_state)
+    app.extensions['single_flight'] = (
+        SingleFlight(
+            state=shared_state,
+            lease_ttl=max(app.config['IMAGE_CALL_DEADLINE'], app.config['CAPTION_CALL_DEADLINE']) + 30,
+        )
+        if app.config['SINGLE_FLIGHT_ENABLED'] else None
+    )
+    for name in ('generation_cache', 'caption_cache', 'file_index', 'image_encoder', 'similarity', 'storage',
+                 'janitor'):
+        app.extensions[name] = None
+    app.extensions['runtime_pid'] = None  # process that last ran _init_runtime
+    # Created lazily on first use, see services.gemini_service.get_gemini_service
+    app.extensions['gemini_service'] = None
+    app.extensions['job_queue'] = None  # see services.job_service.get_job_queue
+
+    # Register blueprints
+    app.register_blueprint(image_bp, url_prefix='/api/images')
+    app.register_blueprint(caption_bp, url_prefix='/api/captions')
+
+    @app.route('/api/health', methods=['GET'])
+    def health_check():
+        return jsonify({'status': 'healthy', 'message': 'Social Media Generator API is running'})
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus text exposition of this worker process."""
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.cli.command('phash-backfill')
+    def phash_backfill():
+        """Add stored images missing from the perceptual-hash index."""
+        _load_state(app)
+        if app.extensions['similarity'] is None:
+            raise SystemExit('PHASH_ENABLED is false')
+        added = app.extensions['similarity'].backfill(app.extensions['file_index'])
+        print(f"Hashed {added} images; the index holds {len(app.extensions['similarity'])}")
+
+    app.before_request(lambda: _init_runtime(app))  # registered first: runs before the other hooks
+    _instrument_requests(app)
+    REGISTRY.add_collector('app_state', lambda: _collect_app_state(app))
+
+    if app.config['APP_PRELOAD']:
+        warmup(app)
+    return app
+
+
+def _init_runtime(app):
+    """Per-process setup, run before every request; a no-op once this process has done it."""
+    if app.extensions['runtime_pid'] == os.getpid():
+        return
+    with _runtime_lock:
+        if app.extensions['runtime_pid'] == os.getpid():
+            return
+        _load_state(app)
+        _start_background(app)
+        app.extensions['runtime_pid'] = os.getpid()
+
+
+def preload_modules():
+    """Import the heavy dependencies (genai SDK, Pillow and its format plugins) now instead of on first use."""
+    from google import genai  # noqa: F401
+    from google.genai import types  # noqa: F401
+    from PIL import Image
+    Image.init()
+
+
+def warmup(app):
+    """
+    Optional preload hook for pre-fork servers: import the heavy modules and load the on-disk
+    state once in the master so forked workers inherit them (e.g. gunicorn --preload with
+    APP_PRELOAD=true). Background threads are still started in each worker on its first request.
+    """
+    preload_modules()
+    with _runtime_lock:
+        _load_state(app)
+
+
+def _load_state(app):
+    """Create the folders and load the on-disk state (caches, file index); no threads, safe before fork."""
+    if app.extensions['file_index'] is not None:
+        return
+    for folder in ('UPLOAD_FOLDER', 'GENERATED_FOLDER', 'STATE_FOLDER', 'VARIANT_FOLDER'):
+        os.makedirs(app.config[folder], exist_ok=True)
+
+    # with a shared state the entries live there; the JSON index is for single-process setups
+    shared_state = app.extensions['shared_state']
+    app.extensions['generation_cache'] = (
+        ResultCache(
+            max_entries=app.config['GENERATION_CACHE_MAX_ENTRIES'],
+            ttl=app.config['GENERATION_CACHE_TTL'],
+            index_path=None if shared_state is not None else os.path.join(app.config['STATE_FOLDER'],
+                                                                          'generation_cache.json'),
+            state=shared_state,
+            namespace='generation_cache',
+        )
+        if app.config['GENERATION_CACHE_ENABLED'] else None
+    )
+    app.extensions['caption_cache'] = (
+        ResultCache(
+            max_entries=app.config['CAPTION_CACHE_MAX_ENTRIES'],
+            ttl=app.config['CAPTION_CACHE_TTL'],
+            index_path=None if shared_state is not None else os.path.join(app.config['STATE_FOLDER'],
+                                                                          'caption_cache.json'),
+            state=shared_state,
+            namespace='caption_cache',
+        )
+        if app.config['CAPTION_CACHE_ENABLED'] else None
+    )
+    app.extensions['image_encoder'] = ImageEncoder(
+        rendition_format=app.config['RENDITION_FORMAT'],
+        quality={'jpeg': app.config['JPEG_QUALITY'], 'webp': app.config['WEBP_QUALITY'],
+                 'avif': app.config['AVIF_QUALITY']},
+        progressive=app.config['JPEG_PROGRESSIVE'],
+        generated_format=app.config['GENERATED_FORMAT'],
+        negotiate_formats=[fmt.strip() for fmt in app.config['NEGOTIATE_FORMATS'].split(',') if fmt.strip()],
+        variant_folder=app.config['VARIANT_FOLDER'],
+        max_variant_bytes=app.config['VARIANT_MAX_BYTES'],
+    )
+    # Metadata of everything in UPLOAD_FOLDER / GENERATED_FOLDER, kept in memory
+    file_index = FileIndex(
+        {'uploads': app.config['UPLOAD_FOLDER'], 'generated': app.config['GENERATED_FOLDER']},
+        manifest_path=os.path.join(app.config['STATE_FOLDER'], 'file_index.jsonl'),
+        state=shared_state,
+    )
+    app.extensions['similarity'] = (
+        PerceptualIndex(manifest_path=os.path.join(app.config['STATE_FOLDER'], 'phash_index.jsonl'))
+        if app.config['PHASH_ENABLED'] else None
+    )
+    app.extensions['storage'] = create_storage(app.config, file_index)
+    app.extensions['file_index'] = file_index  # set last: marks the state as loaded
+
+
+def _start_background(app):
+    """Threads don't survive fork(), so each worker process starts its own janitor and backfill."""
+    app.extensions['janitor'] = None
+    if app.config['JANITOR_ENABLED']:
+        janitor = StorageJanitor(
+            app.extensions['file_index'],
+            policies={
+                'uploads': {'ttl': app.config['UPLOAD_TTL'], 'quota': app.config['UPLOAD_QUOTA_BYTES']},
+                'generated': {'ttl': app.config['GENERATED_TTL'], 'quota': app.config['GENERATED_QUOTA_BYTES']},
+            },
+            interval=app.config['JANITOR_INTERVAL'],
+            in_flight=app.extensions['in_flight'],
+            referenced_paths=lambda: get_job_queue(app).referenced_paths(),
+            state=app.extensions['shared_state'],
+            storage=app.extensions['storage'],
+        )
+        janitor.start()
+        app.extensions['janitor'] = janitor
+    if app.extensions['similarity'] is not None and app.config['PHASH_BACKFILL']:
+        threading.Thread(
+            target=app.extensions['similarity'].backfill,
+            args=(app.extensions['file_index'],),
+            kwargs={'pause': 0.01},
+            name='phash-backfill',
+            daemon=True,
+        ).start()
+
+
+def _instrument_requests(app):
+    """Count and time every request per route; streamed bodies are timed until fully sent."""
+    @app.before_request
+    def start_timer():
+        g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.metrics_started = time.perf_counter()
+        HTTP_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = g.pop('metrics_endpoint', None)
+        if endpoint is None:
+            return response
+        started, method, status = g.pop('metrics_started'), request.method, response.status_code
+
+        def finished():
+            HTTP_IN_FLIGHT.labels(endpoint).dec()
+            HTTP_REQUESTS.labels(endpoint, method, status).inc()
+            HTTP_LATENCY.labels(endpoint, method).observe(time.perf_counter() - started)
+
+        response.call_on_close(finished)
+        return response
+
+
+def _collect_app_state(app):
+    """Export counters the caches, limiter, call policy, single-flight and janitor already keep."""
+    families = []
+    caches = [(name, app.extensions.get(f'{name}_cache')) for name in ('generation', 'caption')]
+    caches = [(name, cache.stats()) for name, cache in caches if cache is not None]
+    families.append(('result_cache_hits_total', 'counter', 'Result cache hits.',
+                     [({'cache': name}, stats['hits']) for name, stats in caches]))
+    families.append(('result_cache_misses_total', 'counter', 'Result cache misses.',
+                     [({'cache': name}, stats['misses']) for name, stats in caches]))
+
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is not None:
+        limits = limiter.stats()
+        families.append(('upstream_concurrency_limit', 'gauge', 'Adaptive concurrency limit per model.',
+                         [({'kind': kind}, stats['limit']) for kind, stats in limits.items()]))
+        families.append(('upstream_waiting', 'gauge', 'Callers queued for an upstream slot.',
+                         [({'kind': kind}, stats['waiting']) for kind, stats in limits.items()]))
+        families.append(('upstream_rejected_total', 'counter', 'Calls refused with 503 by the limiter.',
+                         [({'kind': kind}, stats['rejected']) for kind, stats in limits.items()]))
+        families.append(('upstream_rate_limited_total', 'counter', 'Upstream 429 responses.',
+                         [({'kind': kind}, stats['rate_limited']) for kind, stats in limits.items()]))
+
+    calls = app.extensions['call_policy'].stats()
+    for counter in ('retries', 'timeouts', 'failed', 'hedged', 'hedge_wins'):
+        families.append((f'gemini_{counter}_total', 'counter', f'Model calls: {counter.replace("_", " ")}.',
+                         [({'kind': kind}, stats.get(counter, 0)) for kind, stats in calls.items()]))
 
-CORS(app)
+    single_flight = app.extensions.get('single_flight')
+    if single_flight is not None:
+        flights = single_flight.stats()
+        families.append(('single_flight_calls_total', 'counter', 'Model calls led by a first caller.',
+                         [({'kind': kind}, stats['calls']) for kind, stats in flights.items()]))
+        families.append(('single_flight_deduplicated_total', 'counter',
+                         'Calls answered by an identical in-flight call instead of the model.',
+                         [({'kind': kind}, stats['deduplicated']) for kind, stats in flights.items()]))
+        families.append(('single_flight_waiting', 'gauge', 'Callers waiting on an identical in-flight call.',
+                         [({'kind': kind}, stats['waiting']) for kind, stats in flights.items()]))
 
-# Create directories if they don't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['GENERATED_FOLDER'], exist_ok=True)
+    janitor = app.extensions.get('janitor')
+    if janitor is not None:
+        families.append(('janitor_bytes_reclaimed_total', 'counter', 'Bytes deleted by the storage janitor.',
+                         [({}, janitor.total_bytes_reclaimed)]))
+    return families
 
-# Register blueprints
-app.register_blueprint(image_bp, url_prefix='/api/images')
-app.register_blueprint(caption_bp, url_prefix='/api/captions')
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'healthy', 'message': 'Social Media Generator API is running'})
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=False, host='0.0.0.0', port=5000)
@@ -0,0 +1,81 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'bench', 'results')
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list (q in 0..100)."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies_s, elapsed_s=None, errors=0, extra=None):
+    """Latency summary in milliseconds; throughput if the wall-clock duration is given."""
+    values = sorted(latencies_s)
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+        'min_ms': round(values[0] * 1000, 3) if values else None,
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+        'max_ms': round(values[-1] * 1000, 3) if values else None,
+    }
+    if elapsed_s:
+        summary['elapsed_s'] = round(elapsed_s, 3)
+        summary['throughput_rps'] = round(len(values) / elapsed_s, 2)
+    if extra:
+        summary.update(extra)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, results, output=None, params=None):
+    """
+    Write {"meta": ..., "params": ..., "results": ...} as JSON and return the path.
+    Default location: bench/results/<name>-<git revision>.json
+    """
+    payload = {
+        'meta': {
+            'benchmark': name,
+            'git_revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'params': params or {},
+        'results': results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{name}-{payload['meta']['git_revision'] or 'worktree'}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    return output
+
+
+def print_table(rows, columns):
+    """Print dict rows as a fixed-width table."""
+    widths = [max(len(column), *(len(str(row.get(column, ''))) for row in rows)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
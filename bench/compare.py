@@ -0,0 +1,75 @@
+"""
+Compare two benchmark result files (e.g. from two commits) and flag regressions.
+
+    python -m bench.compare bench/results/load-abc123.json bench/results/load-def456.json --threshold 10
+
+Exits with status 1 when any compared latency got worse by more than --threshold percent
+or throughput dropped by more than that.
+"""
+import argparse
+import json
+from bench.common import print_table
+
+LATENCY_KEYS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def _flatten(results, prefix=''):
+    """{"a/b": summary} for every nested dict that looks like a latency summary."""
+    flat = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        name = f"{prefix}/{key}" if prefix else key
+        if 'p50_ms' in value:
+            flat[name] = value
+        else:
+            flat.update(_flatten(value, name))
+    return flat
+
+
+def _change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return round((after - before) / before * 100, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    before, after = _flatten(baseline['results']), _flatten(candidate['results'])
+    rows, regressions = [], []
+    for name in sorted(set(before) & set(after)):
+        row = {'benchmark': name}
+        for key in LATENCY_KEYS:
+            change = _change(before[name].get(key), after[name].get(key))
+            row[key] = f"{before[name].get(key)} -> {after[name].get(key)} ({change:+}%)" if change is not None else ''
+            if change is not None and change > args.threshold:
+                regressions.append(f"{name} {key} {change:+}%")
+        change = _change(before[name].get('throughput_rps'), after[name].get('throughput_rps'))
+        if change is not None:
+            row['throughput_rps'] = f"{change:+}%"
+            if -change > args.threshold:
+                regressions.append(f"{name} throughput {change:+}%")
+        rows.append(row)
+
+    print(f"baseline  {baseline['meta'].get('git_revision')}  {baseline['meta'].get('timestamp')}")
+    print(f"candidate {candidate['meta'].get('git_revision')}  {candidate['meta'].get('timestamp')}\n")
+    print_table(rows, ['benchmark', *LATENCY_KEYS, 'throughput_rps'])
+    if regressions:
+        print(f"\nRegressions above {args.threshold}%:")
+        for line in regressions:
+            print(f"  {line}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
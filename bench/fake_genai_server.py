@@ -0,0 +1,189 @@
+"""
+Local stand-in for the Gemini REST API used by benchmarks and load tests.
+
+Answers generateContent (captions) and streamGenerateContent (image generation/edit)
+by replaying recorded image payloads, with configurable latency and injected errors.
+Point the app at it with GEMINI_BASE_URL=http://127.0.0.1:<port>/ and any GEMINI_API_KEY.
+
+    python -m bench.fake_genai_server --port 8089 --first-chunk-ms 800 --error-rate 0.02
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bench.common import REPO_ROOT
+
+DEFAULT_PAYLOAD_GLOB = os.path.join(REPO_ROOT, 'generated', 'generated_*.png')
+
+
+class FakeGenaiConfig:
+    def __init__(self, payloads, images_per_response=1, first_chunk_ms=0.0, chunk_ms=0.0,
+                 caption_ms=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.payloads = payloads  # [(mime type, base64 data)] replayed round-robin
+        self.images_per_response = images_per_response
+        self.first_chunk_ms = first_chunk_ms
+        self.chunk_ms = chunk_ms
+        self.caption_ms = caption_ms
+        self.jitter = jitter                    # +/- fraction applied to every delay
+        self.error_rate = error_rate            # share of calls answered 503
+        self.rate_limit_rate = rate_limit_rate  # share of calls answered 429
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors_injected = 0
+        self._lock = threading.Lock()
+
+    def delay(self, ms):
+        if ms <= 0:
+            return
+        factor = 1 + self.random.uniform(-self.jitter, self.jitter) if self.jitter else 1
+        time.sleep(ms * factor / 1000)
+
+    def next_payload(self):
+        with self._lock:
+            self.calls += 1
+            return self.payloads[self.calls % len(self.payloads)]
+
+    def injected_error(self):
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return 429, 'RESOURCE_EXHAUSTED'
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503, 'UNAVAILABLE'
+        return None
+
+
+def load_payloads(pattern=DEFAULT_PAYLOAD_GLOB):
+    payloads = []
+    for path in sorted(glob.glob(pattern)):
+        mime = 'image/jpeg' if path.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
+        with open(path, 'rb') as f:
+            payloads.append((mime, base64.b64encode(f.read()).decode('ascii')))
+    if not payloads:
+        raise SystemExit(f"No payload images match {pattern}")
+    return payloads
+
+
+class FakeGenaiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024  # whole SSE events per write; avoids Nagle stalls on small writes
+    config = None         # FakeGenaiConfig, set by make_server
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        config = self.config
+
+        error = config.injected_error()
+        if error is not None:
+            with config._lock:
+                config.errors_injected += 1
+            code, status = error
+            body = {'error': {'code': code, 'message': 'injected by fake server', 'status': status}}
+            headers = {'Retry-After': '1'} if code == 429 else {}
+            return self._send_json(code, body, headers)
+
+        if ':streamGenerateContent' in self.path:
+            return self._stream_images()
+        if ':generateContent' in self.path:
+            config.delay(config.caption_ms)
+            return self._send_json(200, {'candidates': [{'content': {
+                'role': 'model',
+                'parts': [{'text': 'Golden hour on the coast, made for slow mornings. '
+                                   '#sunset #travel #coastal #weekendvibes'}],
+            }}]})
+        self._send_json(404, {'error': {'code': 404, 'message': 'unknown method', 'status': 'NOT_FOUND'}})
+
+    def _stream_images(self):
+        config = self.config
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        config.delay(config.first_chunk_ms)
+        self._send_event({'candidates': [{'content': {'role': 'model', 'parts': [{'text': 'Here you go.'}]}}]})
+        for index in range(config.images_per_response):
+            if index:
+                config.delay(config.chunk_ms)
+            mime, data = config.next_payload()
+            self._send_event({'candidates': [{'content': {
+                'role': 'model', 'parts': [{'inlineData': {'mimeType': mime, 'data': data}}],
+            }}]})
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _send_event(self, obj):
+        event = f"data: {json.dumps(obj)}\r\n\r\n".encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.flush()
+
+    def _send_json(self, code, obj, headers=None):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(config, host='127.0.0.1', port=0):
+    """Start the fake server on a daemon thread; returns (server, base_url)."""
+    handler = type('ConfiguredFakeGenaiHandler', (FakeGenaiHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-genai', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/"
+
+
+def add_arguments(parser):
+    parser.add_argument('--payloads', default=DEFAULT_PAYLOAD_GLOB, help='glob of images to replay')
+    parser.add_argument('--images-per-response', type=int, default=1)
+    parser.add_argument('--first-chunk-ms', type=float, default=0.0, help='delay before the first streamed chunk')
+    parser.add_argument('--chunk-ms', type=float, default=0.0, help='delay between streamed images')
+    parser.add_argument('--caption-ms', type=float, default=0.0, help='latency of generateContent')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- fraction applied to delays')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of calls answered 429')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def config_from_args(args):
+    return FakeGenaiConfig(
+        load_payloads(args.payloads),
+        images_per_response=args.images_per_response,
+        first_chunk_ms=args.first_chunk_ms,
+        chunk_ms=args.chunk_ms,
+        caption_ms=args.caption_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = make_server(config_from_args(args), args.host, args.port)
+    print(f"Fake genai server listening on {base_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
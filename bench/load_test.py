@@ -0,0 +1,216 @@
+"""
+End-to-end load test of the API against the fake genai server.
+
+Starts the fake backend and the app (threaded Werkzeug server, temp folders) in this
+process, then drives each scenario with --concurrency keep-alive clients and reports
+throughput and p50/p95/p99 latency. Results go to bench/results/load-<rev>.json.
+
+    python -m bench.load_test --requests 200 --concurrency 8 --first-chunk-ms 200
+    python -m bench.load_test --scenarios resize,download --target http://127.0.0.1:5000
+"""
+import argparse
+import glob
+import http.client
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from bench import fake_genai_server
+from bench.common import REPO_ROOT, print_table, summarize, write_results
+
+SCENARIOS = ('generate', 'generate_same', 'edit', 'resize', 'caption', 'download')
+
+
+class Client:
+    """One keep-alive HTTP/1.1 connection; reconnects after errors."""
+    def __init__(self, base_url, timeout=300):
+        parts = urlsplit(base_url)
+        self.host, self.port, self.timeout = parts.hostname, parts.port or 80, timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            data = response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return response.status, data
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+    def post_json(self, path, payload):
+        status, data = self.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+        return status, data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def upload_sample(client, image_path):
+    boundary = uuid.uuid4().hex
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="image"; '
+        f'filename="{os.path.basename(image_path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    status, response = client.request('POST', '/api/images/upload', body,
+                                      {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    if status != 200:
+        raise SystemExit(f"Sample upload failed ({status}): {response[:200]!r}")
+    return json.loads(response)
+
+
+def scenario_requests(name, upload):
+    """(method, path, json body) for the i-th request of a scenario."""
+    image_id = upload['image_id']
+    platforms = ('instagram', 'facebook', 'twitter', 'linkedin')
+    if name == 'generate':
+        return lambda i: ('POST', '/api/images/generate',
+                          {'prompt': f'a lighthouse at dusk, variation {i}', 'use_cache': False})
+    if name == 'generate_same':
+        # one prompt from every client: concurrent duplicates share a model call (single-flight)
+        return lambda i: ('POST', '/api/images/generate', {'prompt': 'a lighthouse at dusk'})
+    if name == 'edit':
+        return lambda i: ('POST', '/api/images/edit', {'image_id': image_id, 'edit_prompt': f'warmer tones {i}'})
+    if name == 'resize':
+        return lambda i: ('POST', '/api/images/resize', {'image_id': image_id, 'platform': platforms[i % 4]})
+    if name == 'caption':
+        return lambda i: ('POST', '/api/captions/generate', {'image_id': image_id, 'platform': platforms[i % 4]})
+    if name == 'download':
+        return lambda i: ('GET', upload['download_url'], None)
+    raise SystemExit(f"Unknown scenario {name}")
+
+
+def run_scenario(base_url, name, upload, total, concurrency):
+    make_request = scenario_requests(name, upload)
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = Client(base_url)
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                method, path, payload = make_request(i)
+                started = time.perf_counter()
+                try:
+                    if payload is None:
+                        status, _ = client.request(method, path)
+                    else:
+                        status, _ = client.post_json(path, payload)
+                except (OSError, http.client.HTTPException):
+                    status = 'connection_error'
+                elapsed = time.perf_counter() - started
+                with lock:
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    if status == 200:
+                        latencies.append(elapsed)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, name=f'load-{name}-{n}') for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    errors = total - len(latencies)
+    return summarize(latencies, elapsed, errors, extra={'concurrency': concurrency, 'statuses': statuses})
+
+
+def start_app(backend_url, work_dir, args):
+    os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no access log lines in the report
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app({
+        'UPLOAD_FOLDER': os.path.join(work_dir, 'uploads'),
+        'GENERATED_FOLDER': os.path.join(work_dir, 'generated'),
+        'VARIANT_FOLDER': os.path.join(work_dir, 'variants'),
+        'STATE_FOLDER': os.path.join(work_dir, 'state'),
+        'GEMINI_BASE_URL': backend_url,
+        # measure the backend path, not our own caches, unless asked to
+        'GENERATION_CACHE_ENABLED': False,
+        'CAPTION_CACHE_ENABLED': args.with_caches,
+        'RATE_LIMIT_ENABLED': args.with_limiter,
+        'JANITOR_ENABLED': False,
+    })
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"subset of {','.join(SCENARIOS)}")
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--target', help='benchmark an already running app instead of starting one')
+    parser.add_argument('--sample', help='image uploaded for edit/resize/caption/download '
+                                         '(default: first JPEG in uploads/)')
+    parser.add_argument('--with-caches', action='store_true', help='keep the caption cache enabled')
+    parser.add_argument('--with-limiter', action='store_true', help='keep the upstream rate limiter enabled')
+    parser.add_argument('--output', help='JSON path (default bench/results/load-<rev>.json)')
+    fake_genai_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    sample = args.sample or sorted(glob.glob(os.path.join(REPO_ROOT, 'uploads', '*.jpg')))[0]
+
+    work_dir = tempfile.mkdtemp(prefix='load-test-')
+    servers = []
+    try:
+        if args.target:
+            base_url = args.target.rstrip('/')
+        else:
+            backend, backend_url = fake_genai_server.make_server(fake_genai_server.config_from_args(args))
+            app_server, base_url = start_app(backend_url, work_dir, args)
+            servers += [backend, app_server]
+
+        setup_client = Client(base_url)
+        upload = upload_sample(setup_client, sample)
+        for name in scenarios:  # one untimed request each: lazy service creation, first decode
+            method, path, payload = scenario_requests(name, upload)(0)
+            setup_client.post_json(path, payload) if payload is not None else setup_client.request(method, path)
+        setup_client.close()
+
+        results, rows = {}, []
+        for name in scenarios:
+            results[name] = run_scenario(base_url, name, upload, args.requests, args.concurrency)
+            rows.append({'scenario': name, **results[name]})
+        if not args.target:
+            status, metrics = Client(base_url).request('GET', '/api/metrics')
+            if status == 200:
+                results['_server_metrics'] = metrics.decode()
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(rows, ['scenario', 'count', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+    params = {key: value for key, value in vars(args).items() if key != 'payloads'}
+    output = write_results('load', results, args.output, params=params)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
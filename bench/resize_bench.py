@@ -0,0 +1,90 @@
+"""
+Microbenchmark of ImageService.resize_for_social_media over the sample images in uploads/.
+
+Every iteration renders into an empty folder so the rendition cache never answers;
+--cached additionally times the cache-hit path (rendition already on disk).
+
+    python -m bench.resize_bench --repeat 5
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from PIL import Image
+from bench.common import REPO_ROOT, print_table, summarize, write_results
+from services.image_service import PLATFORM_SIZES, ImageService
+from utils.file_utils import file_sha256
+
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png', '*.webp', '*.gif')
+
+
+def sample_images(folder):
+    paths = []
+    for pattern in IMAGE_PATTERNS:
+        paths.extend(glob.glob(os.path.join(folder, '**', pattern), recursive=True))
+    return sorted(set(paths))
+
+
+def bench_image(image_path, platforms, repeat, cached):
+    with Image.open(image_path) as img:
+        source = {'width': img.width, 'height': img.height, 'format': img.format}
+
+    results = {}
+    for platform in platforms:
+        cold, warm = [], []
+        for _ in range(repeat):
+            work_dir = tempfile.mkdtemp(prefix='resize-bench-')
+            try:
+                service = ImageService(os.path.join(work_dir, 'uploads'), work_dir)
+                started = time.perf_counter()
+                service.resize_for_social_media(image_path, platform)
+                cold.append(time.perf_counter() - started)
+                if cached:
+                    started = time.perf_counter()
+                    service.resize_for_social_media(image_path, platform)
+                    warm.append(time.perf_counter() - started)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        results[platform] = {'render': summarize(cold)}
+        if cached:
+            results[platform]['cache_hit'] = summarize(warm)
+    return {'source': {**source, 'bytes': os.path.getsize(image_path)}, 'platforms': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(REPO_ROOT, 'uploads'), help='folder of sample images')
+    parser.add_argument('--platforms', default=','.join(PLATFORM_SIZES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cached', action='store_true', help='also time the rendition cache hit')
+    parser.add_argument('--output', help='JSON path (default bench/results/resize-<rev>.json)')
+    args = parser.parse_args()
+
+    platforms = [p.strip() for p in args.platforms.split(',') if p.strip()]
+    images = sample_images(args.images)
+    if not images:
+        raise SystemExit(f"No sample images under {args.images}")
+
+    # resizing the same bytes twice is deduplicated by digest; measure each distinct image once
+    seen, results, rows = set(), {}, []
+    for path in images:
+        digest = file_sha256(path)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        name = os.path.relpath(path, args.images)
+        results[name] = bench_image(path, platforms, args.repeat, args.cached)
+        for platform, stats in results[name]['platforms'].items():
+            rows.append({'image': name[:48], 'platform': platform, **{
+                key: stats['render'][key] for key in ('p50_ms', 'p95_ms', 'p99_ms')
+            }})
+
+    print_table(rows, ['image', 'platform', 'p50_ms', 'p95_ms', 'p99_ms'])
+    output = write_results('resize', results, args.output, params=vars(args))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the perceptual-hash index behind /api/images/similar.
+
+Builds an in-memory PerceptualIndex of --size synthetic hashes (random images plus
+clusters of near-duplicates a few bits apart), then times Hamming-radius queries at
+several max_distance values. Also times dHash itself on the sample images in uploads/.
+
+    python -m bench.similar_bench --size 100000 --queries 2000
+"""
+import argparse
+import os
+import random
+import time
+from bench.common import REPO_ROOT, print_table, summarize, write_results
+from bench.resize_bench import sample_images
+from services.similarity import HASH_BITS, PerceptualIndex, hash_image
+
+
+def synthetic_hashes(size, cluster_share, rng):
+    """Random 64-bit hashes; cluster_share of them are 1-3 bit variants of earlier ones."""
+    hashes = []
+    for _ in range(size):
+        if hashes and rng.random() < cluster_share:
+            value = rng.choice(hashes)
+            for bit in rng.sample(range(HASH_BITS), rng.randint(1, 3)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(HASH_BITS)
+        hashes.append(value)
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100_000, help='indexed hashes')
+    parser.add_argument('--queries', type=int, default=2000, help='queries per max_distance')
+    parser.add_argument('--distances', default='0,4,8,11')
+    parser.add_argument('--cluster-share', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON path (default bench/results/similar-<rev>.json)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    hashes = synthetic_hashes(args.size, args.cluster_share, rng)
+    index = PerceptualIndex()
+    started = time.perf_counter()
+    for number, value in enumerate(hashes):
+        index.add(f"img{number}", value, None)
+    results = {'build': {'size': args.size, 'seconds': round(time.perf_counter() - started, 3)}}
+
+    rows = []
+    for max_distance in (int(value) for value in args.distances.split(',')):
+        latencies, found = [], 0
+        for _ in range(args.queries):
+            value = rng.choice(hashes) ^ (1 << rng.randrange(HASH_BITS))  # a near-duplicate of a stored image
+            started = time.perf_counter()
+            found += len(index.query(value, max_distance, limit=20))
+            latencies.append(time.perf_counter() - started)
+        name = f"query_d{max_distance}"
+        results[name] = summarize(latencies, extra={'mean_matches': round(found / args.queries, 2)})
+        rows.append({'benchmark': name, **results[name]})
+
+    images = sample_images(os.path.join(REPO_ROOT, 'uploads'))
+    if images:
+        latencies = []
+        for path in images:
+            started = time.perf_counter()
+            hash_image(path)
+            latencies.append(time.perf_counter() - started)
+        results['dhash'] = summarize(latencies, extra={'images': len(images), 'numpy': index.stats()['numpy']})
+        rows.append({'benchmark': 'dhash', **results['dhash']})
+
+    print(f"index of {args.size} hashes built in {results['build']['seconds']} s")
+    print_table(rows, ['benchmark', 'count', 'mean_matches', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+    output = write_results('similar', results, args.output, params=vars(args))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
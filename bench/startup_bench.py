@@ -0,0 +1,117 @@
+"""
+Cold-start benchmark of the app: `import app` measured with `python -X importtime`.
+
+Each run is a fresh interpreter, so nothing is cached in memory. Reports the cumulative
+import time of `app`, the slowest modules under it, whether the genai SDK and Pillow were
+imported, and the wall-clock time to the first /api/health response. --preload runs the
+same with APP_PRELOAD=true, i.e. what a pre-fork master pays up front.
+
+    python -m bench.startup_bench --repeat 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from bench.common import REPO_ROOT, print_table, summarize, write_results
+
+HEAVY_MODULES = ('google.genai', 'PIL.Image', 'requests', 'boto3')
+
+# Runs in the child interpreter; prints one JSON line on stdout (importtime goes to stderr)
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/api/health')
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import_s': imported - started,
+    'first_request_s': time.perf_counter() - imported,
+    'modules': {name: name in sys.modules for name in %r},
+}))
+""" % (HEAVY_MODULES,)
+
+
+def parse_importtime(stderr):
+    """{module: (self us, cumulative us)} from `-X importtime` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def run_once(preload, work_dir):
+    env = {
+        **os.environ,
+        'APP_PRELOAD': 'true' if preload else 'false',
+        # keep the repository's folders and state untouched
+        'UPLOAD_FOLDER': os.path.join(work_dir, 'uploads'),
+        'GENERATED_FOLDER': os.path.join(work_dir, 'generated'),
+        'STATE_FOLDER': os.path.join(work_dir, 'state'),
+        'VARIANT_FOLDER': os.path.join(work_dir, 'variants'),
+        'JANITOR_ENABLED': 'false',
+    }
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    child = json.loads(result.stdout.strip().splitlines()[-1])
+    child['importtime'] = parse_importtime(result.stderr)
+    return child
+
+
+def bench(preload, repeat, top):
+    runs = []
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix='startup-bench-')
+        runs.append(run_once(preload, work_dir))
+
+    # slowest modules (cumulative) of the median run by `import app` time
+    median_run = sorted(runs, key=lambda run: run['importtime']['app'][1])[len(runs) // 2]
+    slowest = sorted(median_run['importtime'].items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        'import_app': summarize([run['importtime']['app'][1] / 1e6 for run in runs]),
+        'import_wall': summarize([run['import_s'] for run in runs]),
+        'first_request': summarize([run['first_request_s'] for run in runs]),
+        'modules_loaded': median_run['modules'],
+        'slowest_modules': [
+            {'module': name, 'self_ms': round(self_us / 1000, 1), 'cumulative_ms': round(cumulative_us / 1000, 1)}
+            for name, (self_us, cumulative_us) in slowest[1:top + 1]  # [0] is app itself
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to report')
+    parser.add_argument('--preload', action='store_true', help='also measure with APP_PRELOAD=true')
+    parser.add_argument('--output', help='JSON path (default bench/results/startup-<rev>.json)')
+    args = parser.parse_args()
+
+    results = {'default': bench(False, args.repeat, args.top)}
+    if args.preload:
+        results['preload'] = bench(True, args.repeat, args.top)
+
+    rows = []
+    for mode, result in results.items():
+        for metric in ('import_app', 'import_wall', 'first_request'):
+            rows.append({'mode': mode, 'metric': metric,
+                         **{key: result[metric][key] for key in ('p50_ms', 'p95_ms', 'max_ms')}})
+    print_table(rows, ['mode', 'metric', 'p50_ms', 'p95_ms', 'max_ms'])
+    for mode, result in results.items():
+        loaded = [name for name, present in result['modules_loaded'].items() if present]
+        print(f"\n{mode}: heavy modules loaded after the first request: {', '.join(loaded) or 'none'}")
+        print_table(result['slowest_modules'], ['module', 'self_ms', 'cumulative_ms'])
+
+    output = write_results('startup', results, args.output, params=vars(args))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
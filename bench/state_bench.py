@@ -0,0 +1,134 @@
+"""
+Multi-process benchmark of the shared state (services/shared_state.py).
+
+Starts --processes worker processes that hammer the same keys at once, one operation
+type at a time, and reports aggregate ops/s and per-op latency. Also checks the results:
+every counter increment is counted, and a lease is never held by two workers at once.
+Uses a fresh SQLite database in a temp folder unless --redis is given.
+
+    python -m bench.state_bench --processes 8 --ops 2000
+    python -m bench.state_bench --redis redis://127.0.0.1:6379/15
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from bench.common import print_table, summarize, write_results
+from services.shared_state import RedisState, SQLiteState
+
+OPERATIONS = ('get', 'set', 'incr', 'lease', 'take_tokens')
+
+
+def state_spec(args, work_dir):
+    """Picklable description of the state; each process opens its own."""
+    if args.redis:
+        return ('redis', args.redis, f"state-bench:{uuid.uuid4().hex[:8]}:")
+    return ('sqlite', os.path.join(work_dir, 'shared_state.sqlite3'))
+
+
+def open_state(spec):
+    if spec[0] == 'redis':
+        return RedisState(spec[1], prefix=spec[2])
+    return SQLiteState(spec[1])
+
+
+def run_op(state, op, i, owner):
+    if op == 'get':
+        state.get(f"key:{i % 100}")
+    elif op == 'set':
+        state.set(f"key:{i % 100}", 'x' * 64, ttl=60)
+    elif op == 'incr':
+        state.incr('counter')
+    elif op == 'lease':
+        # acquire + release; holders counts workers inside the lease, which must never exceed 1
+        if state.acquire_lease('lease', owner, ttl=30):
+            if state.incr('holders') > 1:
+                state.incr('lease_violations')
+            state.incr('holders', -1)
+            state.release_lease('lease', owner)
+            state.incr('lease_grants')
+    elif op == 'take_tokens':
+        state.take_tokens('bucket', rate=1000, burst=100)
+
+
+def worker(spec, op, ops, barrier, results):
+    state = open_state(spec)
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    run_op(state, 'get', 0, owner)  # open the connection outside the timed loop
+    barrier.wait()
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for i in range(ops):
+        op_started = time.perf_counter()
+        try:
+            run_op(state, op, i, owner)
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - op_started)
+    results.put((latencies, errors, started, time.perf_counter()))
+
+
+def bench_op(spec, op, processes, ops):
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(spec, op, ops, barrier, results)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    outcomes = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+
+    latencies = [latency for outcome in outcomes for latency in outcome[0]]
+    errors = sum(outcome[1] for outcome in outcomes)
+    elapsed = max(outcome[3] for outcome in outcomes) - min(outcome[2] for outcome in outcomes)
+    summary = summarize(latencies, elapsed, errors, extra={'processes': processes})
+    summary['ops_per_s'] = summary.pop('throughput_rps')
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=2000, help='operations per process and operation type')
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help=f"subset of {','.join(OPERATIONS)}")
+    parser.add_argument('--redis', help='benchmark a Redis-compatible server instead of SQLite')
+    parser.add_argument('--output', help='JSON path (default bench/results/state-<rev>.json)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='state-bench-')
+    try:
+        spec = state_spec(args, work_dir)
+        results, rows = {}, []
+        for op in (name.strip() for name in args.operations.split(',') if name.strip()):
+            results[op] = bench_op(spec, op, args.processes, args.ops)
+            rows.append({'operation': op, **results[op]})
+
+        state = open_state(spec)
+        checks = {}
+        if 'incr' in results:
+            checks['counter'] = int(state.get('counter') or 0)
+            checks['counter_expected'] = args.processes * args.ops
+        if 'lease' in results:
+            checks['lease_grants'] = int(state.get('lease_grants') or 0)
+            checks['lease_violations'] = int(state.get('lease_violations') or 0)
+        results['checks'] = checks
+        results['backend'] = state.stats()['backend']
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{results['backend']} backend, {args.processes} processes")
+    print_table(rows, ['operation', 'count', 'errors', 'ops_per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+    print(f"\nchecks: {checks}")
+    output = write_results('state', results, args.output, params=vars(args))
+    print(f"Results written to {output}")
+    if checks.get('counter', 0) != checks.get('counter_expected', 0) or checks.get('lease_violations'):
+        raise SystemExit('Shared state check failed')
+
+
+if __name__ == '__main__':
+    main()
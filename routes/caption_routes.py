@@ -1,43 +1,67 @@
-from flask import Blueprint, request, jsonify
-from services.gemini_service import GeminiService
-from PIL import Image
-import os
+from flask import Blueprint, request, jsonify, current_app
+from services.gemini_service import get_gemini_service
+from services.call_policy import CallTimeoutError
+from services.rate_limiter import UpstreamBusyError
+from routes.errors import busy_response
+from utils.file_utils import resolve_image_path
+import io
 import logging
 
 caption_bp = Blueprint('captions', __name__)
 
+def _read_validated_image(image_path):
+    """Read image bytes once and verify them; returns (bytes, error response)."""
+    from PIL import Image
+
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            img.verify()
+    except Exception as img_err:
+        logging.error(f"Invalid image {image_path}: {str(img_err)}")
+        return None, (jsonify({'error': f'Invalid image: {str(img_err)}'}), 400)
+    return image_data, None
+
 @caption_bp.route('/generate', methods=['POST'])
 def generate_caption():
     """Generate caption for image"""
     try:
         data = request.get_json()
-        image_path = data.get('image_path')
+        image_path = data.get('image_path') or data.get('image_id')
         platform = data.get('platform', 'general')
         tone = data.get('tone', 'engaging')
-        
+
         if not image_path:
             return jsonify({'error': 'Image path is required'}), 400
-        
-        if not os.path.exists(image_path):
+
+        image_path = resolve_image_path(image_path, current_app.config['UPLOAD_FOLDER'])
+        if not current_app.extensions['storage'].available(image_path):
             return jsonify({'error': 'Image file not found'}), 404
-        
-        # Validate image
-        try:
-            with Image.open(image_path) as img:
-                img.verify()
-        except Exception as img_err:
-            logging.error(f"Invalid image {image_path}: {str(img_err)}")
-            return jsonify({'error': f'Invalid image: {str(img_err)}'}), 400
-        
-        gemini_service = GeminiService()
-        caption = gemini_service.generate_caption(image_path, platform, tone)
-        
-        return jsonify({
+
+        # Validate image (bytes are reused for the model call)
+        image_data, error = _read_validated_image(image_path)
+        if error:
+            return error
+
+        gemini_service = get_gemini_service(current_app)
+        result = gemini_service.generate_caption_result(image_path, platform, tone, image_data=image_data)
+
+        payload = {
             'success': True,
-            'caption': caption,
+            'caption': result['caption'],
+            'cached': result['cached'],
+            'coalesced': result.get('coalesced', False),
             'message': 'Caption generated successfully'
-        })
-        
+        }
+        if result.get('near_duplicate_of'):
+            payload['near_duplicate_of'] = result['near_duplicate_of']
+        return jsonify(payload)
+
+    except UpstreamBusyError as e:
+        return busy_response(e)
+    except CallTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logging.error(f"Error generating caption for {image_path}: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
@@ -47,39 +71,44 @@ def regenerate_caption():
     """Regenerate caption with different parameters"""
     try:
         data = request.get_json()
-        image_path = data.get('image_path')
+        image_path = data.get('image_path') or data.get('image_id')
         platform = data.get('platform', 'general')
         tone = data.get('tone', 'engaging')
         custom_prompt = data.get('custom_prompt', '')
-        
+        bypass_cache = bool(data.get('bypass_cache', False))
+
         if not image_path:
             return jsonify({'error': 'Image path is required'}), 400
-        
-        if not os.path.exists(image_path):
+
+        image_path = resolve_image_path(image_path, current_app.config['UPLOAD_FOLDER'])
+        if not current_app.extensions['storage'].available(image_path):
             return jsonify({'error': 'Image file not found'}), 404
-        
-        # Validate image
-        try:
-            with Image.open(image_path) as img:
-                img.verify()
-        except Exception as img_err:
-            logging.error(f"Invalid image {image_path}: {str(img_err)}")
-            return jsonify({'error': f'Invalid image: {str(img_err)}'}), 400
-        
-        gemini_service = GeminiService()
-        
+
+        # Validate image (bytes are reused for the model call)
+        image_data, error = _read_validated_image(image_path)
+        if error:
+            return error
+
+        gemini_service = get_gemini_service(current_app)
+
         # Use custom prompt if provided
-        if custom_prompt:
-            caption = gemini_service.generate_caption(image_path, platform, custom_prompt)
-        else:
-            caption = gemini_service.generate_caption(image_path, platform, tone)
-        
+        result = gemini_service.generate_caption_result(
+            image_path, platform, custom_prompt or tone,
+            image_data=image_data, use_cache=not bypass_cache
+        )
+
         return jsonify({
             'success': True,
-            'caption': caption,
+            'caption': result['caption'],
+            'cached': result['cached'],
+            'coalesced': result.get('coalesced', False),
             'message': 'Caption regenerated successfully'
         })
-        
+
+    except UpstreamBusyError as e:
+        return busy_response(e)
+    except CallTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         logging.error(f"Error regenerating caption for {image_path}: {str(e)}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,8 @@
+from flask import jsonify
+
+
+def busy_response(error):
+    """503 with Retry-After for an UpstreamBusyError: the model is saturated or rate limited upstream."""
+    response = jsonify(error.payload())
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
@@ -1,7 +1,20 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory, url_for
-from services.gemini_service import GeminiService
-from services.image_service import ImageService
+from flask import (Blueprint, Response, request, jsonify, current_app, redirect, send_file,
+                   send_from_directory, stream_with_context, url_for)
+from services.encoder import ENCODINGS
+from services.gemini_service import get_gemini_service
+from services.image_service import PLATFORM_SIZES, ImageService, InvalidImageError
+from services.job_service import InvalidCallbackError, QueueFullError, get_job_queue
+from services.call_policy import CallTimeoutError
+from services.rate_limiter import UpstreamBusyError
+from routes.errors import busy_response
+from utils.file_utils import content_relpath, file_etag, is_content_id, resolve_image_path
+from utils.upload_stream import MultipartFileStream
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import mimetypes
 import os
+import time
 
 image_bp = Blueprint('images', __name__)
 
@@ -15,6 +28,58 @@ def _download_url(folder: str, filename: str) -> str:
     """Return a stable, relative download URL the frontend can prepend with base."""
     return url_for('images.download_image_v2', folder=folder, filename=filename, _external=False)
 
+def _images_payload(image_paths, text=''):
+    """Public paths and download URLs for every image of a generate/edit result."""
+    public_paths = [_public_path(path) for path in image_paths]
+    download_urls = [_download_url('generated', os.path.basename(path)) for path in image_paths]
+    return {
+        'image_path': public_paths[0],
+        'download_url': download_urls[0],
+        'image_paths': public_paths,
+        'download_urls': download_urls,
+        'text': text,
+    }
+
+class _InvalidField(ValueError):
+    """A request field with the wrong type or value; the message names the field."""
+
+def _int_field(data, name, default=None, minimum=1, maximum=None):
+    """data[name] as an int within [minimum, maximum], or default when it is missing."""
+    value = data.get(name)
+    if value is None:
+        return default
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError
+        value = int(value)
+    except ValueError:
+        raise _InvalidField(f'{name} must be an integer')
+    if value < minimum or (maximum is not None and value > maximum):
+        bounds = f'between {minimum} and {maximum}' if maximum is not None else f'at least {minimum}'
+        raise _InvalidField(f'{name} must be {bounds}')
+    return value
+
+def _max_images(data):
+    """Optional positive max_images of a generate/edit body; raises _InvalidField otherwise."""
+    return _int_field(data, 'max_images')
+
+def _image_service() -> ImageService:
+    return ImageService(
+        current_app.config['UPLOAD_FOLDER'],
+        current_app.config['GENERATED_FOLDER'],
+        max_generated_bytes=current_app.config['GENERATED_MAX_BYTES'],
+        file_index=current_app.extensions['file_index'],
+        storage=current_app.extensions['storage'],
+        max_upload_side=current_app.config['UPLOAD_MAX_SIDE'],
+        max_upload_pixels=current_app.config['UPLOAD_MAX_PIXELS'],
+        encoder=current_app.extensions['image_encoder'],
+        similarity=current_app.extensions['similarity'],
+    )
+
+def _in_flight():
+    """Files held here are skipped by the storage janitor while a request uses them."""
+    return current_app.extensions['in_flight']
+
 def _safe_norm(filename: str) -> str:
     safe = os.path.normpath(filename)
     # block absolute or traversal
@@ -22,6 +87,45 @@ def _safe_norm(filename: str) -> str:
         raise ValueError("Invalid filename")
     return safe
 
+def _submit_job(kind, params, callback_url):
+    """Queue a job and return the 202 response pointing at its status URL."""
+    try:
+        job_id = get_job_queue(current_app).submit(kind, params, callback_url)
+    except InvalidCallbackError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('images.get_job', job_id=job_id, _external=False),
+        'message': 'Job accepted'
+    }), 202
+
+# ---------- Background jobs ----------
+
+def run_generate_job(params):
+    """Job handler for asynchronous /generate."""
+    gemini_service = get_gemini_service(current_app)
+    result = gemini_service.generate_image(params['prompt'], params['style'], use_cache=params['use_cache'],
+                                           max_images=params.get('max_images'))
+    if not result['image_path']:
+        raise RuntimeError('Failed to generate image')
+    return {'image_paths': [_public_path(p) for p in result['image_paths']],
+            'text': result['text'], 'cached': result['cached'], 'coalesced': result.get('coalesced', False)}
+
+def run_edit_job(params):
+    """Job handler for asynchronous /edit."""
+    gemini_service = get_gemini_service(current_app)
+    result = gemini_service.edit_image_result(params['image_path'], params['edit_prompt'],
+                                              max_images=params.get('max_images'),
+                                              use_cache=params.get('use_cache', True))
+    if not result['image_path']:
+        raise RuntimeError('Failed to edit image')
+    return {'image_paths': [_public_path(p) for p in result['image_paths']],
+            'text': result['text'], 'cached': result['cached'], 'coalesced': result.get('coalesced', False)}
+
 # ---------- Routes ----------
 
 @image_bp.route('/generate', methods=['POST'])
@@ -31,60 +135,219 @@ def generate_image():
         data = request.get_json() or {}
         prompt = data.get('prompt')
         style = data.get('style', 'realistic')
+        use_cache = data.get('use_cache', True)
+        max_images = _max_images(data)
 
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
 
-        gemini_service = GeminiService()
-        image_path = gemini_service.generate_image_from_text(prompt, style)
+        if data.get('async'):
+            params = {'prompt': prompt, 'style': style, 'use_cache': use_cache, 'max_images': max_images}
+            return _submit_job('generate', params, data.get('callback_url'))
 
-        if not image_path:
-            return jsonify({'error': 'Failed to generate image'}), 500
+        gemini_service = get_gemini_service(current_app)
+        result = gemini_service.generate_image(prompt, style, use_cache=use_cache, max_images=max_images)
 
-        public_path = _public_path(image_path)
-        public_name = os.path.basename(image_path)
-        download_url = _download_url('generated', public_name)
+        if not result['image_path']:
+            return jsonify({'error': 'Failed to generate image'}), 500
 
         return jsonify({
             'success': True,
-            'image_path': public_path,
-            'download_url': download_url,
+            **_images_payload(result['image_paths'], result['text']),
+            'cached': result['cached'],
+            'coalesced': result.get('coalesced', False),
             'message': 'Image generated successfully'
         })
+    except _InvalidField as e:
+        return jsonify({'error': str(e)}), 400
+    except UpstreamBusyError as e:
+        return busy_response(e)
+    except CallTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@image_bp.route('/upload', methods=['POST'])
-def upload_image():
-    """Upload and save image."""
+@image_bp.route('/generate/stream', methods=['POST'])
+def generate_image_stream():
+    """Generate image from text prompt, reporting progress as Server-Sent Events."""
+    data = request.get_json() or {}
+    prompt = data.get('prompt')
+    style = data.get('style', 'realistic')
+    use_cache = data.get('use_cache', True)
     try:
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
+        max_images = _max_images(data)
+    except _InvalidField as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not prompt:
+        return jsonify({'error': 'Prompt is required'}), 400
+
+    gemini_service = get_gemini_service(current_app)
+
+    def events():
+        try:
+            for event in gemini_service.generate_image_stream(prompt, style, use_cache, max_images):
+                name = event.pop('event')
+                if name == 'done':
+                    if not event['image_paths']:
+                        name, event = 'error', {'error': 'Failed to generate image'}
+                    else:
+                        event.update(_images_payload(event['image_paths'], event['text']))
+                elif name == 'image':
+                    event['download_url'] = _download_url('generated', os.path.basename(event['image_path']))
+                    event['image_path'] = _public_path(event['image_path'])
+                yield f"event: {name}\ndata: {json.dumps(event)}\n\n"
+        except UpstreamBusyError as e:
+            yield f"event: error\ndata: {json.dumps(e.payload())}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@image_bp.route('/generate/batch', methods=['POST'])
+def generate_image_batch():
+    """
+    Generate many images concurrently, streaming one NDJSON line per finished item.
+    Body: {"items": [{"prompt": ..., "style": ...}, ...]}
+       or {"prompt": ..., "style": ..., "variants": N}; optional "concurrency".
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Body must be a JSON object'}), 400
+    max_items = current_app.config['BATCH_MAX_ITEMS']
 
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+    try:
+        if data.get('items') is not None:
+            items = data['items']
+            if not isinstance(items, list):
+                raise _InvalidField('items must be a list')
+            for index, item in enumerate(items):
+                if not isinstance(item, dict):
+                    raise _InvalidField(f'items[{index}] must be an object')
+            items = [
+                {'prompt': item.get('prompt'), 'style': item.get('style', 'realistic'),
+                 'use_cache': data.get('use_cache', True)}
+                for item in items
+            ]
+        else:
+            variants = _int_field(data, 'variants', 1, maximum=max_items)
+            # distinct variants are wanted, so they never come from the generation cache
+            items = [{'prompt': data.get('prompt'), 'style': data.get('style', 'realistic'),
+                      'use_cache': variants == 1 and data.get('use_cache', True)}] * variants
+        concurrency = min(_int_field(data, 'concurrency', current_app.config['BATCH_CONCURRENCY']),
+                          current_app.config['BATCH_MAX_CONCURRENCY'])
+    except _InvalidField as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not items or any(not item['prompt'] or not isinstance(item['prompt'], str) for item in items):
+        return jsonify({'error': 'Every item needs a prompt'}), 400
+    if any(not isinstance(item['style'], str) for item in items):
+        return jsonify({'error': 'style must be a string'}), 400
+    if len(items) > max_items:
+        return jsonify({'error': f'At most {max_items} items per batch'}), 400
+    app = current_app._get_current_object()
+    gemini_service = get_gemini_service(app)
+
+    def run_item(item):
+        with app.app_context():
+            return gemini_service.generate_image(item['prompt'], item['style'], use_cache=item['use_cache'])
+
+    def generate():
+        started = time.perf_counter()
+        succeeded = failed = 0
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+        try:
+            futures = {executor.submit(run_item, item): index for index, item in enumerate(items)}
+            for future in as_completed(futures):
+                index = futures[future]
+                line = {'index': index, 'prompt': items[index]['prompt']}
+                try:
+                    result = future.result()
+                    if not result['image_path']:
+                        raise RuntimeError('Failed to generate image')
+                    line.update({
+                        'success': True,
+                        **_images_payload(result['image_paths'], result['text']),
+                        'cached': result['cached'],
+                        'coalesced': result.get('coalesced', False),
+                    })
+                    succeeded += 1
+                except UpstreamBusyError as e:
+                    line.update({'success': False, **e.payload()})
+                    failed += 1
+                except Exception as e:
+                    line.update({'success': False, 'error': str(e)})
+                    failed += 1
+                yield json.dumps(line) + '\n'
+
+            yield json.dumps({
+                'done': True,
+                'total': len(items),
+                'succeeded': succeeded,
+                'failed': failed,
+                'concurrency': concurrency,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+            }) + '\n'
+        finally:
+            # client disconnects close the generator; don't keep paying for queued items
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def _reject_upload(message, status):
+    # the rest of the body is never read; ask the server to drop the connection instead
+    response = jsonify({'error': message})
+    response.headers['Connection'] = 'close'
+    return response, status
 
-        image_service = ImageService(
-            current_app.config['UPLOAD_FOLDER'],
-            current_app.config['GENERATED_FOLDER']
-        )
 
-        file_path = image_service.save_uploaded_image(file)
-        if not file_path:
-            return jsonify({'error': 'Failed to upload image'}), 500
+@image_bp.route('/upload', methods=['POST'])
+def upload_image():
+    """
+    Upload and save image.
+    The multipart body is decoded straight from the request stream, so a bad or oversized
+    image is rejected from its first few KB and memory use doesn't grow with the file.
+    """
+    try:
+        max_length = current_app.config['MAX_CONTENT_LENGTH']
+        if max_length and request.content_length and request.content_length > max_length:
+            return _reject_upload(f'Upload exceeds {max_length} bytes', 413)
+
+        try:
+            upload = MultipartFileStream.from_request(request, 'image')
+        except BadRequest as e:
+            return _reject_upload(e.description, 400)
+        if not upload.found:
+            return _reject_upload('No image file provided', 400)
+        if upload.filename == '':
+            return _reject_upload('No file selected', 400)
+
+        image_service = _image_service()
+
+        try:
+            file_path = image_service.save_upload_stream(upload)
+        except (InvalidImageError, BadRequest) as e:
+            return _reject_upload(getattr(e, 'description', None) or str(e), 400)
 
         public_path = _public_path(file_path)
-        public_name = os.path.basename(file_path)
-        download_url = _download_url('uploads', public_name)
+        image_id = os.path.basename(file_path)
+        download_url = _download_url('uploads', image_id)
 
         return jsonify({
             'success': True,
+            'image_id': image_id,
             'image_path': public_path,
             'download_url': download_url,
             'message': 'Image uploaded successfully'
         })
+    except RequestEntityTooLarge as e:
+        return _reject_upload(e.description, 413)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -94,33 +357,48 @@ def edit_image():
     """Edit existing image."""
     try:
         data = request.get_json() or {}
-        image_path = data.get('image_path')
+        image_path = data.get('image_path') or data.get('image_id')
         edit_prompt = data.get('edit_prompt')
 
         if not image_path or not edit_prompt:
             return jsonify({'error': 'Image path and edit prompt are required'}), 400
+        max_images = _max_images(data)
 
-        # support forward/back slashes in incoming path
-        normalized = image_path.replace('/', os.sep).replace('\\', os.sep)
-        if not os.path.exists(normalized):
+        # accepts a content id or a path with forward/back slashes
+        normalized = resolve_image_path(image_path, current_app.config['UPLOAD_FOLDER'])
+        if not current_app.extensions['storage'].available(normalized):
             return jsonify({'error': 'Image file not found'}), 404
 
-        gemini_service = GeminiService()
-        edited_image_path = gemini_service.edit_image(normalized, edit_prompt)
+        use_cache = data.get('use_cache', True)
+        if data.get('async'):
+            params = {'image_path': normalized, 'edit_prompt': edit_prompt, 'max_images': max_images,
+                      'use_cache': use_cache}
+            return _submit_job('edit', params, data.get('callback_url'))
 
-        if not edited_image_path:
-            return jsonify({'error': 'Failed to edit image'}), 500
+        gemini_service = get_gemini_service(current_app)
+        with _in_flight().hold(normalized):
+            result = gemini_service.edit_image_result(normalized, edit_prompt, max_images=max_images,
+                                                      use_cache=use_cache)
 
-        public_path = _public_path(edited_image_path)
-        public_name = os.path.basename(edited_image_path)
-        download_url = _download_url('generated', public_name)
+        if not result['image_path']:
+            return jsonify({'error': 'Failed to edit image'}), 500
 
-        return jsonify({
+        payload = {
             'success': True,
-            'image_path': public_path,
-            'download_url': download_url,
+            **_images_payload(result['image_paths'], result['text']),
+            'cached': result['cached'],
+            'coalesced': result.get('coalesced', False),
             'message': 'Image edited successfully'
-        })
+        }
+        if result.get('near_duplicate_of'):
+            payload['near_duplicate_of'] = result['near_duplicate_of']
+        return jsonify(payload)
+    except _InvalidField as e:
+        return jsonify({'error': str(e)}), 400
+    except UpstreamBusyError as e:
+        return busy_response(e)
+    except CallTimeoutError as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -130,22 +408,20 @@ def resize_image():
     """Resize image for a social media platform."""
     try:
         data = request.get_json() or {}
-        image_path = data.get('image_path')
+        image_path = data.get('image_path') or data.get('image_id')
         platform = data.get('platform', 'instagram')
 
         if not image_path:
             return jsonify({'error': 'Image path is required'}), 400
 
-        normalized = image_path.replace('/', os.sep).replace('\\', os.sep)
-        if not os.path.exists(normalized):
+        normalized = resolve_image_path(image_path, current_app.config['UPLOAD_FOLDER'])
+        if not current_app.extensions['storage'].available(normalized):
             return jsonify({'error': 'Image file not found'}), 404
 
-        image_service = ImageService(
-            current_app.config['UPLOAD_FOLDER'],
-            current_app.config['GENERATED_FOLDER']
-        )
+        image_service = _image_service()
 
-        resized_image_path = image_service.resize_for_social_media(normalized, platform)
+        with _in_flight().hold(normalized):
+            resized_image_path = image_service.resize_for_social_media(normalized, platform)
 
         public_path = _public_path(resized_image_path)
         public_name = os.path.basename(resized_image_path)
@@ -161,8 +437,271 @@ def resize_image():
         return jsonify({'error': str(e)}), 500
 
 
+@image_bp.route('/resize/multi', methods=['POST'])
+def resize_image_multi():
+    """Resize image for several platforms from a single decode."""
+    try:
+        data = request.get_json() or {}
+        image_path = data.get('image_path') or data.get('image_id')
+        platforms = data.get('platforms') or list(PLATFORM_SIZES)
+
+        if not image_path:
+            return jsonify({'error': 'Image path is required'}), 400
+        if not isinstance(platforms, list) or not all(isinstance(p, str) for p in platforms):
+            return jsonify({'error': 'platforms must be a list of platform names'}), 400
+        platforms = list(dict.fromkeys(platforms))
+
+        unknown = [p for p in platforms if p not in PLATFORM_SIZES]
+        if unknown:
+            return jsonify({'error': f"Unknown platform(s): {', '.join(map(str, unknown))}"}), 400
+
+        normalized = resolve_image_path(image_path, current_app.config['UPLOAD_FOLDER'])
+        if not current_app.extensions['storage'].available(normalized):
+            return jsonify({'error': 'Image file not found'}), 404
+
+        image_service = _image_service()
+
+        with _in_flight().hold(normalized):
+            resized = image_service.resize_for_platforms(normalized, platforms)
+
+        renditions = {
+            platform: {
+                'image_path': _public_path(path),
+                'download_url': _download_url('generated', os.path.basename(path)),
+            }
+            for platform, path in resized.items()
+        }
+
+        return jsonify({
+            'success': True,
+            'renditions': renditions,
+            'message': f"Image resized for {', '.join(platforms)}"
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@image_bp.route('/storage/janitor', methods=['GET'])
+def janitor_stats():
+    """Bytes reclaimed and scan time of the storage janitor."""
+    janitor = current_app.extensions.get('janitor')
+    if janitor is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **janitor.stats()})
+
+
+@image_bp.route('/list', methods=['GET'])
+def list_images():
+    """Paginated listing of stored images from the file index (newest first)."""
+    folder = request.args.get('folder')
+    if folder not in (None, 'uploads', 'generated'):
+        return jsonify({'error': 'Invalid folder'}), 400
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', 50, type=int)), 500)
+
+    _file_index().maybe_refresh()  # picks up files written outside the services
+    total, entries = _file_index().list(folder, offset=(page - 1) * per_page, limit=per_page)
+    items = [{
+        'id': entry['id'],
+        'folder': entry['folder'],
+        'size': entry['size'],
+        'mtime': entry['mtime'],
+        'mime': entry['mime'],
+        'width': entry['width'],
+        'height': entry['height'],
+        'download_url': _download_url(entry['folder'], _public_path(entry['relpath'])),
+    } for entry in entries]
+
+    return jsonify({
+        'success': True,
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+    })
+
+
+@image_bp.route('/similar', methods=['GET'])
+def similar_images():
+    """
+    Stored images that look like a given one: ?image_id=<id or path> or ?hash=<16 hex digits>,
+    optional max_distance (dHash bits, 0-11, default 8) and limit. Nearest first.
+    """
+    index = current_app.extensions['similarity']
+    if index is None:
+        return jsonify({'error': 'Similarity index is disabled'}), 404
+    try:
+        max_distance = request.args.get('max_distance', 8, type=int)
+        limit = min(max(1, request.args.get('limit', 20, type=int)), 200)
+        if not 0 <= max_distance < 12:
+            return jsonify({'error': 'max_distance must be between 0 and 11'}), 400
+
+        image_ref, exclude = request.args.get('image_id') or request.args.get('image_path'), None
+        if request.args.get('hash'):
+            try:
+                value = int(request.args['hash'], 16)
+            except ValueError:
+                return jsonify({'error': 'hash must be 16 hex digits'}), 400
+        elif image_ref:
+            normalized = resolve_image_path(image_ref, current_app.config['UPLOAD_FOLDER'])
+            exclude = os.path.basename(normalized)
+            entry = index.get(exclude)
+            if entry is None:
+                if not current_app.extensions['storage'].available(normalized):
+                    return jsonify({'error': 'Image file not found'}), 404
+                value = index.hash_file(exclude, normalized, file_etag(normalized))
+                if value is None:
+                    return jsonify({'error': 'Image could not be decoded'}), 400
+            else:
+                value = entry[0]
+        else:
+            return jsonify({'error': 'image_id or hash is required'}), 400
+
+        started = time.perf_counter()
+        matches = index.query(value, max_distance, limit, exclude=exclude)
+        query_ms = (time.perf_counter() - started) * 1000
+
+        items = []
+        for distance, file_id, _ in matches:
+            entry = _file_index().get(file_id)
+            if entry is None:
+                index.remove(file_id)  # deleted since it was hashed
+                continue
+            items.append({
+                'id': file_id,
+                'folder': entry['folder'],
+                'distance': distance,
+                'width': entry['width'],
+                'height': entry['height'],
+                'download_url': _download_url(entry['folder'], _public_path(entry['relpath'])),
+            })
+
+        return jsonify({
+            'success': True,
+            'hash': f"{value:016x}",
+            'matches': items,
+            'query_ms': round(query_ms, 3),
+            'indexed': len(index),
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@image_bp.route('/similar/stats', methods=['GET'])
+def similarity_stats():
+    """Size and query count of the perceptual-hash index."""
+    index = current_app.extensions['similarity']
+    if index is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **index.stats()})
+
+
+@image_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, timing and (when finished) result of an asynchronous job."""
+    job = get_job_queue(current_app).get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if job['result'] and job['result'].get('image_paths'):
+        job['result'].update(_images_payload(job['result']['image_paths'], job['result'].get('text', '')))
+    return jsonify(job)
+
+
+@image_bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters for the generation cache."""
+    cache = current_app.extensions.get('generation_cache')
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **cache.stats()})
+
+
+@image_bp.route('/encoder/stats', methods=['GET'])
+def encoder_stats():
+    """Output formats in use and how many negotiated variants were encoded and served."""
+    return jsonify(current_app.extensions['image_encoder'].stats())
+
+
+@image_bp.route('/state/stats', methods=['GET'])
+def shared_state_stats():
+    """Backend, live key count and this worker's operation counts of the state shared by workers."""
+    state = current_app.extensions.get('shared_state')
+    if state is None:
+        return jsonify({'enabled': False})
+    try:
+        return jsonify({'enabled': True, 'pid': os.getpid(), **state.stats()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@image_bp.route('/pool/stats', methods=['GET'])
+def pool_stats():
+    """Connection pool and call statistics of this worker's shared GeminiService."""
+    service = get_gemini_service(current_app)
+    stats = service.pool_stats()
+    if service.preprocessor is not None:
+        stats['model_inputs'] = service.preprocessor.stats()
+    if service.rate_limiter is not None:
+        stats['limiter'] = service.rate_limiter.stats()
+    stats['calls_by_kind'] = service.call_policy.stats()
+    if service.single_flight is not None:
+        stats['single_flight'] = service.single_flight.stats()
+    return jsonify(stats)
+
+
 # ----- Download Endpoints -----
 
+# Stored files never change under a given name (uuid or content-addressed), so
+# clients and CDNs may keep them for a year without revalidating.
+IMMUTABLE_MAX_AGE = 31536000
+
+def _file_index():
+    return current_app.extensions['file_index']
+
+def _send_immutable(base_dir, safe_name, stat):
+    """
+    send_from_directory with a strong ETag, conditional/Range handling and immutable caching.
+    Clients whose Accept header lists a smaller format (AVIF/WebP) get that variant instead;
+    the response then varies on Accept and carries the variant's own ETag.
+    """
+    abs_path = os.path.join(base_dir, safe_name)
+    entry = _file_index().lookup_path(abs_path)
+    etag = entry and entry.get('etag')
+    if entry:
+        _file_index().touch(os.path.basename(abs_path))
+    if not etag:
+        etag = file_etag(abs_path, stat)
+        if entry:
+            _file_index().set_etag(os.path.basename(abs_path), etag)
+
+    encoder = current_app.extensions['image_encoder']
+    source_mime = (entry and entry.get('mime')) or mimetypes.guess_type(safe_name)[0]
+    variant_format = encoder.negotiate(request.headers.get('Accept'), source_mime)
+    variant_path = encoder.variant(abs_path, variant_format, etag) if variant_format else None
+
+    if variant_path:
+        response = send_file(
+            variant_path,
+            mimetype=ENCODINGS[variant_format][1],
+            etag=f"{etag[:40]}-{variant_format}-{encoder.variant_tag(variant_format)}",
+            max_age=IMMUTABLE_MAX_AGE,
+            conditional=True,
+            download_name=f"{os.path.splitext(os.path.basename(safe_name))[0]}{ENCODINGS[variant_format][2]}",
+        )
+    else:
+        response = send_from_directory(
+            base_dir, safe_name,
+            etag=etag,
+            max_age=IMMUTABLE_MAX_AGE,
+            conditional=True,
+        )
+    if encoder.negotiable(source_mime):
+        response.vary.add('Accept')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @image_bp.route('/download/<folder>/<path:filename>')
 def download_image_v2(folder, filename):
     """Stable download endpoint: /api/images/download/<uploads|generated>/<filename>"""
@@ -171,15 +710,27 @@ def download_image_v2(folder, filename):
             return jsonify({'error': 'Invalid folder'}), 400
 
         safe_name = _safe_norm(filename)
+        if folder == 'uploads' and is_content_id(safe_name):
+            safe_name = content_relpath(safe_name)
         base_dir = (current_app.config['UPLOAD_FOLDER']
                     if folder == 'uploads'
                     else current_app.config['GENERATED_FOLDER'])
 
+        # Object storage can hand out presigned URLs so the bytes bypass this worker
+        presigned_url = current_app.extensions['storage'].download_url(folder, safe_name)
+        if presigned_url:
+            _file_index().touch(os.path.basename(safe_name))  # still a read, for LRU eviction of the local copy
+            return redirect(presigned_url, code=302)
+
         abs_path = os.path.join(base_dir, safe_name)
-        if not os.path.exists(abs_path):
+        if not current_app.extensions['storage'].ensure_local(abs_path):
+            return jsonify({'error': 'File not found'}), 404
+        try:
+            stat = os.stat(abs_path)
+        except (FileNotFoundError, NotADirectoryError):
             return jsonify({'error': 'File not found'}), 404
 
-        return send_from_directory(base_dir, safe_name)
+        return _send_immutable(base_dir, safe_name, stat)
     except ValueError:
         return jsonify({'error': 'Invalid filename'}), 400
     except Exception as e:
@@ -191,7 +742,7 @@ def download_image_legacy(filename):
     """
     Legacy compatibility:
     Accepts 'generated\\file.jpg', 'generated/file.jpg', or just 'file.jpg'.
-    Redirects internally to v2 when possible, else searches by basename.
+    Redirects internally to v2 when possible, else looks the basename up in the file index.
     """
     normalized = filename.replace('\\', '/')
     parts = normalized.split('/')
@@ -200,11 +751,14 @@ def download_image_legacy(filename):
     if len(parts) == 2 and parts[0] in ('uploads', 'generated'):
         return download_image_v2(parts[0], parts[1])
 
-    just_name = os.path.basename(filename)
-    for folder, base in (('uploads', current_app.config['UPLOAD_FOLDER']),
-                         ('generated', current_app.config['GENERATED_FOLDER'])):
-        candidate = os.path.join(base, just_name)
-        if os.path.exists(candidate):
-            return send_from_directory(base, just_name)
-
-    return jsonify({'error': 'File not found'}), 404
+    just_name = parts[-1]
+    if is_content_id(just_name):
+        return download_image_v2('uploads', just_name)
+
+    entry = _file_index().get(just_name)
+    if entry is None:
+        _file_index().maybe_refresh()
+        entry = _file_index().get(just_name)
+    if entry is None:
+        return jsonify({'error': 'File not found'}), 404
+    return download_image_v2(entry['folder'], entry['relpath'])
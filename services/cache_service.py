@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from utils.file_utils import rewrite_manifest
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with per-entry TTL.
+    When index_path is given the entries are persisted as JSON so they survive restarts;
+    values must therefore be JSON-serializable. With a shared state (namespace prefixes
+    its keys) the in-process LRU is backed by entries every worker process can read,
+    written through on set(); index_path is then unnecessary.
+    """
+    def __init__(self, max_entries=512, ttl=3600, index_path=None, state=None, namespace='cache'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_path = index_path
+        self.state = state
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0  # hits found in the shared state, i.e. set by another worker
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        if index_path:
+            self._load()
+
+    @staticmethod
+    def make_key(*parts):
+        raw = json.dumps(parts, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key, validate=None, record_stats=True):
+        """
+        Return the cached value or None; validate(value) may reject stale entries.
+        record_stats=False leaves hits/misses alone (secondary lookups, e.g. near-duplicates).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                expired = self.ttl and time.time() - stored_at > self.ttl
+                if expired or (validate and not validate(value)):
+                    del self._entries[key]
+                    self._save()
+                else:
+                    self._entries.move_to_end(key)
+                    if record_stats:
+                        self.hits += 1
+                    return value
+
+        value = self._get_shared(key, validate)
+        with self._lock:
+            if value is not None:
+                self._put(key, value, time.time())
+                if record_stats:
+                    self.hits += 1
+                    self.shared_hits += 1
+            elif record_stats:
+                self.misses += 1
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._put(key, value, time.time())
+            self._save()
+        if self.state is not None:
+            try:
+                self.state.set(f"{self.namespace}:{key}", json.dumps(value, ensure_ascii=False), ttl=self.ttl)
+            except Exception as e:
+                logging.error(f"Could not share cache entry {key}: {str(e)}")
+
+    def _put(self, key, value, stored_at):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_shared(self, key, validate=None):
+        """Value another worker stored under key, or None."""
+        if self.state is None:
+            return None
+        try:
+            raw = self.state.get(f"{self.namespace}:{key}")
+            if raw is None:
+                return None
+            value = json.loads(raw)
+            if validate and not validate(value):
+                self.state.delete(f"{self.namespace}:{key}")
+                return None
+            return value
+        except Exception as e:
+            logging.error(f"Could not read shared cache entry {key}: {str(e)}")
+            return None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'shared': self.state is not None,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Ignoring unreadable cache index {self.index_path}: {str(e)}")
+            return
+        now = time.time()
+        for key, stored_at, value in rows:
+            if not self.ttl or now - stored_at <= self.ttl:
+                self._entries[key] = (stored_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        if not self.index_path:
+            return
+        rows = [[key, stored_at, value] for key, (stored_at, value) in self._entries.items()]
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        # a unique temp file: worker processes sharing index_path save concurrently
+        rewrite_manifest(self.index_path, [json.dumps(rows, ensure_ascii=False)])
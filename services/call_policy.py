@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+from collections import deque
+from services.rate_limiter import UpstreamBusyError, UpstreamRateLimitedError
+
+# HTTP statuses worth another attempt: request timeout and transient server errors
+RETRYABLE_CODES = {408, 500, 502, 503, 504}
+
+
+class CallTimeoutError(TimeoutError):
+    """A model call ran past its deadline, or a stream sent nothing for idle_timeout seconds."""
+    def __init__(self, message, idle=False):
+        super().__init__(message)
+        self.idle = idle
+
+
+def _is_transient(error):
+    if isinstance(error, CallTimeoutError):
+        return error.idle  # a stalled stream may well succeed on a fresh connection
+    if isinstance(error, UpstreamBusyError):
+        return isinstance(error, UpstreamRateLimitedError)  # local overload fails fast
+    if getattr(error, 'code', None) in RETRYABLE_CODES:
+        return True
+    try:
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+    except ImportError:
+        pass
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class CallPolicy:
+    """
+    Deadlines, idle timeouts, retries and caption hedging for model calls.
+
+    deadlines maps a call kind ("image" / "caption") to the seconds one logical call
+    (including retries) may take. idle_timeout bounds the gap between bytes on the
+    socket, so a stalled stream is cut off instead of pinning a worker. Transient
+    errors are retried up to max_retries times with full-jitter exponential backoff,
+    as long as the next attempt still fits in the deadline. With hedge_captions a
+    second caption request is sent when the first hasn't answered after hedge_after
+    seconds (None: the observed p95), and whichever returns first wins.
+    """
+    def __init__(self, deadlines=None, idle_timeout=30.0, connect_timeout=10.0, max_retries=2,
+                 backoff_base=0.5, backoff_max=8.0, hedge_captions=False, hedge_after=None,
+                 window=2048):
+        self.deadlines = {'image': 180.0, 'caption': 30.0, **(deadlines or {})}
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_captions = hedge_captions
+        self.hedge_after = hedge_after
+        self._window = window
+        self._latencies = {}  # kind -> recent successful call latencies (seconds)
+        self._counters = {}   # kind -> counter name -> value
+        self._lock = threading.Lock()
+
+    def deadline(self, kind):
+        """Absolute time.monotonic() by which a call of this kind must finish."""
+        return time.monotonic() + self.deadlines.get(kind, 60.0)
+
+    def socket_timeout(self, deadline):
+        """(connect, read) timeout for one HTTP request of a call due at deadline."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise CallTimeoutError("Model call deadline exceeded")
+        return min(self.connect_timeout, remaining), min(self.idle_timeout, remaining)
+
+    def retry_delay(self, error, attempt, deadline):
+        """Seconds to sleep before retrying after error, or None if it shouldn't be retried."""
+        if attempt >= self.max_retries or not _is_transient(error):
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if isinstance(error, UpstreamRateLimitedError):
+            delay = max(delay, error.retry_after)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def hedge_delay(self, kind):
+        """Seconds to wait before sending a hedge, or None until there is enough history."""
+        if self.hedge_after is not None:
+            return self.hedge_after
+        with self._lock:
+            samples = sorted(self._latencies.get(kind, ()))
+        if len(samples) < 20:
+            return None
+        return samples[int(len(samples) * 0.95)]
+
+    def count(self, kind, name, amount=1):
+        with self._lock:
+            counters = self._counters.setdefault(kind, {})
+            counters[name] = counters.get(name, 0) + amount
+
+    def record(self, kind, latency):
+        """Note the end-to-end latency of a successful call."""
+        with self._lock:
+            self._latencies.setdefault(kind, deque(maxlen=self._window)).append(latency)
+            counters = self._counters.setdefault(kind, {})
+            counters['succeeded'] = counters.get('succeeded', 0) + 1
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for kind in set(self._latencies) | set(self._counters):
+                samples = sorted(self._latencies.get(kind, ()))
+                entry = dict(self._counters.get(kind, {}))
+                for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+                    entry[f'{name}_ms'] = (
+                        round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1000, 1)
+                        if samples else None
+                    )
+                stats[kind] = entry
+            return stats
@@ -0,0 +1,267 @@
+import io
+import logging
+import os
+import threading
+import uuid
+from services.metrics import stage_timer
+
+# format -> (Pillow format, mime type, file extension)
+ENCODINGS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "avif": ("AVIF", "image/avif", ".avif"),
+    "png": ("PNG", "image/png", ".png"),
+}
+MIME_FORMATS = {mime: fmt for fmt, (_, mime, _) in ENCODINGS.items()}
+
+DEFAULT_QUALITY = {"jpeg": 90, "webp": 82, "avif": 60}
+
+
+def supported_formats():
+    """Formats this Pillow build can write; AVIF needs Pillow >= 11.3 or pillow-avif-plugin."""
+    from PIL import Image
+
+    Image.init()  # loads the format plugins that fill Image.SAVE
+    if "AVIF" not in Image.SAVE:
+        try:
+            import pillow_avif  # noqa: F401  registers the AVIF plugin on import
+        except ImportError:
+            pass
+    return {fmt for fmt, (pil_format, _, _) in ENCODINGS.items() if pil_format in Image.SAVE}
+
+
+def _accepted(accept_header):
+    """{mime type: q} from an Accept header; wildcards are ignored (they never ask for a variant)."""
+    accepted = {}
+    for item in (accept_header or "").split(","):
+        mime, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if mime and "*" not in mime:
+            accepted[mime.strip().lower()] = q
+    return accepted
+
+
+class ImageEncoder:
+    """
+    Output encoding stage. Renditions are written as progressive JPEG (or WebP/AVIF),
+    generated images are optionally re-encoded before they are stored, and downloads
+    can be answered with a smaller WebP/AVIF variant when the client's Accept header
+    lists it. Variants are encoded once per (source ETag, format, quality) and kept in
+    variant_folder, evicted least recently used above max_variant_bytes.
+    """
+    def __init__(self, rendition_format="jpeg", quality=None, progressive=True, generated_format="original",
+                 negotiate_formats=("avif", "webp"), variant_folder="variants", max_variant_bytes=0):
+        if rendition_format not in ENCODINGS or rendition_format == "png":
+            raise ValueError(f"Unsupported rendition format: {rendition_format}")
+        if generated_format != "original" and generated_format not in ENCODINGS:
+            raise ValueError(f"Unsupported generated image format: {generated_format}")
+        self.rendition_format = rendition_format
+        self.quality = {**DEFAULT_QUALITY, **(quality or {})}
+        self.progressive = progressive
+        self.generated_format = generated_format  # 'original' stores model output byte for byte
+        self.configured_formats = list(negotiate_formats)  # client preference order
+        self.variant_folder = variant_folder
+        self.max_variant_bytes = max_variant_bytes  # 0 = unbounded
+        self.variants_created = 0
+        self.variant_hits = 0
+        self.bytes_saved = 0
+        self._not_smaller = set()  # variant names that lost to their source; served as-is
+        self._variant_usage = None
+        self._available = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """Formats Pillow can write here; probed on first use so importing the app doesn't load Pillow."""
+        if self._available is None:
+            self._available = supported_formats()
+        return self._available
+
+    @property
+    def negotiate_formats(self):
+        """Configured variant formats this build can encode, in preference order."""
+        return [fmt for fmt in self.configured_formats if fmt in self.available]
+
+    # ----- encoding -----
+
+    def encode(self, img, fmt):
+        """Encode a Pillow image as fmt and return the bytes."""
+        if fmt not in self.available:
+            raise ValueError(f"This Pillow build cannot write {fmt}")
+        pil_format = ENCODINGS[fmt][0]
+        options = {}
+        if fmt == "jpeg":
+            options = {"quality": self.quality["jpeg"], "progressive": self.progressive, "optimize": self.progressive}
+        elif fmt in ("webp", "avif"):
+            options = {"quality": self.quality[fmt]}
+        elif fmt == "png":
+            options = {"optimize": True}
+
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif fmt != "png" and img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+
+        buffer = io.BytesIO()
+        with stage_timer("encoder", fmt):
+            img.save(buffer, pil_format, **options)
+        return buffer.getvalue()
+
+    def rendition_tag(self):
+        """Part of a rendition's file name that changes whenever its encoding does."""
+        fmt = self.rendition_format
+        suffix = "p" if fmt == "jpeg" and self.progressive else ""
+        return f"q{self.quality[fmt]}{suffix}"
+
+    def rendition_extension(self):
+        return ENCODINGS[self.rendition_format][2]
+
+    def encode_generated(self, data, mime_type):
+        """
+        (bytes, mime type) to store for a model-produced image. Re-encoded results are
+        kept only when smaller; unreadable data is stored unchanged.
+        """
+        fmt = self.generated_format
+        if fmt == "original" or mime_type not in MIME_FORMATS:
+            return data, mime_type
+        from PIL import Image
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                encoded = self.encode(img, fmt)
+        except Exception:
+            return data, mime_type
+        if len(encoded) >= len(data):
+            return data, mime_type
+        return encoded, ENCODINGS[fmt][1]
+
+    # ----- negotiated variants -----
+
+    def negotiable(self, source_mime):
+        """True if responses for a source of source_mime depend on the Accept header."""
+        return MIME_FORMATS.get(source_mime) in ("jpeg", "png", "webp") and bool(self.configured_formats)
+
+    def negotiate(self, accept_header, source_mime):
+        """Best variant format the client accepts for a source of source_mime, or None to send the source."""
+        if not self.negotiable(source_mime) or not self.negotiate_formats:
+            return None
+        source_format = MIME_FORMATS[source_mime]
+        accepted = _accepted(accept_header)
+        best = None
+        for fmt in self.negotiate_formats:
+            if fmt == source_format:
+                break  # the source is already the best format the client will take
+            q = accepted.get(ENCODINGS[fmt][1], 0)
+            if q > 0 and (best is None or q > best[1]):
+                best = (fmt, q)
+        return best[0] if best else None
+
+    def variant_tag(self, fmt):
+        """Part of a variant's file name and ETag that changes whenever its encoding does."""
+        return f"q{self.quality.get(fmt, 0)}"
+
+    def variant(self, source_path, fmt, etag):
+        """
+        Path of the fmt variant of source_path, encoding it on first use, or None when the
+        variant is not smaller than the source or cannot be made (serve the source instead).
+        """
+        name = f"{etag[:40]}.{self.variant_tag(fmt)}{ENCODINGS[fmt][2]}"  # etag: source sha256
+        if name in self._not_smaller:
+            return None
+        path = os.path.join(self.variant_folder, name[:2], name)
+        try:
+            os.utime(path)  # recency for LRU eviction
+            with self._lock:
+                self.variant_hits += 1
+            return path
+        except FileNotFoundError:
+            pass
+
+        from PIL import Image, ImageOps
+
+        try:
+            with Image.open(source_path) as img:
+                # only the first frame would survive re-encoding
+                animated = getattr(img, "is_animated", False)
+                data = b"" if animated else self.encode(ImageOps.exif_transpose(img), fmt)
+        except Exception as e:
+            logging.error(f"Could not encode {fmt} variant of {source_path}: {str(e)}")
+            return None
+        source_size = os.path.getsize(source_path)
+        if animated or len(data) >= source_size:
+            with self._lock:
+                if len(self._not_smaller) >= 4096:
+                    self._not_smaller.clear()
+                self._not_smaller.add(name)
+            return None
+
+        # write-then-rename: a concurrent request may encode the same variant; either copy wins
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.variants_created += 1
+            self.bytes_saved += source_size - len(data)
+        self._enforce_variant_quota(len(data))
+        return path
+
+    def _enforce_variant_quota(self, added):
+        if not self.max_variant_bytes:
+            return
+        with self._lock:
+            if self._variant_usage is None:
+                self._variant_usage = sum(size for _, size, _ in self._variant_files())
+            else:
+                self._variant_usage += added
+            if self._variant_usage <= self.max_variant_bytes:
+                return
+
+            files = sorted(self._variant_files())
+            usage = sum(size for _, size, _ in files)
+            target = self.max_variant_bytes * 0.9
+            for _, size, path in files:
+                if usage <= target:
+                    break
+                try:
+                    os.remove(path)
+                    usage -= size
+                except FileNotFoundError:
+                    continue
+            self._variant_usage = usage
+
+    def _variant_files(self):
+        """(atime-ish mtime, size, path) of every stored variant."""
+        files = []
+        if not os.path.isdir(self.variant_folder):
+            return files
+        for shard in os.scandir(self.variant_folder):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rendition_format": self.rendition_format,
+                "rendition_tag": self.rendition_tag(),
+                "generated_format": self.generated_format,
+                "negotiate_formats": self.negotiate_formats,
+                "available_formats": sorted(self.available),
+                "quality": self.quality,
+                "variants_created": self.variants_created,
+                "variant_hits": self.variant_hits,
+                "variant_bytes_saved": self.bytes_saved,
+            }
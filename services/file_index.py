@@ -0,0 +1,289 @@
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+from utils.file_utils import manifest_lock, rewrite_manifest
+
+# A file's access time is written out at most this often (seconds), however often it is read
+ACCESS_PERSIST_INTERVAL = 60
+
+
+def _is_stored_file(name):
+    # temp files (.incoming_*, *.part) and manifests are not served
+    return not name.startswith('.') and not name.endswith('.part')
+
+
+class FileIndex:
+    """
+    In-memory index of stored files: file id (basename) -> folder, size, mtime, mime,
+    dimensions and ETag. Lookups are O(1) dict hits instead of filesystem probes.
+
+    The index is persisted as an append-only JSON-lines manifest, replayed and compacted
+    on load. Services record their own writes with add(); files that appear any other way
+    are picked up by refresh(), which only rescans directories whose mtime changed.
+
+    Access times (read by the storage janitor) go to the manifest too, and with a shared
+    state also to every worker process, at most every ACCESS_PERSIST_INTERVAL per file.
+    """
+    def __init__(self, folders, manifest_path, rescan_interval=5, state=None):
+        self.folders = folders  # folder key ('uploads' / 'generated') -> local directory
+        self.manifest_path = manifest_path
+        self.rescan_interval = rescan_interval
+        self.state = state      # optional shared state holding access times of all workers
+        self._entries = {}
+        self._access_saved = {}  # file id -> access time last written out
+        self._dir_mtimes = {}   # "<folder key>:<rel dir>" -> mtime_ns at last scan
+        self._subdirs = {}      # dir key -> subdirectory names at last scan
+        self._dir_files = {}    # dir key -> ids of the files indexed in it
+        self._sorted_ids = None  # newest first, rebuilt lazily for listing
+        self._refreshed_at = 0.0
+        self._lock = threading.RLock()
+        self._load()
+
+    # ----- Lookups -----
+
+    def get(self, file_id):
+        return self._entries.get(file_id)
+
+    def path_of(self, entry):
+        return os.path.join(self.folders[entry['folder']], entry['relpath'])
+
+    def lookup_path(self, path):
+        """Entry for a client-supplied path, or None if it isn't an indexed file."""
+        entry = self._entries.get(os.path.basename(path))
+        if entry and os.path.abspath(self.path_of(entry)) == os.path.abspath(path):
+            return entry
+        return None
+
+    def exists(self, path):
+        """
+        Whether path is on disk. An index hit is confirmed with a stat, since another worker
+        or the janitor may have deleted the file; such a stale entry is dropped.
+        """
+        entry = self.lookup_path(path)
+        if not os.path.exists(path):
+            if entry is not None:
+                self.remove(os.path.basename(path))
+            return False
+        if entry is not None:
+            self._accessed(os.path.basename(path), entry)
+        return True
+
+    def touch(self, file_id):
+        """Note a read; the janitor evicts least recently accessed files first."""
+        entry = self._entries.get(file_id)
+        if entry is not None:
+            self._accessed(file_id, entry)
+
+    def last_access(self, file_id, entry):
+        """
+        Latest access time of a file in any worker process (the entry's own without a shared
+        state); a newer shared time is copied into the in-memory entry.
+        """
+        accessed = entry.get('accessed', entry['mtime'])
+        if self.state is None:
+            return accessed
+        try:
+            shared = self.state.get(f"accessed:{file_id}")
+        except Exception as e:
+            logging.error(f"Shared state unavailable, using this worker's access time of {file_id}: {str(e)}")
+            return accessed
+        if shared is not None and float(shared) > accessed:
+            accessed = float(shared)
+            current = self._entries.get(file_id)
+            if current is not None:
+                current['accessed'] = max(current.get('accessed', 0), accessed)
+        return accessed
+
+    def snapshot(self, folder):
+        """[(file id, entry copy)] of one folder, for background passes."""
+        with self._lock:
+            return [(i, dict(e)) for i, e in self._entries.items() if e['folder'] == folder]
+
+    def list(self, folder=None, offset=0, limit=50):
+        """Page through entries, newest first; returns (total, entries)."""
+        with self._lock:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(self._entries, key=lambda i: self._entries[i]['mtime'], reverse=True)
+            ids = self._sorted_ids
+            if folder:
+                ids = [i for i in ids if self._entries[i]['folder'] == folder]
+            return len(ids), [dict(self._entries[i], id=i) for i in ids[offset:offset + limit]]
+
+    # ----- Updates -----
+
+    def add(self, folder, path, etag=None):
+        """Record a file just written by a service."""
+        try:
+            entry = self._describe(folder, path)
+        except OSError as e:
+            logging.error(f"Cannot index {path}: {str(e)}")
+            return None
+        if etag:
+            entry['etag'] = etag
+        with self._lock:
+            self._put(os.path.basename(path), entry)
+        return entry
+
+    def remove(self, file_id):
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            self._access_saved.pop(file_id, None)
+            if entry is not None:
+                self._dir_files.get(self._dir_key(entry), set()).discard(file_id)
+                self._sorted_ids = None
+                self._append({'op': 'del', 'id': file_id})
+        if entry is not None and self.state is not None:
+            try:
+                self.state.delete(f"accessed:{file_id}")
+            except Exception as e:
+                logging.error(f"Could not drop shared access time of {file_id}: {str(e)}")
+
+    def set_etag(self, file_id, etag):
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None and entry.get('etag') != etag:
+                entry['etag'] = etag
+                self._append({'op': 'add', 'id': file_id, **entry})
+
+    def maybe_refresh(self):
+        """refresh() at most every rescan_interval seconds (used on lookup misses)."""
+        if time.time() - self._refreshed_at > self.rescan_interval:
+            self.refresh()
+
+    def refresh(self):
+        """Rescan directories whose mtime changed since they were last scanned."""
+        with self._lock:
+            self._refreshed_at = time.time()
+            for folder, root in self.folders.items():
+                if os.path.isdir(root):
+                    self._scan_dir(folder, root, '')
+
+    def _scan_dir(self, folder, root, rel_dir):
+        abs_dir = os.path.join(root, rel_dir)
+        dir_key = f"{folder}:{rel_dir}"
+        mtime_ns = os.stat(abs_dir).st_mtime_ns
+
+        if mtime_ns == self._dir_mtimes.get(dir_key):
+            # nothing was added or removed here; only descend into known subdirectories
+            subdirs = self._subdirs.get(dir_key, [])
+        else:
+            subdirs, present = [], set()
+            for entry in os.scandir(abs_dir):
+                if entry.is_dir():
+                    subdirs.append(entry.name)  # sharded content store: uploads/<ab>/<cd>/...
+                elif entry.is_file() and _is_stored_file(entry.name):
+                    present.add(entry.name)
+                    if entry.name not in self._entries:
+                        try:
+                            self._put(entry.name, self._describe(folder, entry.path))
+                        except OSError:
+                            pass
+            for file_id in self._dir_files.get(dir_key, set()) - present:
+                self.remove(file_id)
+
+            self._dir_mtimes[dir_key] = mtime_ns
+            self._subdirs[dir_key] = subdirs
+            self._append({'op': 'dir', 'key': dir_key, 'mtime_ns': mtime_ns, 'subdirs': subdirs})
+
+        for name in subdirs:
+            try:
+                self._scan_dir(folder, root, os.path.join(rel_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _describe(self, folder, path):
+        stat = os.stat(path)
+        entry = {
+            'folder': folder,
+            'relpath': os.path.relpath(path, self.folders[folder]),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'mime': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'width': None,
+            'height': None,
+            'etag': None,
+        }
+        try:
+            from PIL import Image
+            with Image.open(path) as img:  # header only, pixels are not decoded
+                entry['width'], entry['height'] = img.size
+        except Exception:
+            pass
+        return entry
+
+    def _dir_key(self, entry):
+        return f"{entry['folder']}:{os.path.dirname(entry['relpath'])}"
+
+    def _put(self, file_id, entry):
+        previous = self._entries.get(file_id)
+        if previous is not None:
+            self._dir_files.get(self._dir_key(previous), set()).discard(file_id)
+        self._entries[file_id] = entry
+        self._dir_files.setdefault(self._dir_key(entry), set()).add(file_id)
+        self._sorted_ids = None
+        self._append({'op': 'add', 'id': file_id, **entry})
+
+    def _accessed(self, file_id, entry):
+        now = entry['accessed'] = time.time()
+        if now - self._access_saved.get(file_id, 0) < ACCESS_PERSIST_INTERVAL:
+            return
+        self._access_saved[file_id] = now
+        with self._lock:
+            self._append({'op': 'seen', 'id': file_id, 'at': now})
+        if self.state is not None:
+            try:
+                self.state.set(f"accessed:{file_id}", str(now))
+            except Exception as e:
+                logging.error(f"Could not share access time of {file_id}: {str(e)}")
+
+    # ----- Manifest -----
+
+    def _append(self, record):
+        if not self.manifest_path:
+            return
+        with manifest_lock(self.manifest_path), open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def _load(self):
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return
+        # replayed and compacted under one exclusive lock: other workers' appends wait, so none are lost
+        with manifest_lock(self.manifest_path, exclusive=True):
+            self._replay()
+            self._compact()
+
+    def _replay(self):
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn write from a crashed process
+                op = record.pop('op', None)
+                if op == 'add':
+                    self._entries[record.pop('id')] = record
+                elif op == 'del':
+                    self._entries.pop(record['id'], None)
+                elif op == 'seen':
+                    entry = self._entries.get(record['id'])
+                    if entry is not None:
+                        entry['accessed'] = max(entry.get('accessed', 0), record['at'])
+                elif op == 'dir':
+                    self._dir_mtimes[record['key']] = record['mtime_ns']
+                    self._subdirs[record['key']] = record.get('subdirs', [])
+        for file_id, entry in self._entries.items():
+            self._dir_files.setdefault(self._dir_key(entry), set()).add(file_id)
+
+    def _compact(self):
+        # callers hold the exclusive manifest lock
+        def records():
+            for key, mtime_ns in self._dir_mtimes.items():
+                record = {'op': 'dir', 'key': key, 'mtime_ns': mtime_ns, 'subdirs': self._subdirs.get(key, [])}
+                yield json.dumps(record, separators=(',', ':'))
+            for file_id, entry in self._entries.items():
+                yield json.dumps({'op': 'add', 'id': file_id, **entry}, separators=(',', ':'))
+
+        rewrite_manifest(self.manifest_path, records())
@@ -1,173 +1,744 @@
 import base64
+import hashlib
+import logging
 import mimetypes
 import os
+import threading
+import time
 import uuid
-from google import genai
-from google.genai import types
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager, nullcontext
+from services.call_policy import CallPolicy, CallTimeoutError
+from services.similarity import colour_signature, is_informative, same_colours
+from services.metrics import (MODEL_BYTES_RECEIVED, MODEL_CALL_LATENCY, MODEL_FIRST_CHUNK, MODEL_IN_FLIGHT,
+                              stage_timer)
+
+_shared_service_lock = threading.Lock()
+
+# Writes of multi-image responses overlap with each other and with the stream
+_write_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-write")
+
+# Runs caption attempts when hedging, so the first answer can win
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="caption-hedge")
+
+
+def _image_result(image_paths, text, cached):
+    return {
+        "image_path": image_paths[0] if image_paths else None,
+        "image_paths": image_paths,
+        "text": text,
+        "cached": cached,
+    }
+
+
+def _cached_images_exist(value):
+    # entries written before multi-image results were plain path strings
+    return isinstance(value, dict) and all(os.path.exists(path) for path in value["image_paths"])
+
+
+def _as_call_timeout(error):
+    """CallTimeoutError for transport timeouts (no bytes for idle_timeout), else None."""
+    if isinstance(error, CallTimeoutError):
+        return error
+    import requests
+    # mid-stream read timeouts reach us wrapped in a ConnectionError by requests' iter_content
+    if isinstance(error, requests.exceptions.Timeout) or (
+        isinstance(error, requests.exceptions.ConnectionError) and "Read timed out" in str(error)
+    ):
+        return CallTimeoutError("The model stopped sending data", idle=True)
+    return None
+
+
+def get_gemini_service(app):
+    """
+    Return the worker-wide GeminiService stored on the app, creating it on first use.
+    The pid check makes pre-fork servers build a fresh client in each child process.
+    """
+    service = app.extensions.get("gemini_service")
+    if service is not None and service.pid == os.getpid():
+        return service
+
+    with _shared_service_lock:
+        service = app.extensions.get("gemini_service")
+        if service is None or service.pid != os.getpid():
+            client_factory = app.config.get("GEMINI_CLIENT_FACTORY")
+            service = GeminiService(
+                client=client_factory() if client_factory else None,
+                generation_cache=app.extensions.get("generation_cache"),
+                caption_cache=app.extensions.get("caption_cache"),
+                pool_size=app.config.get("GEMINI_POOL_SIZE", 10),
+                keepalive=app.config.get("GEMINI_KEEPALIVE", 60),
+                base_url=app.config.get("GEMINI_BASE_URL") or None,
+                file_index=app.extensions.get("file_index"),
+                generated_folder=app.config.get("GENERATED_FOLDER", "generated"),
+                storage=app.extensions.get("storage"),
+                preprocessor=app.extensions.get("image_preprocessor"),
+                rate_limiter=app.extensions.get("rate_limiter"),
+                call_policy=app.extensions.get("call_policy"),
+                encoder=app.extensions.get("image_encoder"),
+                similarity=app.extensions.get("similarity"),
+                similarity_distance=app.config.get("PHASH_REUSE_DISTANCE", 0),
+                single_flight=app.extensions.get("single_flight"),
+            )
+            app.extensions["gemini_service"] = service
+    return service
+
+
+class _LineStream:
+    """
+    Streamed response as seen by the SDK, which only calls iter_lines(). requests' default
+    512-byte chunks make splitting a multi-MB base64 image line quadratic; read in larger ones.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, response, on_close=None):
+        self.response = response
+        self.on_close = on_close
+
+    def iter_lines(self):
+        try:
+            yield from self.response.iter_lines(chunk_size=self.chunk_size)
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
 
 
 class GeminiService:
     """
     Image generation/editing uses an image-capable model.
     Captioning uses a multimodal text+vision model.
+    A single instance is safe to share between request threads.
     """
-    def __init__(self):
-        self.client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+    def __init__(self, client=None, generation_cache=None, caption_cache=None,
+                 pool_size=10, keepalive=60, base_url=None, file_index=None,
+                 generated_folder="generated", storage=None, preprocessor=None, rate_limiter=None,
+                 call_policy=None, encoder=None, similarity=None, similarity_distance=0, single_flight=None):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.pool_mounted = False
+        self._pool_lock = threading.Lock()
+        self._pool_active = 0                               # pooled requests still sending or streaming
+        self._pool_idle_since = time.monotonic()
+        self._pool_idle_closes = 0
+        # client may be injected (e.g. a fake genai client in tests)
+        self.client = client or self._build_client(base_url)
         self.image_model = "gemini-2.5-flash-image-preview"  # for image gen & edit
         self.caption_model = "gemini-1.5-flash"              # for captioning (text+vision)
+        self.generation_cache = generation_cache            # optional ResultCache
+        self.caption_cache = caption_cache                  # optional ResultCache
+        self.file_index = file_index                        # optional FileIndex, told about new files
+        self.generated_folder = generated_folder
+        self.storage = storage                              # optional backend new files are published to
+        self.preprocessor = preprocessor                    # optional ImagePreprocessor for model inputs
+        self.rate_limiter = rate_limiter                    # optional RateLimiter keyed "image" / "caption"
+        self.call_policy = call_policy or CallPolicy()      # deadlines, retries and hedging
+        self.encoder = encoder                              # optional ImageEncoder for stored images
+        self.similarity = similarity                        # optional PerceptualIndex of stored images
+        self.similarity_distance = similarity_distance      # dHash bits within which cache entries are shared
+        self.single_flight = single_flight                  # optional SingleFlight coalescing identical calls
+        self._request_options = threading.local()           # per-thread socket timeout for the transport
+        self.pid = os.getpid()
+
+        self._stats_lock = threading.Lock()
+        self._created_at = time.time()
+        self._calls = 0
+        self._errors = 0
+        self._in_flight = 0
+        self._peak_in_flight = 0
+
+    def _build_client(self, base_url):
+        http_options = {}
+        if base_url:
+            http_options["base_url"] = base_url
+        from google import genai  # deferred: the SDK costs ~0.5 s to import
+
+        client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"), http_options=http_options)
+        self.pool_mounted = self._mount_connection_pool(client)
+        return client
+
+    def _mount_connection_pool(self, client):
+        """
+        google-genai 0.2.x opens a fresh requests.Session (new TCP + TLS) for every
+        API-key call. Route those calls through one pooled, keep-alive session instead.
+        Connections left idle for longer than keepalive seconds are closed before the next
+        call rather than reused, since the server or a proxy has likely dropped them by then.
+        """
+        import json
+        import requests
+        from requests.adapters import HTTPAdapter
+        from google.genai import _api_client, errors
+
+        api_client = getattr(client, "_api_client", None)
+        if api_client is None or not hasattr(api_client, "_request_unauthorized"):
+            return False
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        def request_pooled(http_request, stream=False):
+            data = http_request.data
+            if data and not isinstance(data, bytes):
+                data = json.dumps(data, cls=_api_client.RequestJsonEncoder)
+            prepared = requests.Request(
+                method=http_request.method,
+                url=http_request.url,
+                headers=http_request.headers,
+                data=data or None,
+            ).prepare()
+            timeout = getattr(self._request_options, "timeout", None)
+            self._pool_checkout(session)
+            try:
+                response = session.send(prepared, stream=stream, timeout=timeout)
+                errors.APIError.raise_for_response(response)
+            except Exception:
+                self._pool_checkin()
+                raise
+            if stream:
+                return _api_client.HttpResponse(response.headers, _LineStream(response, self._pool_checkin))
+            self._pool_checkin()
+            return _api_client.HttpResponse(response.headers, [response.text])
+
+        api_client._request_unauthorized = request_pooled
+        self._http_session = session
+        return True
+
+    def _pool_checkout(self, session):
+        with self._pool_lock:
+            if self._pool_active == 0 and time.monotonic() - self._pool_idle_since > self.keepalive:
+                # every pooled connection has sat unused past keepalive; the adapters reopen on demand
+                session.close()
+                self._pool_idle_closes += 1
+            self._pool_active += 1
+
+    def _pool_checkin(self):
+        with self._pool_lock:
+            self._pool_active -= 1
+            if self._pool_active == 0:
+                self._pool_idle_since = time.monotonic()
+
+    @contextmanager
+    def _track_call(self, kind):
+        # admission per model ("image" / "caption"); may raise UpstreamBusyError before the call is counted
+        limit = self.rate_limiter.acquire(kind) if self.rate_limiter is not None else nullcontext()
+        with limit, self._counted_call(kind):
+            yield
+
+    @contextmanager
+    def _counted_call(self, kind):
+        with self._stats_lock:
+            self._calls += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        MODEL_IN_FLIGHT.labels(kind).inc()
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except Exception:
+            with self._stats_lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+            MODEL_IN_FLIGHT.labels(kind).dec()
+            MODEL_CALL_LATENCY.labels(kind, outcome).observe(time.perf_counter() - started)
+
+    def pool_stats(self):
+        with self._stats_lock:
+            return {
+                "pid": self.pid,
+                "uptime_seconds": round(time.time() - self._created_at, 1),
+                "pool_size": self.pool_size,
+                "keepalive": self.keepalive,
+                "pool_mounted": self.pool_mounted,
+                "idle_closes": self._pool_idle_closes,
+                "calls": self._calls,
+                "errors": self._errors,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+            }
 
     def generate_image_from_text(self, prompt, style="realistic"):
         """Generate image from text prompt."""
+        return self.generate_image(prompt, style)["image_path"]
+
+    def generate_image(self, prompt, style="realistic", use_cache=True, max_images=None):
+        """
+        Generate image(s) from text prompt.
+        Returns {"image_path": first image, "image_paths": [...], "text": ..., "cached": bool};
+        cached results are only used when a generation cache is configured and use_cache is true.
+        With use_cache, a call made while the same prompt is in flight waits for that call and
+        shares its images (the result then also has "coalesced": True).
+        """
+        for event in self.generate_image_stream(prompt, style, use_cache, max_images):
+            if event["event"] == "done":
+                event.pop("event")
+                return event
+
+    def generate_image_stream(self, prompt, style="realistic", use_cache=True, max_images=None):
+        """
+        Generate image(s) from text prompt, yielding progress events as the model streams:
+        "chunk" (bytes received), "image" (a file was saved), "text" and finally "done".
+        """
+        # collapse whitespace so trivially different prompts share a cache entry
+        prompt = " ".join(prompt.split())
         enhanced_prompt = (
             f"Create a high-quality {style} image for social media: {prompt}. "
             "Make it visually appealing, well-composed, and suitable for social media platforms."
         )
 
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=enhanced_prompt)],
-            ),
-        ]
-
-        generate_content_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE", "TEXT"],
-        )
-
-        os.makedirs("generated", exist_ok=True)
+        cache = self.generation_cache if use_cache else None
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(
+                "generate", self.image_model, style, enhanced_prompt, max_images
+            )
+            cached = cache.get(cache_key, validate=_cached_images_exist)
+            if cached:
+                for index, path in enumerate(cached["image_paths"]):
+                    yield {"event": "image", "index": index, "image_path": path}
+                yield {"event": "done", **_image_result(cached["image_paths"], cached["text"], True)}
+                return
 
-        generated_files = []
-        file_index = 0
+        flight_key = (self.image_model, style, enhanced_prompt, max_images)
+        with self._flight("generate", flight_key, use_cache) as flight:
+            if flight is not None and not flight.leader:
+                # the same prompt is being generated right now: share its images
+                for index, path in enumerate(flight.result["image_paths"]):
+                    yield {"event": "image", "index": index, "image_path": path}
+                yield {"event": "done", **_image_result(flight.result["image_paths"], flight.result["text"], False),
+                       "coalesced": True}
+                return
 
-        for chunk in self.client.models.generate_content_stream(
-            model=self.image_model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if (
-                not chunk.candidates
-                or not chunk.candidates[0].content
-                or not chunk.candidates[0].content.parts
-            ):
-                continue
+            from google.genai import types
 
-            part = chunk.candidates[0].content.parts[0]
-            if getattr(part, "inline_data", None) and getattr(part.inline_data, "data", None):
-                file_name = f"generated_{uuid.uuid4()}_{file_index}"
-                file_index += 1
-                inline_data = part.inline_data
-                data_buffer = inline_data.data
-                file_extension = mimetypes.guess_extension(inline_data.mime_type) or ".png"
+            contents = [
+                types.Content(
+                    role="user",
+                    parts=[types.Part.from_text(text=enhanced_prompt)],
+                ),
+            ]
 
-                file_path = os.path.join("generated", f"{file_name}{file_extension}")
-                self._save_binary_file(file_path, data_buffer)
-                generated_files.append(file_path)
+            image_paths, texts = [], []
+            for event in self._stream_image_events(contents, "generated", max_images):
+                if event["event"] == "image":
+                    image_paths.append(event["image_path"])
+                elif event["event"] == "text":
+                    texts.append(event["text"])
+                yield event
 
-        return generated_files[0] if generated_files else None
+            text = "".join(texts).strip()
+            if image_paths and cache is not None:
+                cache.set(cache_key, {"image_paths": image_paths, "text": text})
+            if flight is not None:
+                flight.resolve({"image_paths": image_paths, "text": text})
+            yield {"event": "done", **_image_result(image_paths, text, False)}
 
     def edit_image(self, image_path, edit_prompt):
         """Edit existing image based on prompt."""
+        return self.edit_image_result(image_path, edit_prompt)["image_path"]
+
+    def edit_image_result(self, image_path, edit_prompt, max_images=None, use_cache=True):
+        """
+        Edit existing image; returns {"image_path", "image_paths", "text", "cached"} like generate_image.
+        With a generation cache, edits of the same (or a visually identical) image and prompt are reused.
+        """
         # normalize path
         image_path = image_path.replace("/", os.sep).replace("\\", os.sep)
+        edit_prompt = " ".join(edit_prompt.split())
+
+        cache = self.generation_cache if use_cache else None
+        cache_key = None
+        digest = None
+        if cache is not None or (use_cache and self.single_flight is not None):
+            with open(image_path, "rb") as f:
+                source = f.read()
+            digest = hashlib.sha256(source).hexdigest()
+        if cache is not None:
+
+            def make_key(image_digest):
+                return cache.make_key("edit", self.image_model, image_digest, edit_prompt, max_images)
+
+            cache_key = make_key(digest)
+            cached = cache.get(cache_key, validate=_cached_images_exist)
+            near_duplicate_of = None
+            if not cached:
+                cached, near_duplicate_of = self._near_duplicate_hit(
+                    cache, image_path, digest, source, make_key, validate=_cached_images_exist
+                )
+                if cached:
+                    cache.set(cache_key, cached)
+            if cached:
+                result = _image_result(cached["image_paths"], cached["text"], True)
+                if near_duplicate_of:
+                    result["near_duplicate_of"] = near_duplicate_of
+                return result
 
-        with open(image_path, "rb") as f:
-            image_data = f.read()
+        flight_key = (self.image_model, digest, edit_prompt, max_images)
+        with self._flight("edit", flight_key, use_cache) as flight:
+            if flight is not None and not flight.leader:
+                # the same edit of the same image is running right now: share its images
+                return {**_image_result(flight.result["image_paths"], flight.result["text"], False),
+                        "coalesced": True}
 
-        mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
+            image_data, mime_type = self._model_input(image_path, "edit")
 
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(
-                        text=f"Edit this image: {edit_prompt}. Maintain social media quality and appeal."
-                    ),
-                    types.Part.from_bytes(data=image_data, mime_type=mime_type),
-                ],
-            ),
-        ]
+            from google.genai import types
+
+            contents = [
+                types.Content(
+                    role="user",
+                    parts=[
+                        types.Part.from_text(
+                            text=f"Edit this image: {edit_prompt}. Maintain social media quality and appeal."
+                        ),
+                        types.Part.from_bytes(data=image_data, mime_type=mime_type),
+                    ],
+                ),
+            ]
+
+            image_paths, texts = [], []
+            for event in self._stream_image_events(contents, "edited", max_images):
+                if event["event"] == "image":
+                    image_paths.append(event["image_path"])
+                elif event["event"] == "text":
+                    texts.append(event["text"])
+            result = _image_result(image_paths, "".join(texts).strip(), False)
+            if cache is not None and image_paths:
+                cache.set(cache_key, {"image_paths": image_paths, "text": result["text"]})
+            if flight is not None:
+                flight.resolve({"image_paths": image_paths, "text": result["text"]})
+            return result
+
+    def _stream_image_events(self, contents, prefix, max_images=None):
+        """
+        Stream an image-model call, walking every part of every candidate.
+        Each inline image is handed to the write pool as a memoryview (no copy) as soon
+        as its chunk arrives; files land via temp file + atomic rename. With max_images
+        the stream is abandoned once that many images have arrived.
+        """
+        from google.genai import types
 
         generate_content_config = types.GenerateContentConfig(
             response_modalities=["IMAGE", "TEXT"],
         )
 
-        os.makedirs("generated", exist_ok=True)
+        os.makedirs(self.generated_folder, exist_ok=True)
 
-        generated_files = []
         file_index = 0
+        bytes_received = 0
+        started = time.perf_counter()
+        pending = []  # (index, future of the stored path) in arrival order
 
-        for chunk in self.client.models.generate_content_stream(
-            model=self.image_model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if (
-                not chunk.candidates
-                or not chunk.candidates[0].content
-                or not chunk.candidates[0].content.parts
-            ):
-                continue
+        def finished_writes(wait=False):
+            while pending and (wait or pending[0][1].done()):
+                index, future = pending.pop(0)
+                yield {"event": "image", "index": index, "image_path": future.result()}
+
+        policy = self.call_policy
+        deadline = policy.deadline("image")
+        call_started = time.monotonic()
+        attempt = 0
+        produced = False  # once events reached the caller, a retry would duplicate them
+        try:
+            while True:
+                try:
+                    with self._track_call("image"), self._request_timeout(deadline):
+                        attempt_started = time.perf_counter()
+                        first_chunk = True
+                        for chunk in self.client.models.generate_content_stream(
+                            model=self.image_model,
+                            contents=contents,
+                            config=generate_content_config,
+                        ):
+                            if first_chunk:
+                                MODEL_FIRST_CHUNK.labels("image").observe(time.perf_counter() - attempt_started)
+                                first_chunk = False
+                            if time.monotonic() > deadline:
+                                raise CallTimeoutError("Image model call exceeded its deadline")
+                            for candidate in (chunk.candidates or []):
+                                if not candidate.content or not candidate.content.parts:
+                                    continue
+                                for part in candidate.content.parts:
+                                    inline_data = getattr(part, "inline_data", None)
+                                    if inline_data is not None and getattr(inline_data, "data", None):
+                                        if max_images is not None and file_index >= max_images:
+                                            continue
+                                        data = memoryview(inline_data.data)
+                                        bytes_received += data.nbytes
+                                        MODEL_BYTES_RECEIVED.labels("image").inc(data.nbytes)
+                                        produced = True
+                                        yield {
+                                            "event": "chunk",
+                                            "bytes_received": bytes_received,
+                                            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                                        }
 
-            part = chunk.candidates[0].content.parts[0]
-            if getattr(part, "inline_data", None) and getattr(part.inline_data, "data", None):
-                file_name = f"edited_{uuid.uuid4()}_{file_index}"
-                file_index += 1
-                inline_data = part.inline_data
-                data_buffer = inline_data.data
-                file_extension = mimetypes.guess_extension(inline_data.mime_type) or ".png"
+                                        file_name = f"{prefix}_{uuid.uuid4()}_{file_index}"
+                                        future = _write_pool.submit(
+                                            self._save_generated_image, file_name, data, inline_data.mime_type
+                                        )
+                                        pending.append((file_index, future))
+                                        file_index += 1
+                                    elif getattr(part, "text", None):
+                                        produced = True
+                                        yield {"event": "text", "text": part.text}
 
-                file_path = os.path.join("generated", f"{file_name}{file_extension}")
-                self._save_binary_file(file_path, data_buffer)
-                generated_files.append(file_path)
+                            yield from finished_writes()
+                            if max_images is not None and file_index >= max_images:
+                                break
 
-        return generated_files[0] if generated_files else None
+                        yield from finished_writes(wait=True)
+                    break
+                except Exception as e:
+                    if produced:
+                        raise
+                    self._before_retry("image", e, attempt, deadline)
+                    attempt += 1
+        except Exception as e:
+            policy.count("image", "timeouts" if isinstance(e, CallTimeoutError) else "failed")
+            raise
+        policy.record("image", time.monotonic() - call_started)
 
-    def generate_caption(self, image_path, platform="general", tone="engaging"):
+    def generate_caption(self, image_path, platform="general", tone="engaging", image_data=None):
         """Generate a caption for an image using a text+vision model."""
+        return self.generate_caption_result(image_path, platform, tone, image_data)["caption"]
+
+    def generate_caption_result(self, image_path, platform="general", tone="engaging",
+                                image_data=None, use_cache=True):
+        """
+        Generate a caption, returning {"caption": ..., "cached": bool}.
+        image_data may carry bytes the caller already read, so the file is opened once.
+        """
         image_path = image_path.replace("/", os.sep).replace("\\", os.sep)
 
-        with open(image_path, "rb") as f:
-            image_data = f.read()
+        if image_data is None:
+            with open(image_path, "rb") as f:
+                image_data = f.read()
 
-        mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
+        cache = self.caption_cache if use_cache else None
+        cache_key = None
+        digest = hashlib.sha256(image_data).hexdigest()
 
-        prompt = (
-            f"Analyze this image and write an {tone} caption optimized for {platform}.\n"
-            "- 1–2 short sentences max.\n"
-            "- Include 3–5 relevant hashtags at the end.\n"
-            "- Encourage engagement without sounding spammy.\n"
-            "Only return the caption text."
-        )
+        def make_key(image_digest):
+            return self.caption_cache.make_key("caption", self.caption_model, image_digest, platform, tone)
 
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=prompt),
-                    types.Part.from_bytes(data=image_data, mime_type=mime_type),
-                ],
-            ),
-        ]
-
-        resp = self.client.models.generate_content(
-            model=self.caption_model,
-            contents=contents,
-        )
+        if self.caption_cache is not None:
+            cache_key = make_key(digest)
+        if cache is not None:
+            cached_caption = cache.get(cache_key)
+            if cached_caption:
+                return {"caption": cached_caption, "cached": True}
+            # same picture re-encoded, resized or converted: reuse its caption
+            cached_caption, near_duplicate_of = self._near_duplicate_hit(
+                cache, image_path, digest, image_data, make_key
+            )
+            if cached_caption:
+                cache.set(cache_key, cached_caption)
+                return {"caption": cached_caption, "cached": True, "near_duplicate_of": near_duplicate_of}
+
+        with self._flight("caption", (self.caption_model, digest, platform, tone), use_cache) as flight:
+            if flight is not None and not flight.leader:
+                # the same image and tone is being captioned right now: share its caption
+                return {"caption": flight.result, "cached": False, "coalesced": True}
+
+            image_data, mime_type = self._model_input(image_path, "caption", image_data)
+
+            prompt = (
+                f"Analyze this image and write an {tone} caption optimized for {platform}.\n"
+                "- 1–2 short sentences max.\n"
+                "- Include 3–5 relevant hashtags at the end.\n"
+                "- Encourage engagement without sounding spammy.\n"
+                "Only return the caption text."
+            )
+
+            from google.genai import types
+
+            contents = [
+                types.Content(
+                    role="user",
+                    parts=[
+                        types.Part.from_text(text=prompt),
+                        types.Part.from_bytes(data=image_data, mime_type=mime_type),
+                    ],
+                ),
+            ]
+
+            resp = self._call_caption_model(contents)
+
+            # Robustly extract text
+            text = getattr(resp, "text", None)
+            if not text:
+                chunks = []
+                for cand in (resp.candidates or []):
+                    if cand.content and cand.content.parts:
+                        for p in cand.content.parts:
+                            if hasattr(p, "text") and p.text:
+                                chunks.append(p.text)
+                text = "".join(chunks).strip()
+
+            if text and cache_key is not None:
+                # a bypassing call still refreshes the entry for later lookups
+                self.caption_cache.set(cache_key, text)
+
+            caption = text or "Captured the moment beautifully. ✨ #photography #aesthetics #moments #inspo"
+            if flight is not None:
+                flight.resolve(caption)
+            return {"caption": caption, "cached": False}
+
+    def _call_caption_model(self, contents):
+        """One logical caption call: retries, and a hedged duplicate if the policy asks for it."""
+        policy = self.call_policy
+        deadline = policy.deadline("caption")
+        started = time.monotonic()
+        hedge_after = policy.hedge_delay("caption") if policy.hedge_captions else None
+        try:
+            if hedge_after is None:
+                resp = self._caption_attempts(contents, deadline)
+            else:
+                resp = self._hedged_caption(contents, deadline, hedge_after)
+        except Exception as e:
+            policy.count("caption", "timeouts" if isinstance(e, CallTimeoutError) else "failed")
+            raise
+        policy.record("caption", time.monotonic() - started)
+        return resp
+
+    def _caption_attempts(self, contents, deadline):
+        attempt = 0
+        while True:
+            try:
+                with self._track_call("caption"), self._request_timeout(deadline):
+                    return self.client.models.generate_content(
+                        model=self.caption_model,
+                        contents=contents,
+                    )
+            except Exception as e:
+                self._before_retry("caption", e, attempt, deadline)
+                attempt += 1
+
+    def _hedged_caption(self, contents, deadline, hedge_after):
+        # captions are idempotent: if the first request is slow, race a second one
+        primary = _hedge_pool.submit(self._caption_attempts, contents, deadline)
+        if wait([primary], timeout=hedge_after).done:
+            return primary.result()
+
+        self.call_policy.count("caption", "hedged")
+        hedge = _hedge_pool.submit(self._caption_attempts, contents, deadline)
+        error = None
+        try:
+            for future in as_completed([primary, hedge], timeout=max(0.0, deadline - time.monotonic())):
+                try:
+                    resp = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    self.call_policy.count("caption", "hedge_wins")
+                return resp
+        except FuturesTimeoutError:
+            raise CallTimeoutError("Caption model call exceeded its deadline")
+        raise error
+
+    def _flight(self, kind, key, enabled=True):
+        """
+        SingleFlight context for one logical model call; None (no coalescing) without a
+        SingleFlight or when the caller asked for a fresh result (use_cache=False).
+        """
+        if self.single_flight is None or not enabled:
+            return nullcontext()
+        return self.single_flight.flight(kind, key)
+
+    def _near_duplicate_hit(self, cache, image_path, digest, image_data, make_key, validate=None):
+        """
+        After an exact cache miss, try the entries of visually identical images: those whose
+        dHash is within similarity_distance bits and whose colours and aspect ratio match too
+        (dHash is grayscale). Returns (value, their file id) or (None, None).
+        """
+        if self.similarity is None or not self.similarity_distance or self.file_index is None:
+            return None, None
+        file_id = os.path.basename(image_path)
+        value = self.similarity.hash_file(file_id, image_path, digest, data=image_data)
+        if value is None or not is_informative(value):
+            return None, None
+        signature = None
+        for _, other_id, other_digest in self.similarity.query(value, self.similarity_distance, limit=8,
+                                                                exclude=file_id):
+            if not other_digest or other_digest == digest:
+                continue
+            hit = cache.get(make_key(other_digest), validate=validate, record_stats=False)
+            if not hit:
+                continue
+            try:
+                signature = signature or colour_signature(image_path, image_data)
+                entry = self.file_index.get(other_id)
+                if entry is not None and same_colours(signature, colour_signature(self.file_index.path_of(entry))):
+                    return hit, other_id
+            except Exception as e:
+                logging.info(f"Cannot compare colours of {file_id} and {other_id}: {str(e)}")
+        return None, None
+
+    def _before_retry(self, kind, error, attempt, deadline):
+        """Sleep before the next attempt, or re-raise error if it shouldn't be retried."""
+        timeout = _as_call_timeout(error)
+        delay = self.call_policy.retry_delay(timeout or error, attempt, deadline)
+        if delay is None:
+            if timeout is not None:
+                raise timeout from error
+            raise error
+        logging.warning(f"Retrying {kind} model call in {delay:.2f}s after: {str(error)}")
+        self.call_policy.count(kind, "retries")
+        time.sleep(delay)
+
+    @contextmanager
+    def _request_timeout(self, deadline):
+        # picked up by the pooled transport for requests sent from this thread
+        self._request_options.timeout = self.call_policy.socket_timeout(deadline)
+        try:
+            yield
+        finally:
+            self._request_options.timeout = None
 
-        # Robustly extract text
-        text = getattr(resp, "text", None)
-        if not text:
-            chunks = []
-            for cand in (resp.candidates or []):
-                if cand.content and cand.content.parts:
-                    for p in cand.content.parts:
-                        if hasattr(p, "text") and p.text:
-                            chunks.append(p.text)
-            text = "".join(chunks).strip()
+    def _model_input(self, image_path, operation, image_data=None):
+        """(bytes, mime type) of an input image, downscaled/re-encoded when a preprocessor is set."""
+        if self.preprocessor is not None:
+            return self.preprocessor.prepare(image_path, operation, image_data)
+        if image_data is None:
+            with open(image_path, "rb") as f:
+                image_data = f.read()
+        return image_data, mimetypes.guess_type(image_path)[0] or "image/png"
 
-        return text or "Captured the moment beautifully. ✨ #photography #aesthetics #moments #inspo"
+    def _save_generated_image(self, file_name, data, mime_type):
+        """Store a model-produced image (re-encoded if the encoder says so); returns its path."""
+        if self.encoder is not None:
+            data, mime_type = self.encoder.encode_generated(data, mime_type)
+        file_extension = mimetypes.guess_extension(mime_type or "") or ".png"
+        file_path = os.path.join(self.generated_folder, f"{file_name}{file_extension}")
+        digest = self._save_binary_file(file_path, data)
+        if self.similarity is not None:
+            self.similarity.submit(os.path.basename(file_path), file_path, digest)
+        return file_path
 
     def _save_binary_file(self, file_path, data):
-        with open(file_path, "wb") as f:
-            f.write(data)
-        print(f"File saved to: {file_path}")
+        # write-then-rename: readers never observe a partially written image
+        tmp_path = f"{file_path}.part"
+        with stage_timer("gemini", "write"):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        digest = hashlib.sha256(data).hexdigest()
+        if self.storage is not None:
+            self.storage.save("generated", file_path)
+        if self.file_index is not None:
+            self.file_index.add("generated", file_path, etag=digest)
+        logging.info(f"File saved to: {file_path}")
+        return digest
@@ -1,53 +1,290 @@
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import math
 import os
+import threading
 import uuid
+from services.encoder import ImageEncoder
+from services.metrics import stage_timer
+from services.storage import LocalStorage
+from utils.file_utils import content_path, file_sha256, is_content_id, write_stream_hashed
+from utils.upload_stream import sniff_image_type
+
+PLATFORM_SIZES = {
+    "instagram": (1080, 1080),
+    "facebook": (1200, 630),
+    "twitter": (1200, 675),
+    "linkedin": (1200, 627)
+}
+DEFAULT_SIZE = (1080, 1080)
+
+RENDITION_FILTER = "lanczos"
+RESAMPLE_FILTERS = {"lanczos": "LANCZOS"}  # names in PIL.Image.Resampling
+
+# Shared across requests; resampling and encoding release the GIL
+_render_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='render')
+
+# Upload validation reads at most this much of the body before deciding
+HEADER_PROBE_BYTES = 64 * 1024
+HEADER_PROBE_STEP = 4 * 1024
+PIL_FORMATS = {"png": "PNG", "jpg": "JPEG", "gif": "GIF", "webp": "WEBP"}
+
+# (abs path, size, mtime_ns) -> sha256 of sources that aren't content-addressed
+_digest_memo = {}
+# generated folder -> tracked bytes of its renditions
+_folder_usage = {}
+_usage_lock = threading.Lock()
+
+
+class InvalidImageError(ValueError):
+    """Upload rejected from its header: not an accepted image, or too many pixels."""
+
 
 class ImageService:
-    def __init__(self, upload_folder, generated_folder):
+    def __init__(self, upload_folder, generated_folder, max_generated_bytes=None, file_index=None,
+                 storage=None, max_upload_side=None, max_upload_pixels=None, encoder=None, similarity=None):
         self.upload_folder = upload_folder
         self.generated_folder = generated_folder
+        self.max_generated_bytes = max_generated_bytes  # rendition eviction cap, None = unbounded
+        self.file_index = file_index                    # optional FileIndex, told about new files
+        self.storage = storage or LocalStorage({'uploads': upload_folder, 'generated': generated_folder})
+        self.max_upload_side = max_upload_side      # per-dimension cap checked from the header
+        self.max_upload_pixels = max_upload_pixels  # width * height cap checked from the header
+        self.encoder = encoder or ImageEncoder()    # rendition format and quality
+        self.similarity = similarity                # optional PerceptualIndex, told about new uploads
     
     def save_uploaded_image(self, file):
-        """Save uploaded image and return file path"""
+        """
+        Save uploaded image into the content-addressed store and return its path.
+        Identical uploads resolve to the same blob: uploads/<ab>/<cd>/<sha256><ext>.
+        The basename doubles as the stable image id accepted by other routes.
+        """
         if file and self._allowed_file(file.filename):
-            filename = f"upload_{uuid.uuid4()}_{file.filename}"
-            file_path = os.path.join(self.upload_folder, filename)
-            file.save(file_path)
-            return file_path
+            return self.save_upload_stream(file.stream)
         return None
+
+    def save_upload_stream(self, stream):
+        """
+        Validate and store an upload read from a file-like stream, in fixed-size chunks.
+        Only the leading bytes are inspected (magic number, then the Pillow header) and
+        InvalidImageError is raised before the rest of the body is read. The extension
+        comes from the detected format, not the client's filename.
+        """
+        with stage_timer('image_service', 'probe'):
+            head, ext = self._probe_header(stream)
+        with stage_timer('image_service', 'store'):
+            tmp_path, digest, _ = write_stream_hashed(stream, self.upload_folder, prefix=head)
+        image_id = f"{digest}.{ext}"
+        file_path = content_path(self.upload_folder, image_id)
+
+        if os.path.exists(file_path):
+            # Already stored: drop the duplicate bytes and mark the blob as used, so the
+            # janitor doesn't expire the file this client was just given
+            os.remove(tmp_path)
+            os.utime(file_path)
+            if self.file_index is not None:
+                self.file_index.touch(image_id)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp_path, file_path)
+            self.storage.save('uploads', file_path, immutable=True)
+            if self.file_index is not None:
+                self.file_index.add('uploads', file_path, etag=digest)
+        if self.similarity is not None:
+            self.similarity.submit(image_id, file_path, digest)
+        return file_path
     
+    def _probe_header(self, stream):
+        """Read just enough of stream to identify the image; returns (bytes read, extension)."""
+        from PIL import Image  # Pillow is imported on first use, not when the app starts
+
+        head = stream.read(HEADER_PROBE_STEP)
+        ext = sniff_image_type(head)
+        if ext is None:
+            raise InvalidImageError("Unsupported or corrupt image file")
+
+        while True:
+            try:
+                # header only: Image.open does not decode pixels
+                with Image.open(io.BytesIO(head), formats=[PIL_FORMATS[ext]]) as img:
+                    width, height = img.size
+                break
+            except Image.DecompressionBombError as e:
+                raise InvalidImageError(str(e))
+            except Exception:
+                # e.g. a JPEG whose size marker sits after a large EXIF block
+                chunk = stream.read(HEADER_PROBE_STEP) if len(head) < HEADER_PROBE_BYTES else b''
+                if not chunk:
+                    raise InvalidImageError("Unsupported or corrupt image file")
+                head += chunk
+
+        if self.max_upload_side and max(width, height) > self.max_upload_side:
+            raise InvalidImageError(f"Image is {width}x{height}; the maximum side is {self.max_upload_side} px")
+        if self.max_upload_pixels and width * height > self.max_upload_pixels:
+            raise InvalidImageError(f"Image is {width}x{height}; the maximum is {self.max_upload_pixels} pixels")
+        return head, ext
+
     def resize_for_social_media(self, image_path, platform="instagram"):
         """Resize image for specific social media platform"""
-        sizes = {
-            "instagram": (1080, 1080),
-            "facebook": (1200, 630),
-            "twitter": (1200, 675),
-            "linkedin": (1200, 627)
-        }
-        
-        size = sizes.get(platform, (1080, 1080))
-        
-        with Image.open(image_path) as img:
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize maintaining aspect ratio
-            img.thumbnail(size, Image.Resampling.LANCZOS)
-            
+        size = PLATFORM_SIZES.get(platform, DEFAULT_SIZE)
+        return self._render_sizes(image_path, {platform: size})[platform]
+
+    def resize_for_platforms(self, image_path, platforms):
+        """
+        Resize image for several platforms at once; returns {platform: output path}.
+        The source is decoded a single time and every rendition is built from it.
+        """
+        sizes = {platform: PLATFORM_SIZES[platform] for platform in platforms}
+        return self._render_sizes(image_path, sizes)
+
+    def _render_sizes(self, image_path, sizes):
+        # Renditions are named after (source digest, size, encoding, filter), so an
+        # existing file is the cached result and is returned without decoding.
+        digest = self._source_digest(image_path)
+        outputs, missing = {}, {}
+        for platform, size in sizes.items():
+            output_path = os.path.join(self.generated_folder, self._rendition_name(digest, size))
+            if self.storage.ensure_local(output_path):
+                os.utime(output_path)  # recency for LRU eviction
+                outputs[platform] = output_path
+            else:
+                missing[platform] = (size, output_path)
+
+        if missing:
+            from PIL import Image
+
+            with Image.open(image_path) as img:
+                with stage_timer('image_service', 'decode'):
+                    img = self._decode_for_targets(img, [size for size, _ in missing.values()])
+
+                # Pillow releases the GIL while resampling and encoding, so renditions run in parallel
+                futures = {
+                    platform: _render_pool.submit(self._render_rendition, img, size, output_path)
+                    for platform, (size, output_path) in missing.items()
+                }
+                for platform, future in futures.items():
+                    outputs[platform] = future.result()
+            self._enforce_generated_quota([outputs[platform] for platform in missing])
+
+        return {platform: outputs[platform] for platform in sizes}
+
+    def _source_digest(self, image_path):
+        name = os.path.basename(image_path)
+        if is_content_id(name):
+            return name.split('.', 1)[0]
+
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        digest = _digest_memo.get(key)
+        if digest is None:
+            digest = file_sha256(image_path)
+            if len(_digest_memo) >= 4096:
+                _digest_memo.clear()
+            _digest_memo[key] = digest
+        return digest
+
+    def _rendition_name(self, digest, size):
+        encoder = self.encoder
+        return (f"resized_{digest[:32]}_{size[0]}x{size[1]}_{encoder.rendition_tag()}_{RENDITION_FILTER}"
+                f"{encoder.rendition_extension()}")
+
+    def _decode_for_targets(self, img, target_sizes):
+        """
+        Decode just enough pixels for the largest target.
+        JPEG sources are DCT-scaled by draft(); everything is then shrunk by an integer
+        reduce() while keeping at least 2x the largest target for the final LANCZOS pass.
+        """
+        # thumbnail() never upscales, so the largest scale any target needs is at most 1
+        scale = min(1.0, max(min(w / img.width, h / img.height) for w, h in target_sizes))
+        needed = (max(1, math.ceil(img.width * scale)), max(1, math.ceil(img.height * scale)))
+
+        if img.format == 'JPEG':
+            img.draft('RGB', needed)
+
+        # Convert to RGB if necessary
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        else:
+            img.load()
+
+        factor = min(img.width // (needed[0] * 2), img.height // (needed[1] * 2))
+        if factor >= 2:
+            img = img.reduce(factor)
+        return img
+
+    def _render_rendition(self, img, size, output_path):
+        from PIL import Image
+
+        with stage_timer('image_service', 'resize'):
+            # Resize maintaining aspect ratio (resize() leaves the shared source untouched)
+            scale = min(size[0] / img.width, size[1] / img.height, 1.0)
+            fitted = img.resize(
+                (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                getattr(Image.Resampling, RESAMPLE_FILTERS[RENDITION_FILTER]),
+            )
+
             # Create new image with exact dimensions and paste centered
             new_img = Image.new('RGB', size, (255, 255, 255))
-            paste_x = (size[0] - img.width) // 2
-            paste_y = (size[1] - img.height) // 2
-            new_img.paste(img, (paste_x, paste_y))
-            
-            # Save resized image
-            filename = f"resized_{uuid.uuid4()}.jpg"
-            output_path = os.path.join(self.generated_folder, filename)
-            new_img.save(output_path, 'JPEG', quality=90)
-            
-            return output_path
-    
+            paste_x = (size[0] - fitted.width) // 2
+            paste_y = (size[1] - fitted.height) // 2
+            new_img.paste(fitted, (paste_x, paste_y))
+
+        with stage_timer('image_service', 'encode'):
+            data = self.encoder.encode(new_img, self.encoder.rendition_format)
+
+        # Save resized image; write-then-rename so concurrent readers never see a partial file
+        with stage_timer('image_service', 'save'):
+            tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, output_path)
+            self.storage.save('generated', output_path, immutable=True)
+            if self.file_index is not None:
+                self.file_index.add('generated', output_path)
+
+        return output_path
+
+    def _enforce_generated_quota(self, new_files):
+        """
+        Evict least recently used renditions once they exceed the cap. Only resized_*
+        renditions count towards it: model output can't be rebuilt, so it is never evicted.
+        """
+        if not self.max_generated_bytes:
+            return
+        folder = os.path.abspath(self.generated_folder)
+        new_files = {os.path.abspath(path) for path in new_files}  # scandir below yields absolute paths
+        with _usage_lock:
+            if folder not in _folder_usage:
+                _folder_usage[folder] = sum(st.st_size for _, st in self._renditions(folder))
+            else:
+                _folder_usage[folder] += sum(os.path.getsize(path) for path in new_files)
+
+            if _folder_usage[folder] <= self.max_generated_bytes:
+                return
+
+            renditions = self._renditions(folder)
+            usage = sum(st.st_size for _, st in renditions)
+            candidates = sorted((st.st_mtime, st.st_size, path) for path, st in renditions if path not in new_files)
+            target = self.max_generated_bytes * 0.9
+            for _, size, path in candidates:
+                if usage <= target:
+                    break
+                try:
+                    self.storage.evict('generated', os.path.relpath(path, folder))
+                except OSError as e:
+                    logging.error(f"Could not evict rendition {path}: {str(e)}")
+                    continue
+                usage -= size
+                if self.file_index is not None:
+                    self.file_index.remove(os.path.basename(path))
+            _folder_usage[folder] = usage
+
+    @staticmethod
+    def _renditions(folder):
+        return [(entry.path, entry.stat()) for entry in os.scandir(folder)
+                if entry.is_file() and entry.name.startswith('resized_')]
+
     def _allowed_file(self, filename):
         """Check if file extension is allowed"""
         allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
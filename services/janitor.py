@@ -0,0 +1,185 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from services.storage import LocalStorage
+
+
+class InFlightRegistry:
+    """
+    Reference counts of files that running requests are reading; the janitor skips them.
+    With a shared state the counts are also kept there, so a janitor in any worker
+    process sees them; hold_ttl bounds how long a crashed process's holds survive.
+    """
+    def __init__(self, state=None, hold_ttl=3600):
+        self.state = state
+        self.hold_ttl = hold_ttl
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, *paths):
+        keys = [os.path.abspath(path) for path in paths]
+        with self._lock:
+            self._counts.update(keys)
+        self._update_shared(keys, 1)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._counts.subtract(keys)
+                for key in keys:
+                    if self._counts[key] <= 0:
+                        del self._counts[key]
+            self._update_shared(keys, -1)
+
+    def paths(self):
+        with self._lock:
+            return set(self._counts)
+
+    def is_held(self, path):
+        """True if a request in this or (with a shared state) any other worker is reading path."""
+        key = os.path.abspath(path)
+        with self._lock:
+            if self._counts[key] > 0:
+                return True
+        if self.state is None:
+            return False
+        try:
+            return int(self.state.get(f"in_flight:{key}") or 0) > 0
+        except Exception as e:
+            logging.error(f"Shared state unavailable, treating {path} as in use: {str(e)}")
+            return True
+
+    def _update_shared(self, keys, amount):
+        if self.state is None:
+            return
+        for key in keys:
+            try:
+                self.state.incr(f"in_flight:{key}", amount, ttl=self.hold_ttl)
+            except Exception as e:
+                logging.error(f"Could not share in-flight marker for {key}: {str(e)}")
+
+
+class StorageJanitor(threading.Thread):
+    """
+    Background garbage collector for the upload and generated folders.
+
+    policies maps a file index folder key to {"ttl": seconds, "quota": bytes} (0 disables
+    either). Files are visited least recently accessed first: expired files are deleted,
+    then more are deleted while the folder is above its quota. Files held in in_flight or
+    returned by referenced_paths() (e.g. inputs of queued jobs) are never deleted. Only local
+    copies are deleted; a remote backend's objects are left to its own lifecycle rules,
+    since other nodes may still serve them. With a shared state, passes take a lease so
+    only one worker process sweeps at a time.
+    """
+    def __init__(self, file_index, policies, interval=300, in_flight=None, referenced_paths=None, state=None,
+                 storage=None):
+        super().__init__(name='storage-janitor', daemon=True)
+        self.file_index = file_index
+        self.storage = storage or LocalStorage(file_index.folders)
+        self.policies = policies
+        self.interval = interval
+        self.in_flight = in_flight
+        self.referenced_paths = referenced_paths
+        self.state = state
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.skipped_passes = 0  # passes left to the worker holding the lease
+        self.last_report = None
+        self.total_bytes_reclaimed = 0
+        self.total_files_deleted = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self._has_lease():
+                    self.collect()
+                else:
+                    self.skipped_passes += 1
+            except Exception as e:
+                logging.error(f"Storage janitor pass failed: {str(e)}", exc_info=True)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _has_lease(self):
+        if self.state is None:
+            return True
+        # renewed every pass; lapses within two intervals once its worker stops
+        return self.state.acquire_lease('janitor', self.owner, ttl=self.interval * 2)
+
+    def collect(self):
+        """Run one pass; returns (and keeps) a report of what was reclaimed."""
+        started = time.perf_counter()
+        self.file_index.refresh()
+
+        protected = set()
+        if self.referenced_paths:
+            protected |= {os.path.abspath(path) for path in self.referenced_paths()}
+
+        now = time.time()
+        report = {'folders': {}, 'bytes_reclaimed': 0, 'files_deleted': 0}
+        for folder, policy in self.policies.items():
+            ttl, quota = policy.get('ttl', 0), policy.get('quota', 0)
+            entries = sorted(self.file_index.snapshot(folder),
+                             key=lambda item: item[1].get('accessed', item[1]['mtime']))
+            usage = sum(entry['size'] for _, entry in entries)
+            folder_report = {'bytes_before': usage, 'bytes_reclaimed': 0, 'files_deleted': 0,
+                             'skipped_in_flight': 0, 'skipped_recent': 0}
+
+            for file_id, entry in entries:
+                accessed = entry.get('accessed', entry['mtime'])
+                expired = ttl and now - accessed > ttl
+                over_quota = quota and usage > quota
+                if not expired and not over_quota:
+                    break  # everything after this was accessed more recently
+
+                latest = self.file_index.last_access(file_id, entry)
+                if latest > accessed and not (ttl and now - latest > ttl):
+                    # read since by another worker: no longer among the least recently used
+                    folder_report['skipped_recent'] += 1
+                    continue
+
+                path = self.file_index.path_of(entry)
+                if os.path.abspath(path) in protected or (self.in_flight and self.in_flight.is_held(path)):
+                    folder_report['skipped_in_flight'] += 1
+                    continue
+                try:
+                    self.storage.evict(folder, entry['relpath'])
+                except OSError as e:
+                    logging.error(f"Janitor could not delete {path}: {str(e)}")
+                    continue
+                self.file_index.remove(file_id)
+                usage -= entry['size']
+                folder_report['bytes_reclaimed'] += entry['size']
+                folder_report['files_deleted'] += 1
+
+            folder_report['bytes_after'] = usage
+            report['folders'][folder] = folder_report
+            report['bytes_reclaimed'] += folder_report['bytes_reclaimed']
+            report['files_deleted'] += folder_report['files_deleted']
+
+        report['scan_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        report['finished_at'] = time.time()
+        self.total_bytes_reclaimed += report['bytes_reclaimed']
+        self.total_files_deleted += report['files_deleted']
+        self.last_report = report
+        logging.info(
+            f"Storage janitor reclaimed {report['bytes_reclaimed']} bytes "
+            f"({report['files_deleted']} files) in {report['scan_ms']} ms"
+        )
+        return report
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'policies': self.policies,
+            'total_bytes_reclaimed': self.total_bytes_reclaimed,
+            'total_files_deleted': self.total_files_deleted,
+            'skipped_passes': self.skipped_passes,
+            'last_report': self.last_report,
+        }
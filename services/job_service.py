@@ -0,0 +1,294 @@
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+_shared_queue_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds max_pending unfinished jobs."""
+
+
+class InvalidCallbackError(ValueError):
+    """callback_url is not an http(s) URL, or (unless allowed) its host is not a public address."""
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect could point the callback at a host check_callback_url would have refused
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def check_callback_url(url, allow_private=False):
+    """
+    Raise InvalidCallbackError unless url is http(s). Unless allow_private, every address
+    the host resolves to must also be globally routable: no loopback, link-local (cloud
+    metadata), private or reserved ranges.
+    """
+    if not isinstance(url, str):
+        raise InvalidCallbackError('callback_url must be a string')
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError:
+        raise InvalidCallbackError('callback_url is not a valid URL')
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise InvalidCallbackError('callback_url must be an http or https URL')
+    if allow_private:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        raise InvalidCallbackError(f"callback_url host {parts.hostname} cannot be resolved")
+    for raw in addresses:
+        address = ipaddress.ip_address(raw.split('%', 1)[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise InvalidCallbackError(f"callback_url host {parts.hostname} is not a public address")
+
+
+def get_job_queue(app):
+    """Return this worker's JobQueue, creating it (and resuming pending jobs) on first use."""
+    # worker threads push their own app context, so they need the app, not current_app
+    app = app._get_current_object() if hasattr(app, '_get_current_object') else app
+    queue = app.extensions.get('job_queue')
+    if queue is not None and queue.pid == os.getpid():
+        return queue
+
+    with _shared_queue_lock:
+        queue = app.extensions.get('job_queue')
+        if queue is None or queue.pid != os.getpid():
+            queue = JobQueue(
+                db_path=os.path.join(app.config['STATE_FOLDER'], 'jobs.sqlite3'),
+                handlers=app.config['JOB_HANDLERS'],
+                max_workers=app.config.get('JOB_WORKERS', 4),
+                max_pending=app.config.get('JOB_MAX_PENDING', 100),
+                lease_ttl=app.config.get('JOB_LEASE_TTL', 30),
+                allow_private_callbacks=app.config.get('JOB_CALLBACK_ALLOW_PRIVATE', False),
+                app=app,
+            )
+            queue.resume()
+            app.extensions['job_queue'] = queue
+    return queue
+
+
+class JobQueue:
+    """
+    Persistent job table (SQLite) drained by a bounded thread pool.
+    handlers maps a job kind to a callable(params) -> JSON-serializable result.
+    A running job is leased to the queue that claimed it: each queue has its own owner
+    token and renews its jobs' heartbeat_at every lease_ttl / 3 seconds. Jobs whose
+    heartbeat is older than lease_ttl (worker crashed, container restarted) are requeued.
+    """
+    def __init__(self, db_path, handlers, max_workers=4, max_pending=100,
+                 callback_timeout=10, allow_private_callbacks=False, app=None, lease_ttl=30):
+        self.db_path = db_path
+        self.handlers = handlers
+        self.max_pending = max_pending
+        self.lease_ttl = lease_ttl
+        self.owner = uuid.uuid4().hex  # new per process start, unlike pids which repeat across restarts
+        self.callback_timeout = callback_timeout
+        self.allow_private_callbacks = allow_private_callbacks  # e.g. a webhook receiver on localhost
+        self.app = app
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._init_db()
+        self._stopped = threading.Event()
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+
+    @contextmanager
+    def _connect(self):
+        """Connection that commits on success and is always closed."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    callback_url TEXT,
+                    owner_pid INTEGER,
+                    owner TEXT,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, kind in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    try:
+                        conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+                    except sqlite3.OperationalError as e:
+                        if 'duplicate column' not in str(e):  # another worker migrated first
+                            raise
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    def submit(self, kind, params, callback_url=None):
+        """Persist a job and schedule it; returns the job id. A bad callback_url raises InvalidCallbackError."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if callback_url:
+            check_callback_url(callback_url, self.allow_private_callbacks)
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError('Job queue is full, try again later')
+            conn.execute(
+                'INSERT INTO jobs (id, kind, params, status, callback_url, created_at) '
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(params), callback_url, time.time()),
+            )
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def resume(self):
+        """Requeue jobs left queued, or running under an expired lease, by a previous run."""
+        with self._connect() as conn:
+            self._requeue_expired(conn)
+            job_ids = [row['id'] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            )]
+        for job_id in job_ids:
+            self._executor.submit(self._run, job_id)
+
+    def stop(self):
+        """Stop heartbeating; this queue's running jobs are requeued elsewhere once their lease expires."""
+        self._stopped.set()
+
+    def _requeue_expired(self, conn):
+        # owner IS NULL: claimed before leases existed, by a process that is gone after the upgrade
+        return conn.execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, owner_pid = NULL "
+            "WHERE status = 'running' AND (owner IS NULL OR heartbeat_at IS NULL OR heartbeat_at < ?)",
+            (time.time() - self.lease_ttl,),
+        ).rowcount
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.lease_ttl / 3):
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'running'",
+                        (time.time(), self.owner),
+                    )
+                    requeued = self._requeue_expired(conn)
+                if requeued:
+                    # another worker died mid-job; pick its work up here
+                    logging.warning(f"Requeued {requeued} job(s) whose worker stopped heartbeating")
+                    self.resume()
+            except Exception as e:
+                logging.error(f"Job heartbeat failed: {str(e)}")
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def referenced_paths(self):
+        """Input image paths of unfinished jobs, which must not be garbage collected."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT params FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        paths = (json.loads(row['params']).get('image_path') for row in rows)
+        return [path for path in paths if path]
+
+    def _run(self, job_id):
+        # Claim atomically so that several workers resuming the same table don't double-run
+        now = time.time()
+        with self._connect() as conn:
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, owner_pid = ?, heartbeat_at = ?, started_at = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (self.owner, os.getpid(), now, now, job_id),
+            ).rowcount
+            row = conn.execute('SELECT kind, params FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if not claimed:
+            return
+
+        try:
+            handler = self.handlers[row['kind']]
+            params = json.loads(row['params'])
+            if self.app is not None:
+                with self.app.app_context():
+                    result = handler(params)
+            else:
+                result = handler(params)
+            status, result_json, error = 'succeeded', json.dumps(result), None
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+            status, result_json, error = 'failed', None, str(e)
+
+        with self._connect() as conn:
+            # our lease may have expired meanwhile (e.g. a long stall); the job then belongs to its new owner
+            finished = conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND owner = ?',
+                (status, result_json, error, time.time(), job_id, self.owner),
+            ).rowcount
+        if finished:
+            self._notify(job_id)
+
+    def _notify(self, job_id):
+        job = self.get(job_id)
+        if not job or not job['callback_url']:
+            return
+        body = json.dumps(job).encode('utf-8')
+        req = urllib.request.Request(
+            job['callback_url'], data=body, headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            # checked again: the host may resolve differently than at submit time
+            check_callback_url(job['callback_url'], self.allow_private_callbacks)
+            with _callback_opener.open(req, timeout=self.callback_timeout):
+                pass
+        except Exception as e:
+            logging.error(f"Callback for job {job_id} to {job['callback_url']} failed: {str(e)}")
+
+    def _to_dict(self, row):
+        created, started, finished = row['created_at'], row['started_at'], row['finished_at']
+        return {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'callback_url': row['callback_url'],
+            'timing': {
+                'created_at': created,
+                'started_at': started,
+                'finished_at': finished,
+                'queue_ms': round((started - created) * 1000, 1) if started else None,
+                'run_ms': round((finished - started) * 1000, 1) if started and finished else None,
+            },
+        }
+
@@ -0,0 +1,146 @@
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from utils.file_utils import is_content_id
+
+INPUT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+# formats the model reads directly, so an image already small enough can be sent untouched
+PASSTHROUGH_FORMATS = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+# img.info keys of metadata blocks; their orientation must be applied and the rest dropped
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp")
+
+
+class ImagePreprocessor:
+    """
+    Prepares images before they are sent to the model: EXIF orientation is applied and
+    the metadata dropped, the longest side is capped per operation (e.g. smaller for
+    captions than for edits) and the result is re-encoded as WebP or JPEG.
+
+    An image that needs none of that (fits the cap, no EXIF block, a format the model
+    reads) is sent as its original bytes, as is one whose re-encode would not be smaller;
+    re-encoding those would only cost quality and CPU.
+
+    Re-encoded payloads are kept in a byte-bounded LRU keyed by source digest and
+    settings, so repeated edits and captions of the same upload skip the decode.
+    """
+    def __init__(self, max_sides=None, output_format="webp", quality=85, cache_bytes=64 * 1024 * 1024):
+        if output_format not in INPUT_FORMATS:
+            raise ValueError(f"Unsupported model input format: {output_format}")
+        self.max_sides = max_sides or {}  # operation -> max side in px, 0/missing = send as-is
+        self.output_format = output_format
+        self.quality = quality
+        self.cache_bytes = cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.passed_through = 0
+        self._entries = OrderedDict()  # (digest, max side, format, quality) -> (data, mime type)
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, image_path, operation, image_data=None):
+        """
+        Return (bytes, mime type) to send for image_path; image_data may carry bytes
+        the caller already read. Unreadable images are passed through unchanged.
+        """
+        max_side = self.max_sides.get(operation)
+        if not max_side:
+            if image_data is None:
+                with open(image_path, "rb") as f:
+                    image_data = f.read()
+            return image_data, mimetypes.guess_type(image_path)[0] or "image/png"
+
+        name = os.path.basename(image_path)
+        if is_content_id(name) and image_data is None:
+            digest = name.split(".", 1)[0]  # content-addressed: no need to read or hash
+        else:
+            if image_data is None:
+                with open(image_path, "rb") as f:
+                    image_data = f.read()
+            digest = hashlib.sha256(image_data).hexdigest()
+
+        key = (digest, max_side, self.output_format, self.quality)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        if image_data is None:
+            with open(image_path, "rb") as f:
+                image_data = f.read()
+        try:
+            result = self._encode(image_data, max_side)
+        except Exception:
+            # let the model see the original rather than failing the request here
+            return image_data, mimetypes.guess_type(image_path)[0] or "image/png"
+
+        with self._lock:
+            self.bytes_in += len(image_data)
+            self.bytes_out += len(result[0])
+            if result[0] is image_data:
+                self.passed_through += 1
+                return result  # nothing was computed; keep the cache for re-encodes
+            if key not in self._entries:
+                self._entries[key] = result
+                self._cached_bytes += len(result[0])
+            while self._cached_bytes > self.cache_bytes and self._entries:
+                _, (data, _) = self._entries.popitem(last=False)
+                self._cached_bytes -= len(data)
+        return result
+
+    def _encode(self, image_data, max_side):
+        from PIL import Image, ImageOps
+
+        pil_format, mime_type = INPUT_FORMATS[self.output_format]
+        with Image.open(io.BytesIO(image_data)) as img:
+            # without metadata blocks there is no orientation to apply and nothing to strip
+            has_metadata = any(key in img.info for key in METADATA_KEYS)
+            original_mime = None if has_metadata else PASSTHROUGH_FORMATS.get(img.format)
+            if original_mime and max(img.size) <= max_side:
+                return image_data, original_mime
+
+            if img.format == "JPEG":
+                # DCT-scale while decoding; orientation may swap the sides, so ask for a square
+                img.draft("RGB", (max_side, max_side))
+            img = ImageOps.exif_transpose(img)  # also drops the orientation tag
+
+            keeps_alpha = pil_format == "WEBP" and img.mode in ("RGBA", "LA", "P")
+            if keeps_alpha:
+                img = img.convert("RGBA")
+            elif img.mode in ("RGBA", "LA", "P"):
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+            # no exif/icc arguments: metadata is not carried over
+            buffer = io.BytesIO()
+            img.save(buffer, pil_format, quality=self.quality)
+        if original_mime and buffer.tell() >= len(image_data):
+            return image_data, original_mime
+        return buffer.getvalue(), mime_type
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_sides": self.max_sides,
+                "format": self.output_format,
+                "quality": self.quality,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "cached_bytes": self._cached_bytes,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "passed_through": self.passed_through,
+            }
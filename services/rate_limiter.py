@@ -0,0 +1,294 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class UpstreamBusyError(Exception):
+    """The model can't take this call now; retry_after is a hint in seconds for the client."""
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+    def payload(self):
+        """JSON body telling the client when to retry."""
+        return {'error': str(self), 'retry_after': self.retry_after}
+
+
+class UpstreamRateLimitedError(UpstreamBusyError):
+    """The upstream API answered 429 / RESOURCE_EXHAUSTED."""
+
+
+def is_rate_limit_error(error):
+    """True for a 429 from the genai SDK (or anything shaped like one, e.g. a fake client)."""
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return code == 429 or getattr(error, 'status', None) == 'RESOURCE_EXHAUSTED'
+
+
+def retry_after_hint(error, default):
+    """Seconds to back off after a 429: Retry-After header, then google.rpc.RetryInfo, then default."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        pass
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict):
+        for detail in details.get('error', details).get('details', []) or []:
+            delay = isinstance(detail, dict) and detail.get('retryDelay')
+            if isinstance(delay, str) and delay.endswith('s'):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return default
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to burst; paused entirely until blocked_until after a 429."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, now):
+        """Take a token and return how long to wait before using it."""
+        if not self.rate:
+            return max(0.0, self.blocked_until - now)
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket whose tokens and 429 pause live in the shared state, so rate and burst
+    budget all worker processes together. If the state is unreachable, a local bucket
+    takes over rather than failing model calls.
+    """
+    def __init__(self, state, key, rate, burst):
+        self.state = state
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self._local = TokenBucket(rate, burst)
+
+    @property
+    def blocked_until(self):
+        """time.monotonic() until which the upstream asked everyone to back off."""
+        try:
+            blocked = self.state.get(f"{self.key}:blocked_until")
+        except Exception as e:
+            logging.warning(f"Shared state unavailable, using local rate limit for {self.key}: {str(e)}")
+            return self._local.blocked_until
+        # stored as wall-clock time: monotonic clocks aren't comparable between processes
+        return max(self._local.blocked_until, float(blocked) - time.time() + time.monotonic() if blocked else 0.0)
+
+    @blocked_until.setter
+    def blocked_until(self, until):
+        self._local.blocked_until = until
+        remaining = until - time.monotonic()
+        if remaining > 0:
+            try:
+                self.state.set(f"{self.key}:blocked_until", time.time() + remaining, ttl=remaining)
+            except Exception as e:
+                logging.warning(f"Shared state unavailable, 429 pause for {self.key} kept local: {str(e)}")
+
+    def reserve(self, now):
+        try:
+            if not self.rate:
+                return max(0.0, self.blocked_until - now)
+            tokens = self.state.take_tokens(self.key, self.rate, self.burst)
+        except Exception as e:
+            logging.warning(f"Shared state unavailable, using local rate limit for {self.key}: {str(e)}")
+            return self._local.reserve(now)
+        wait = 0.0 if tokens >= 0 else -tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def refund(self):
+        if not self.rate:
+            return
+        try:
+            self.state.take_tokens(self.key, self.rate, self.burst, count=-1)
+        except Exception:
+            self._local.refund()
+
+
+class AdaptiveLimiter:
+    """
+    Admission control for one upstream key (a model): a token bucket caps the request
+    rate and an AIMD limit caps concurrency. The limit grows by ~1 per limit's worth of
+    calls that finish within latency_tolerance x the average latency, shrinks by 10% on
+    slower ones and halves on a 429, which also pauses the bucket for the server's
+    retry hint. Callers wait at most max_wait, with at most max_queue waiting; beyond
+    that acquire() raises UpstreamBusyError right away. With a shared state the bucket
+    (rate budget and 429 pause) is shared by all workers; the concurrency limit stays
+    per process.
+    """
+    def __init__(self, name, rate=0, burst=1, initial_limit=4, min_limit=1, max_limit=32,
+                 max_queue=50, max_wait=10.0, latency_tolerance=2.0, state=None):
+        self.name = name
+        self.bucket = (SharedTokenBucket(state, f"limiter:{name}", rate, max(1, burst)) if state is not None
+                       else TokenBucket(rate, max(1, burst)))
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline_latency = None  # EWMA of successful call latency, seconds
+        self.counters = {'admitted': 0, 'rejected': 0, 'succeeded': 0, 'failed': 0, 'rate_limited': 0}
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def acquire(self):
+        self._admit()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limit_error(e):
+                retry_after = self._on_rate_limited(retry_after_hint(e, default=5))
+                raise UpstreamRateLimitedError(
+                    f"{self.name} is rate limited upstream", retry_after=retry_after
+                ) from e
+            self._release(failed=True)
+            raise
+        except BaseException:
+            self._release()  # abandoned (e.g. a closed stream): free the slot, learn nothing
+            raise
+        else:
+            self._release(latency=time.monotonic() - started)
+
+    def _admit(self):
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            busy = self._take_slot(deadline)
+        if busy:
+            raise UpstreamBusyError(busy, self._retry_hint())
+
+        # A shared bucket is a state round trip (SQLite BEGIN IMMEDIATE or Redis), so the token
+        # is taken without the condition; other callers keep releasing and queueing meanwhile.
+        now = time.monotonic()
+        wait = self.bucket.reserve(now)
+        if now + wait > deadline:
+            self.bucket.refund()
+            with self._cond:
+                self.in_flight -= 1
+                self.counters['rejected'] += 1
+                self._cond.notify()
+            raise UpstreamBusyError(f"Rate limit reached for {self.name}", wait)
+        with self._cond:
+            self.counters['admitted'] += 1
+
+        if wait > 0:
+            time.sleep(wait)  # our token becomes valid; the concurrency slot is already held
+
+    def _take_slot(self, deadline):
+        """Hold a concurrency slot, or return why the caller is turned away (caller holds _cond)."""
+        if self.waiting >= self.max_queue:
+            self.counters['rejected'] += 1
+            return f"Too many requests waiting for {self.name}"
+
+        self.waiting += 1
+        try:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['rejected'] += 1
+                    return f"Timed out waiting for {self.name}"
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return None
+        finally:
+            self.waiting -= 1
+
+    def _release(self, latency=None, failed=False):
+        with self._cond:
+            self.in_flight -= 1
+            if failed:
+                self.counters['failed'] += 1
+            elif latency is not None:
+                self.counters['succeeded'] += 1
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                if latency > self.baseline_latency * self.latency_tolerance:
+                    self.limit = max(self.min_limit, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                # slow average, so a lasting shift in latency eventually becomes the new normal
+                self.baseline_latency += 0.05 * (latency - self.baseline_latency)
+            self._cond.notify_all()
+
+    def _on_rate_limited(self, retry_after):
+        # the pause is written to the shared state before the slot is freed, outside the condition
+        self.bucket.blocked_until = max(self.bucket.blocked_until, time.monotonic() + retry_after)
+        with self._cond:
+            self.in_flight -= 1
+            self.counters['rate_limited'] += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+            self._cond.notify_all()
+        return retry_after
+
+    def _retry_hint(self):
+        blocked = self.bucket.blocked_until - time.monotonic()
+        if blocked > 0:
+            return blocked
+        # roughly how long until the queue ahead of a new caller drains
+        per_call = self.baseline_latency or 1.0
+        return per_call * (self.waiting + 1) / max(1.0, self.limit)
+
+    def stats(self):
+        blocked_for = max(0.0, self.bucket.blocked_until - time.monotonic())  # may read the shared state
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'rate': self.bucket.rate,
+                'burst': self.bucket.burst,
+                'blocked_for': round(blocked_for, 2),
+                'baseline_latency_ms': round(self.baseline_latency * 1000, 1)
+                if self.baseline_latency is not None else None,
+                **self.counters,
+            }
+
+
+class RateLimiter:
+    """One AdaptiveLimiter per key, created on first use from the per-key settings."""
+    def __init__(self, settings=None, defaults=None, state=None):
+        self.settings = settings or {}   # key -> AdaptiveLimiter kwargs
+        self.defaults = defaults or {}   # kwargs for keys without their own settings
+        self.state = state               # optional shared state: token buckets shared between workers
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, key):
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(key)
+                if limiter is None:
+                    kwargs = {**self.defaults, **self.settings.get(key, {}), 'state': self.state}
+                    limiter = self._limiters[key] = AdaptiveLimiter(key, **kwargs)
+        return limiter
+
+    def acquire(self, key):
+        return self.limiter(key).acquire()
+
+    def stats(self):
+        with self._lock:
+            return {key: limiter.stats() for key, limiter in self._limiters.items()}
@@ -0,0 +1,321 @@
+import importlib.util
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def create_shared_state(config):
+    """Build the state shared by worker processes, selected by SHARED_STATE_BACKEND ('sqlite', 'redis' or 'local')."""
+    backend = config.get('SHARED_STATE_BACKEND', 'sqlite')
+    if backend == 'local':
+        return None  # per-process state only (single worker)
+    if backend == 'sqlite':
+        path = config.get('SHARED_STATE_PATH') or os.path.join(config['STATE_FOLDER'], 'shared_state.sqlite3')
+        return SQLiteState(path)
+    if backend == 'redis':
+        return RedisState(config['REDIS_URL'], prefix=config.get('REDIS_PREFIX', ''))
+    raise ValueError(f"Unknown SHARED_STATE_BACKEND: {backend}")
+
+
+def _ttl_ms(ttl):
+    return max(1, int(ttl * 1000)) if ttl else None
+
+
+class SQLiteState:
+    """
+    Shared key/value state in one SQLite database in WAL mode, for the worker processes of
+    one machine. Provides TTL keys, atomic counters, leases and token buckets; expired keys
+    read as absent and are purged every purge_every writes.
+
+    Connections are opened lazily, one per thread and process, so the object can be
+    created before a pre-fork server forks.
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path, busy_timeout=5.0, purge_every=1000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._counts = {}  # op -> calls made by this process
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # autocommit; multi-statement updates use explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL: a crashed process loses nothing, power loss the last commits
+        if not self._initialized:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    value,
+                    expires_at REAL
+                ) WITHOUT ROWID
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS shared_state_expiry ON shared_state (expires_at)')
+            self._initialized = True
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, op, write=False):
+        with self._lock:
+            self._counts[op] = self._counts.get(op, 0) + 1
+            if write:
+                self._writes += 1
+                purge = self._writes % self.purge_every == 0
+        if write and purge:
+            self._conn().execute('DELETE FROM shared_state WHERE expires_at <= ?', (time.time(),))
+
+    @staticmethod
+    def _expiry(ttl):
+        return time.time() + ttl if ttl else None
+
+    # ----- TTL keys -----
+
+    def get(self, key):
+        """Value of key, or None if absent or expired. Read counters with int(): Redis returns them as str."""
+        self._count('get')
+        row = self._conn().execute(
+            'SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        self._count('set', write=True)
+        self._conn().execute(
+            'INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+            (key, value, self._expiry(ttl)),
+        )
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it is absent or expired; True if it was set."""
+        self._count('add', write=True)
+        now = time.time()
+        return self._conn().execute(
+            'INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE shared_state.expires_at <= ?',
+            (key, value, self._expiry(ttl), now),
+        ).rowcount == 1
+
+    def delete(self, key):
+        self._count('delete', write=True)
+        self._conn().execute('DELETE FROM shared_state WHERE key = ?', (key,))
+
+    # ----- counters -----
+
+    def incr(self, key, amount=1, ttl=None):
+        """Atomically add amount to an integer key (absent = 0) and return the new value; ttl applies when created."""
+        self._count('incr', write=True)
+        now = time.time()
+        return self._conn().execute(
+            'INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            '  value = CASE WHEN shared_state.expires_at <= ? THEN excluded.value '
+            '               ELSE shared_state.value + excluded.value END, '
+            '  expires_at = CASE WHEN shared_state.expires_at <= ? THEN excluded.expires_at '
+            '                    ELSE shared_state.expires_at END '
+            'RETURNING value',
+            (key, amount, self._expiry(ttl), now, now),
+        ).fetchone()[0]
+
+    # ----- leases -----
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take (or, for its current owner, extend) a lease for ttl seconds; True if owner holds it now."""
+        self._count('acquire_lease', write=True)
+        now = time.time()
+        return self._conn().execute(
+            'INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE shared_state.expires_at <= ? OR shared_state.value = excluded.value',
+            (name, owner, now + ttl, now),
+        ).rowcount == 1
+
+    def release_lease(self, name, owner):
+        """Give up a lease; False if owner no longer held it (expired and taken over)."""
+        self._count('release_lease', write=True)
+        return self._conn().execute(
+            'DELETE FROM shared_state WHERE key = ? AND value = ?', (name, owner)
+        ).rowcount == 1
+
+    # ----- token buckets -----
+
+    def take_tokens(self, key, rate, burst, count=1):
+        """
+        Refill the bucket at key (rate tokens per second, up to burst), take count tokens and
+        return what is left; negative means the caller must wait -left / rate seconds. A
+        negative count gives tokens back.
+        """
+        self._count('take_tokens', write=True)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()  # read under the write lock, so updates are applied in time order
+            row = conn.execute(
+                'SELECT value FROM shared_state WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            tokens, updated = (float(part) for part in row[0].split(',')) if row else (burst, now)
+            tokens = min(burst, min(burst, tokens + max(0.0, now - updated) * rate) - count)
+            # an idle bucket refills completely, so it can expire once full
+            idle_ttl = (burst - tokens) / rate + 60 if rate else 3600
+            conn.execute(
+                'INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+                (key, f"{tokens!r},{now!r}", now + idle_ttl),
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return tokens
+
+    def stats(self):
+        row = self._conn().execute(
+            'SELECT COUNT(*) FROM shared_state WHERE expires_at IS NULL OR expires_at > ?', (time.time(),)
+        ).fetchone()
+        with self._lock:
+            return {'backend': self.backend, 'path': self.path, 'keys': row[0], 'ops': dict(self._counts)}
+
+
+# Lua scripts run atomically inside Redis
+_INCR_SCRIPT = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) == -1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+_ACQUIRE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+elseif current == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_TAKE_SCRIPT = """
+local rate, burst, count = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')  -- the server's clock: workers on several machines may disagree
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, math.min(burst, tokens + math.max(0, now - updated) * rate) - count)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+local idle_ttl = 3600
+if rate > 0 then idle_ttl = (burst - tokens) / rate + 60 end
+redis.call('PEXPIRE', KEYS[1], math.ceil(idle_ttl * 1000))
+return tostring(tokens)
+"""
+
+
+class RedisState:
+    """
+    The same operations as SQLiteState on a Redis-compatible server (Redis, Valkey, KeyDB...),
+    for workers spread over several machines. Requires the redis package; the client and
+    its connection pool are created on first use in each process.
+    """
+    backend = 'redis'
+
+    def __init__(self, url, prefix=''):
+        if importlib.util.find_spec('redis') is None:
+            raise RuntimeError("SHARED_STATE_BACKEND=redis requires the redis package (pip install redis)")
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._scripts = {}
+        self._pid = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    import redis
+
+                    client = redis.Redis.from_url(self.url, decode_responses=True)
+                    self._scripts = {
+                        name: client.register_script(script)
+                        for name, script in (('incr', _INCR_SCRIPT), ('acquire', _ACQUIRE_SCRIPT),
+                                             ('release', _RELEASE_SCRIPT), ('take', _TAKE_SCRIPT))
+                    }
+                    self._client, self._pid = client, os.getpid()
+        return self._client
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def _count(self, op):
+        with self._lock:
+            self._counts[op] = self._counts.get(op, 0) + 1
+
+    def get(self, key):
+        self._count('get')
+        return self._redis().get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self._count('set')
+        self._redis().set(self._key(key), value, px=_ttl_ms(ttl))
+
+    def add(self, key, value, ttl=None):
+        self._count('add')
+        return bool(self._redis().set(self._key(key), value, px=_ttl_ms(ttl), nx=True))
+
+    def delete(self, key):
+        self._count('delete')
+        self._redis().delete(self._key(key))
+
+    def incr(self, key, amount=1, ttl=None):
+        self._count('incr')
+        self._redis()
+        return int(self._scripts['incr'](keys=[self._key(key)], args=[amount, _ttl_ms(ttl) or 0]))
+
+    def acquire_lease(self, name, owner, ttl):
+        self._count('acquire_lease')
+        self._redis()
+        return bool(self._scripts['acquire'](keys=[self._key(name)], args=[owner, _ttl_ms(ttl)]))
+
+    def release_lease(self, name, owner):
+        self._count('release_lease')
+        self._redis()
+        return bool(self._scripts['release'](keys=[self._key(name)], args=[owner]))
+
+    def take_tokens(self, key, rate, burst, count=1):
+        self._count('take_tokens')
+        self._redis()
+        return float(self._scripts['take'](keys=[self._key(key)], args=[rate, burst, count]))
+
+    def stats(self):
+        parts = urlsplit(self.url)
+        try:
+            keys = self._redis().dbsize()
+        except Exception as e:
+            logging.error(f"Could not reach shared state at {parts.hostname}: {str(e)}")
+            keys = None
+        with self._lock:
+            return {'backend': self.backend, 'host': parts.hostname, 'port': parts.port, 'prefix': self.prefix,
+                    'keys': keys, 'ops': dict(self._counts)}
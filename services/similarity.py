@@ -0,0 +1,276 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.file_utils import file_etag, manifest_lock, rewrite_manifest
+
+HASH_BITS = 64
+CHUNKS = 4                      # multi-index hashing: 4 tables keyed by 16-bit slices of the hash
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Computes hashes of new uploads/generated images off the request thread
+_hash_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="phash")
+
+_numpy = None
+
+
+def _load_numpy():
+    """NumPy if installed, imported on first use; the pure-Python path handles 72 pixels fine."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def dhash(img):
+    """
+    64-bit difference hash of a Pillow image: grayscale, shrunk to 9x8, one bit per
+    horizontally adjacent pixel pair (left brighter than right). Robust to re-encoding,
+    resizing and format changes; EXIF orientation is applied first.
+    """
+    from PIL import Image, ImageOps
+
+    if img.format == "JPEG":
+        img.draft("L", (64, 64))  # DCT-scaled decode: no need for full resolution
+    img = ImageOps.exif_transpose(img).convert("L")
+    img.thumbnail((64, 64), Image.Resampling.BILINEAR)
+    small = img.resize((9, 8), Image.Resampling.LANCZOS)
+
+    np = _load_numpy()
+    if np is not None:
+        pixels = np.asarray(small, dtype=np.int16)
+        bits = (pixels[:, :-1] > pixels[:, 1:]).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hash_image(path=None, data=None):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data) if data is not None else path) as img:
+        return dhash(img)
+
+
+def colour_signature(path=None, data=None):
+    """(aspect ratio, 4x4 RGB thumbnail) of an image: what the grayscale dHash doesn't see."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data) if data is not None else path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (64, 64))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        aspect = img.width / img.height
+        img.thumbnail((64, 64), Image.Resampling.BILINEAR)
+        return aspect, list(img.resize((4, 4), Image.Resampling.BOX).getdata())
+
+
+def same_colours(a, b, aspect_tolerance=0.02, channel_tolerance=24):
+    """
+    True if two colour_signature()s agree: aspect ratios within aspect_tolerance and every
+    channel of every cell within channel_tolerance. Re-encoding and resizing pass; a recoloured
+    image (e.g. red and blue swapped) or a crop to another shape with the same dHash does not.
+    """
+    if abs(a[0] / b[0] - 1) > aspect_tolerance:
+        return False
+    return all(abs(x - y) <= channel_tolerance for p, q in zip(a[1], b[1]) for x, y in zip(p, q))
+
+
+def is_informative(value, margin=4):
+    """Near-blank images hash to (almost) all zeros or ones and would match each other."""
+    return margin <= value.bit_count() <= HASH_BITS - margin
+
+
+def _flip_masks(radius):
+    """XOR masks reaching every CHUNK_BITS-bit value within Hamming distance radius (<= 2) of a chunk."""
+    masks = [0]
+    if radius >= 1:
+        masks += [1 << i for i in range(CHUNK_BITS)]
+    if radius >= 2:
+        masks += [(1 << i) | (1 << j) for i in range(CHUNK_BITS) for j in range(i + 1, CHUNK_BITS)]
+    return masks
+
+
+FLIP_MASKS = [_flip_masks(radius) for radius in range(3)]
+
+
+class PerceptualIndex:
+    """
+    Near-duplicate index: file id -> (64-bit dHash, content digest).
+
+    Lookups use multi-index hashing. The hash is cut into CHUNKS slices, each with its
+    own table; two hashes within distance r share at least one slice within r // CHUNKS
+    bits (pigeonhole), so only those buckets are probed and candidates are verified with
+    a popcount. Buckets hold the full hashes, so verification needs no second lookup.
+    Persisted as an append-only JSON-lines manifest, like FileIndex.
+    """
+    def __init__(self, manifest_path=None):
+        self.manifest_path = manifest_path
+        self.queries = 0
+        self.hashed = 0
+        self._entries = {}  # file id -> (hash, digest)
+        self._tables = [dict() for _ in range(CHUNKS)]  # chunk value -> {file id: hash}
+        self._lock = threading.RLock()
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, file_id):
+        return self._entries.get(file_id)
+
+    def add(self, file_id, value, digest=None):
+        with self._lock:
+            if self._entries.get(file_id) == (value, digest):
+                return
+            self._discard(file_id)
+            self._put(file_id, value, digest)
+            self._append({"op": "add", "id": file_id, "h": f"{value:016x}", "d": digest})
+
+    def remove(self, file_id):
+        with self._lock:
+            if self._discard(file_id):
+                self._append({"op": "del", "id": file_id})
+
+    def hash_file(self, file_id, path, digest=None, data=None):
+        """Hash path (or its bytes) and index it under file_id; returns the hash or None if unreadable."""
+        entry = self._entries.get(file_id)
+        if entry is not None and (digest is None or entry[1] == digest):
+            return entry[0]
+        try:
+            value = hash_image(path, data)
+        except Exception as e:
+            logging.info(f"Cannot hash {path}: {str(e)}")
+            return None
+        self.add(file_id, value, digest)
+        with self._lock:
+            self.hashed += 1
+        return value
+
+    def submit(self, file_id, path, digest=None):
+        """hash_file on the background pool."""
+        if file_id not in self._entries:
+            _hash_pool.submit(self.hash_file, file_id, path, digest)
+
+    def query(self, value, max_distance=8, limit=20, exclude=None):
+        """[(distance, file id, digest)] within max_distance of value, nearest first."""
+        radius = max_distance // CHUNKS
+        if radius > 2:
+            raise ValueError(f"max_distance must be below {3 * CHUNKS}")
+        found = {}
+        with self._lock:
+            # a candidate can sit in several probed buckets; found dedupes by file id
+            for index, table in enumerate(self._tables):
+                chunk = (value >> (index * CHUNK_BITS)) & CHUNK_MASK
+                for mask in FLIP_MASKS[radius]:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        for file_id, other in bucket.items():
+                            distance = (value ^ other).bit_count()
+                            if distance <= max_distance:
+                                found[file_id] = distance
+            found.pop(exclude, None)
+            matches = [(distance, file_id, self._entries[file_id][1]) for file_id, distance in found.items()]
+            self.queries += 1
+        matches.sort()
+        return matches[:limit]
+
+    def backfill(self, file_index, folders=("uploads", "generated"), pause=0.0):
+        """Hash indexed images that have no entry yet (e.g. files stored before this index existed)."""
+        added = 0
+        file_index.refresh()  # pick up files that were never recorded through the services
+        for folder in folders:
+            for file_id, entry in file_index.snapshot(folder):
+                if file_id in self._entries or not entry.get("mime", "").startswith("image/"):
+                    continue
+                path = file_index.path_of(entry)
+                try:
+                    digest = entry.get("etag") or file_etag(path)
+                except OSError:
+                    continue  # deleted since the snapshot
+                if self.hash_file(file_id, path, digest) is not None:
+                    added += 1
+                if pause:
+                    time.sleep(pause)  # background pass: leave CPU to requests
+        if added:
+            logging.info(f"Perceptual index backfilled {added} images")
+        return added
+
+    def stats(self):
+        with self._lock:
+            buckets = [len(table) for table in self._tables]
+            return {
+                "entries": len(self._entries),
+                "queries": self.queries,
+                "hashed": self.hashed,
+                "buckets_per_table": buckets,
+                "numpy": _load_numpy() is not None,
+            }
+
+    # ----- internals -----
+
+    def _put(self, file_id, value, digest):
+        self._entries[file_id] = (value, digest)
+        for index, table in enumerate(self._tables):
+            table.setdefault((value >> (index * CHUNK_BITS)) & CHUNK_MASK, {})[file_id] = value
+
+    def _discard(self, file_id):
+        entry = self._entries.pop(file_id, None)
+        if entry is None:
+            return False
+        value = entry[0]
+        for index, table in enumerate(self._tables):
+            chunk = (value >> (index * CHUNK_BITS)) & CHUNK_MASK
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.pop(file_id, None)
+                if not bucket:
+                    del table[chunk]
+        return True
+
+    def _append(self, record):
+        if not self.manifest_path:
+            return
+        with manifest_lock(self.manifest_path), open(self.manifest_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _load(self):
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return
+        with manifest_lock(self.manifest_path, exclusive=True):
+            self._replay()
+            self._compact()
+
+    def _replay(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn write from a crashed process
+                if record.get("op") == "add":
+                    self._discard(record["id"])
+                    self._put(record["id"], int(record["h"], 16), record.get("d"))
+                elif record.get("op") == "del":
+                    self._discard(record["id"])
+
+    def _compact(self):
+        # callers hold the exclusive manifest lock
+        rewrite_manifest(self.manifest_path, (
+            json.dumps({"op": "add", "id": file_id, "h": f"{value:016x}", "d": digest}, separators=(",", ":"))
+            for file_id, (value, digest) in self._entries.items()
+        ))
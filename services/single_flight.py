@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class _Call:
+    """One in-flight upstream call and the outcome its followers are waiting for."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.lease = None  # (shared name, owner) while this process leads the call for all workers
+
+
+class Flight:
+    """
+    Handle yielded by SingleFlight.flight(). The leader makes the call and passes the
+    outcome to resolve(); a follower finds the leader's result in .result.
+    """
+    def __init__(self, flights, kind, key, call, leader):
+        self._flights = flights
+        self._kind = kind
+        self._key = key
+        self._call = call
+        self.leader = leader
+        self.result = call.result if not leader else None
+
+    def resolve(self, result):
+        self.result = result
+        self._flights._finish(self._kind, self._key, self._call, result=result)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller for a key (the leader) does the
+    work while later callers with the same key wait and share its result, or its error.
+    Nothing is kept once the call finishes; persistent reuse is the result caches' job.
+
+    If the leader gives up without a result (e.g. a streaming client disconnected), its
+    followers race to lead a fresh call instead of failing with it.
+
+    With a shared state the leader of each process also takes a lease on the key, so one
+    call serves every worker: the others poll for the result it publishes. The result is
+    stored under the lease's owner token, which only workers that saw the lease held know,
+    so a call that has already finished is never reused by a later request (results must
+    be JSON-serializable; result_ttl just bounds how long waiters have to pick them up).
+    Errors are not published; when the lease is released without a result the next worker
+    makes its own call.
+    """
+    def __init__(self, state=None, lease_ttl=300.0, result_ttl=10.0, poll_interval=0.02):
+        self.state = state
+        self.lease_ttl = lease_ttl          # outlives the longest call; frees the key if its process dies
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval  # first poll delay, doubling up to 0.25 s
+        self._calls = {}  # (kind, key) -> _Call
+        self._counters = {}  # kind -> counter name -> value
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def flight(self, kind, key):
+        """
+        Lead or join the call for (kind, key). Yields a Flight: when flight.leader is true the
+        with-body makes the call and hands its outcome to flight.resolve(); an exception
+        leaving the body is passed on to the followers. Otherwise flight.result is ready.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get((kind, key))
+                leader = call is None
+                if leader:
+                    call = self._calls[(kind, key)] = _Call()
+                else:
+                    self._count(kind, "waiting")
+                    counters = self._counters[kind]
+                    counters["peak_waiting"] = max(counters.get("peak_waiting", 0), counters["waiting"])
+            if leader:
+                break
+            try:
+                call.done.wait()
+            finally:
+                with self._lock:
+                    self._count(kind, "waiting", -1)
+            if call.abandoned:
+                continue
+            with self._lock:
+                self._count(kind, "deduplicated")
+            if call.error is not None:
+                raise call.error
+            yield Flight(self, kind, key, call, leader=False)
+            return
+
+        shared = self._join_shared(kind, key, call) if self.state is not None else None
+        if shared is not None:
+            # another worker made this call; our own followers get its result too
+            self._finish(kind, key, call, result=shared)
+            with self._lock:
+                self._count(kind, "deduplicated")
+                self._count(kind, "remote_deduplicated")
+            yield Flight(self, kind, key, call, leader=False)
+            return
+
+        with self._lock:
+            self._count(kind, "calls")
+        try:
+            yield Flight(self, kind, key, call, leader=True)
+        except Exception as e:
+            if not call.done.is_set():
+                self._finish(kind, key, call, error=e)
+            raise
+        finally:
+            if not call.done.is_set():
+                self._finish(kind, key, call, abandoned=True)
+
+    def do(self, kind, key, fn):
+        """fn() run once for all concurrent callers of (kind, key); returns (result, shared)."""
+        with self.flight(kind, key) as flight:
+            if flight.leader:
+                flight.resolve(fn())
+            return flight.result, not flight.leader
+
+    def stats(self):
+        with self._lock:
+            stats = {kind: {"calls": 0, "deduplicated": 0, "remote_deduplicated": 0, "abandoned": 0,
+                            "waiting": 0, "peak_waiting": 0, **counters, "in_flight": 0}
+                     for kind, counters in self._counters.items()}
+            for kind, _ in self._calls:
+                stats[kind]["in_flight"] += 1
+            return stats
+
+    def _finish(self, kind, key, call, result=None, error=None, abandoned=False):
+        with self._lock:
+            if self._calls.get((kind, key)) is call:
+                del self._calls[(kind, key)]
+            if abandoned:
+                self._count(kind, "abandoned")
+        if call.lease is not None:
+            self._publish(call.lease, result if error is None and not abandoned else None)
+        call.result, call.error, call.abandoned = result, error, abandoned
+        call.done.set()
+
+    # ----- across worker processes -----
+
+    def _join_shared(self, kind, key, call):
+        """
+        Lease the key for all workers (returns None: make the call) or wait for the worker
+        holding it and return the result it publishes under its owner token.
+        """
+        name = hashlib.sha256(json.dumps([kind, key]).encode("utf-8")).hexdigest()
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        holder = None  # owner of the lease last seen held by another worker
+        delay = self.poll_interval
+        try:
+            while True:
+                result = self._published(name, holder) if holder is not None else None
+                if result is not None:
+                    return result
+                if self.state.acquire_lease(f"flight:{name}", owner, self.lease_ttl):
+                    # the holder may have published and released since the check above
+                    result = self._published(name, holder) if holder is not None else None
+                    if result is None:
+                        call.lease = (name, owner)
+                        return None
+                    self.state.release_lease(f"flight:{name}", owner)
+                    return result
+                holder = self.state.get(f"flight:{name}") or holder
+                time.sleep(delay)
+                delay = min(delay * 2, 0.25)
+        except Exception as e:
+            logging.error(f"Shared state unavailable, coalescing {kind} calls in this process only: {str(e)}")
+            return None
+
+    def _published(self, name, owner):
+        raw = self.state.get(f"flight-result:{name}:{owner}")
+        return json.loads(raw) if raw is not None else None
+
+    def _publish(self, lease, result):
+        name, owner = lease
+        try:
+            if result is not None:
+                self.state.set(f"flight-result:{name}:{owner}", json.dumps(result), ttl=self.result_ttl)
+            self.state.release_lease(f"flight:{name}", owner)
+        except Exception as e:
+            logging.error(f"Could not publish coalesced call {name}: {str(e)}")
+
+    def _count(self, kind, name, amount=1):
+        counters = self._counters.setdefault(kind, {})
+        counters[name] = counters.get(name, 0) + amount
@@ -0,0 +1,156 @@
+import os
+import uuid
+
+
+def create_storage(config, file_index=None):
+    """Build the storage backend selected by STORAGE_BACKEND ('local' or 's3')."""
+    folders = {'uploads': config['UPLOAD_FOLDER'], 'generated': config['GENERATED_FOLDER']}
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(folders, file_index)
+    if backend == 's3':
+        return S3Storage(
+            folders,
+            bucket=config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX', ''),
+            endpoint_url=config.get('S3_ENDPOINT_URL') or None,
+            region=config.get('S3_REGION') or None,
+            presign_downloads=config.get('S3_PRESIGN_DOWNLOADS', True),
+            presign_ttl=config.get('S3_PRESIGN_TTL', 3600),
+            file_index=file_index,
+        )
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+class LocalStorage:
+    """
+    Files live in the local upload/generated folders only.
+    Services write to local disk and then call save(); readers call ensure_local().
+    """
+    presigned_downloads = False
+
+    def __init__(self, folders, file_index=None):
+        self.folders = folders  # folder key ('uploads' / 'generated') -> local directory
+        self.file_index = file_index
+
+    def save(self, folder, path, immutable=False):
+        """Publish a file that was just written locally (no-op for local storage)."""
+
+    def ensure_local(self, path):
+        """True if path is available on local disk, fetching it from the backend if needed."""
+        return os.path.exists(path)
+
+    def available(self, path):
+        """Indexed or on disk locally, else fetched from the backend if it has it."""
+        if self.file_index is not None and self.file_index.exists(path):
+            return True
+        return self.ensure_local(path)
+
+    def download_url(self, folder, relpath):
+        """Direct (presigned) URL for a stored file, or None to serve it from Flask."""
+        return None
+
+    def evict(self, folder, relpath):
+        """
+        Remove the local copy of a file (the janitor and the rendition cap call this).
+        Objects in a remote backend are shared by every node and are left to its own
+        retention, e.g. a bucket lifecycle rule.
+        """
+        try:
+            os.remove(os.path.join(self.folders[folder], relpath))
+        except FileNotFoundError:
+            pass
+
+    def _locate(self, path):
+        """(folder key, relpath) of a local path inside one of the folders, else (None, None)."""
+        abs_path = os.path.abspath(path)
+        for folder, root in self.folders.items():
+            root = os.path.abspath(root)
+            if abs_path.startswith(root + os.sep):
+                return folder, os.path.relpath(abs_path, root)
+        return None, None
+
+
+class S3Storage(LocalStorage):
+    """
+    S3-compatible object storage with the local folders acting as a write-through cache,
+    so any app node can serve files produced by another. Works against AWS S3 or a
+    MinIO-style endpoint (S3_ENDPOINT_URL). Requires boto3.
+    """
+    def __init__(self, folders, bucket, prefix='', endpoint_url=None, region=None,
+                 presign_downloads=True, presign_ttl=3600, file_index=None,
+                 multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024):
+        super().__init__(folders, file_index)
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)") from e
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.presigned_downloads = presign_downloads
+        self.presign_ttl = presign_ttl
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        # files above the threshold are streamed from disk as multipart uploads
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+        )
+
+    def _key(self, folder, relpath):
+        key = f"{folder}/{relpath.replace(os.sep, '/')}"
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def save(self, folder, path, immutable=False):
+        relpath = os.path.relpath(path, self.folders[folder])
+        key = self._key(folder, relpath)
+        if immutable and self._exists(key):
+            return  # content-addressed: same key means same bytes
+        self.client.upload_file(path, self.bucket, key, Config=self.transfer_config)
+
+    def ensure_local(self, path):
+        if os.path.exists(path):
+            return True
+        folder, relpath = self._locate(path)
+        if folder is None:
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            self.client.download_file(self.bucket, self._key(folder, relpath), tmp_path,
+                                      Config=self.transfer_config)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if _is_not_found(e):
+                return False
+            raise
+        os.replace(tmp_path, path)
+        if self.file_index is not None:
+            self.file_index.add(folder, path)
+        return True
+
+    def download_url(self, folder, relpath):
+        if not self.presigned_downloads:
+            return None
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self._key(folder, relpath)},
+            ExpiresIn=self.presign_ttl,
+        )
+
+    def _exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+
+def _is_not_found(error):
+    response = getattr(error, 'response', None) or {}
+    return str(response.get('Error', {}).get('Code')) in ('404', 'NoSuchKey', 'NotFound')
@@ -0,0 +1,68 @@
+"""Stand-ins for the google-genai client, shaped like the parts of it GeminiService uses."""
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+
+def png_bytes(size=(8, 8), color=(200, 40, 40)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class FakeAPIError(Exception):
+    """Shaped like google.genai.errors.APIError: code, status and the HTTP response."""
+    def __init__(self, code, status, retry_after=None):
+        super().__init__(f"{code} {status}")
+        self.code = code
+        self.status = status
+        self.response = SimpleNamespace(headers={'Retry-After': str(retry_after)} if retry_after else {})
+
+
+def rate_limited(retry_after=None):
+    return FakeAPIError(429, 'RESOURCE_EXHAUSTED', retry_after)
+
+
+def unavailable():
+    return FakeAPIError(503, 'UNAVAILABLE')
+
+
+class FakeClient:
+    """
+    Answers generate_content (captions) and generate_content_stream (images) after latency
+    seconds; delays, if given, override it for the first calls, one per call. errors are
+    raised by the next calls, one per call, instead of an answer.
+    """
+    def __init__(self, latency=0.0, errors=(), images=1, caption="Fresh caption #test", delays=()):
+        self.latency = latency
+        self.delays = list(delays)
+        self.errors = list(errors)
+        self.images = images
+        self.caption = caption
+        self.calls = 0
+        self.models = self
+        self._lock = threading.Lock()
+
+    def _begin(self):
+        with self._lock:
+            self.calls += 1
+            error = self.errors.pop(0) if self.errors else None
+            latency = self.delays.pop(0) if self.delays else self.latency
+        if latency:
+            time.sleep(latency)
+        if error is not None:
+            raise error
+
+    def generate_content(self, model, contents, config=None):
+        self._begin()
+        return SimpleNamespace(text=self.caption, candidates=[])
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._begin()
+        data = png_bytes()
+        for _ in range(self.images):
+            part = SimpleNamespace(inline_data=SimpleNamespace(data=data, mime_type='image/png'), text=None)
+            yield SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
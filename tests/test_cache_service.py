@@ -0,0 +1,138 @@
+import os
+import pytest
+from services import cache_service
+from services.cache_service import ResultCache
+from services.gemini_service import GeminiService
+from tests.fakes import FakeClient, png_bytes
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_service.time, 'time', clock)
+    return clock
+
+
+def test_miss_then_hit():
+    cache = ResultCache()
+    key = cache.make_key('generate', 'model', 'style', 'prompt')
+    assert cache.get(key) is None
+    cache.set(key, {'image_paths': ['a.png'], 'text': ''})
+    assert cache.get(key) == {'image_paths': ['a.png'], 'text': ''}
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_make_key_depends_on_every_part():
+    assert ResultCache.make_key('a', 'b') == ResultCache.make_key('a', 'b')
+    assert ResultCache.make_key('a', 'b') != ResultCache.make_key('a', 'c')
+    assert ResultCache.make_key('a', None) != ResultCache.make_key('a', 1)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResultCache(ttl=60)
+    cache.set('key', 'value')
+    clock.now += 59
+    assert cache.get('key') == 'value'
+    clock.now += 2
+    assert cache.get('key') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # b is now the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_validate_rejects_and_drops_entry():
+    cache = ResultCache()
+    cache.set('key', 'stale')
+    assert cache.get('key', validate=lambda value: value != 'stale') is None
+    assert cache.stats()['entries'] == 0
+    assert cache.get('key') is None
+
+
+def test_record_stats_false_leaves_counters_alone():
+    cache = ResultCache()
+    cache.set('key', 'value')
+    cache.get('key', record_stats=False)
+    cache.get('other', record_stats=False)
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 0)
+
+
+def test_index_path_survives_restart(tmp_path, clock):
+    index_path = str(tmp_path / 'cache.json')
+    cache = ResultCache(ttl=60, index_path=index_path)
+    cache.set('kept', 'value')
+    assert ResultCache(ttl=60, index_path=index_path).get('kept') == 'value'
+    clock.now += 61
+    assert ResultCache(ttl=60, index_path=index_path).get('kept') is None
+
+
+@pytest.fixture
+def service(tmp_path):
+    client = FakeClient()
+    service = GeminiService(client=client, generation_cache=ResultCache(), caption_cache=ResultCache(),
+                            generated_folder=str(tmp_path / 'generated'))
+    return service, client
+
+
+def test_generation_is_served_from_cache(service):
+    service, client = service
+    first = service.generate_image('a red  square', style='flat')
+    second = service.generate_image('a red square', style='flat')
+    assert client.calls == 1
+    assert (first['cached'], second['cached']) == (False, True)
+    assert second['image_paths'] == first['image_paths']
+
+
+def test_generation_cache_is_keyed_on_style_and_bypassable(service):
+    service, client = service
+    service.generate_image('a red square', style='flat')
+    service.generate_image('a red square', style='realistic')
+    service.generate_image('a red square', style='flat', use_cache=False)
+    assert client.calls == 3
+
+
+def test_generation_with_missing_files_is_regenerated(service):
+    service, client = service
+    first = service.generate_image('a red square')
+    os.remove(first['image_path'])
+    second = service.generate_image('a red square')
+    assert client.calls == 2
+    assert second['cached'] is False
+    assert os.path.exists(second['image_path'])
+
+
+def test_caption_is_served_from_cache(service, tmp_path):
+    service, client = service
+    image_path = tmp_path / 'photo.png'
+    image_path.write_bytes(png_bytes())
+    first = service.generate_caption_result(str(image_path), 'instagram', 'playful')
+    second = service.generate_caption_result(str(image_path), 'instagram', 'playful')
+    other_tone = service.generate_caption_result(str(image_path), 'instagram', 'formal')
+    assert client.calls == 2
+    assert (first['cached'], second['cached'], other_tone['cached']) == (False, True, False)
+    assert second['caption'] == client.caption
+
+
+def test_prompts_differing_in_case_are_not_shared(service):
+    service, client = service
+    service.generate_image('a banner that says SALE')
+    service.generate_image('a banner that says sale')
+    service.generate_image('a banner  that says SALE ')
+    assert client.calls == 2
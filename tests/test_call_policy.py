@@ -0,0 +1,110 @@
+import time
+import pytest
+from services.call_policy import CallPolicy, CallTimeoutError
+from services.gemini_service import GeminiService
+from services.rate_limiter import RateLimiter, UpstreamBusyError, UpstreamRateLimitedError
+from tests.fakes import FakeAPIError, FakeClient, png_bytes, rate_limited, unavailable
+
+
+def make_service(tmp_path, client, **policy):
+    policy = CallPolicy(**{'backoff_base': 0.01, **policy})
+    return GeminiService(client=client, call_policy=policy, rate_limiter=RateLimiter(),
+                         generated_folder=str(tmp_path / 'generated'))
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / 'photo.png'
+    path.write_bytes(png_bytes())
+    return str(path)
+
+
+def test_retry_delay_backs_off_within_the_deadline():
+    policy = CallPolicy(max_retries=2, backoff_base=0.5, backoff_max=8.0)
+    deadline = time.monotonic() + 60
+    assert 0 <= policy.retry_delay(unavailable(), 0, deadline) <= 0.5
+    assert 0 <= policy.retry_delay(unavailable(), 1, deadline) <= 1.0
+    assert policy.retry_delay(unavailable(), 2, deadline) is None  # out of retries
+    assert policy.retry_delay(FakeAPIError(400, 'INVALID_ARGUMENT'), 0, deadline) is None
+    assert policy.retry_delay(UpstreamBusyError('local queue full'), 0, deadline) is None
+    assert policy.retry_delay(UpstreamRateLimitedError('429', retry_after=4), 0, deadline) >= 4
+    assert policy.retry_delay(UpstreamRateLimitedError('429', retry_after=4), 0, time.monotonic() + 2) is None
+
+
+def test_idle_timeouts_are_retried_but_deadlines_are_not():
+    policy = CallPolicy()
+    deadline = time.monotonic() + 60
+    assert policy.retry_delay(CallTimeoutError('stalled', idle=True), 0, deadline) is not None
+    assert policy.retry_delay(CallTimeoutError('too slow'), 0, deadline) is None
+
+
+def test_transient_errors_are_retried(tmp_path, image):
+    client = FakeClient(errors=[unavailable(), unavailable()])
+    service = make_service(tmp_path, client, max_retries=2)
+    assert service.generate_caption(image) == client.caption
+    assert client.calls == 3
+    assert service.call_policy.stats()['caption']['retries'] == 2
+
+
+def test_retries_give_up_after_max_retries(tmp_path, image):
+    client = FakeClient(errors=[unavailable()] * 3)
+    service = make_service(tmp_path, client, max_retries=1)
+    with pytest.raises(FakeAPIError):
+        service.generate_caption(image)
+    assert client.calls == 2
+    assert service.call_policy.stats()['caption']['failed'] == 1
+
+
+def test_429_is_not_retried_past_the_deadline(tmp_path, image):
+    client = FakeClient(errors=[rate_limited(retry_after=5)])
+    service = make_service(tmp_path, client, deadlines={'caption': 1.0})
+    with pytest.raises(UpstreamRateLimitedError) as error:
+        service.generate_caption(image)
+    assert error.value.retry_after == 5
+    assert client.calls == 1
+    assert service.rate_limiter.stats()['caption']['rate_limited'] == 1
+
+
+def test_429_is_retried_after_the_hint(tmp_path):
+    client = FakeClient(errors=[rate_limited(retry_after=1)])
+    service = make_service(tmp_path, client)
+    started = time.monotonic()
+    result = service.generate_image('a red square')
+    assert time.monotonic() - started >= 1
+    assert len(result['image_paths']) == 1
+    assert client.calls == 2
+
+
+def test_image_call_past_its_deadline_times_out(tmp_path):
+    client = FakeClient(latency=0.2)
+    service = make_service(tmp_path, client, deadlines={'image': 0.05})
+    with pytest.raises(CallTimeoutError):
+        service.generate_image('a red square')
+    assert client.calls == 1
+    assert service.call_policy.stats()['image']['timeouts'] == 1
+
+
+def test_slow_caption_is_hedged(tmp_path, image):
+    client = FakeClient(delays=[1.0, 0.0])
+    service = make_service(tmp_path, client, hedge_captions=True, hedge_after=0.05)
+    started = time.monotonic()
+    assert service.generate_caption(image) == client.caption
+    assert time.monotonic() - started < 0.5
+    stats = service.call_policy.stats()['caption']
+    assert (stats['hedged'], stats['hedge_wins']) == (1, 1)
+
+
+def test_fast_caption_is_not_hedged(tmp_path, image):
+    client = FakeClient()
+    service = make_service(tmp_path, client, hedge_captions=True, hedge_after=0.5)
+    service.generate_caption(image)
+    assert client.calls == 1
+    assert 'hedged' not in service.call_policy.stats()['caption']
+
+
+def test_hedge_delay_follows_observed_p95():
+    policy = CallPolicy(hedge_captions=True)
+    assert policy.hedge_delay('caption') is None  # not enough history yet
+    for latency in range(1, 101):
+        policy.record('caption', latency / 100)
+    assert policy.hedge_delay('caption') == pytest.approx(0.96)
@@ -0,0 +1,67 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import pytest
+from services.gemini_service import GeminiService
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep the connection open between requests
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.peers.add(self.client_address)
+        body = b'{}\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.peers = set()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def pooled_service(keepalive):
+    service = GeminiService(client=object(), keepalive=keepalive)
+    api_client = SimpleNamespace(_request_unauthorized=None)
+    assert service._mount_connection_pool(SimpleNamespace(_api_client=api_client))
+    return service, api_client._request_unauthorized
+
+
+def call(request, server, stream=False):
+    url = f'http://127.0.0.1:{server.server_address[1]}/v1/models'
+    response = request(SimpleNamespace(method='POST', url=url, headers={}, data={'q': 1}), stream=stream)
+    if stream:
+        list(response.segments())
+
+
+def test_pooled_connections_are_reused_within_keepalive(server):
+    service, request = pooled_service(keepalive=60)
+    for stream in (False, True, False):
+        call(request, server, stream)
+    assert len(server.peers) == 1
+    assert service.pool_stats()['idle_closes'] == 0
+
+
+def test_connections_idle_past_keepalive_are_closed(server):
+    service, request = pooled_service(keepalive=30)
+    call(request, server)
+    service._pool_idle_since -= 31
+    call(request, server, stream=True)
+    service._pool_idle_since -= 31
+    call(request, server)
+    assert len(server.peers) == 3
+    assert service.pool_stats()['idle_closes'] == 2
+    assert service._pool_active == 0
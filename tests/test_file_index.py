@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import pytest
+from services.file_index import FileIndex
+from services.similarity import PerceptualIndex
+from tests.test_janitor import make_index
+
+
+def test_a_stale_hit_is_confirmed_on_disk_and_dropped(tmp_path):
+    index = make_index(tmp_path)
+    path = os.path.join(index.folders['generated'], 'generated_a_0.png')
+    with open(path, 'wb') as f:
+        f.write(b'png')
+    index.add('generated', path)
+
+    os.remove(path)  # e.g. evicted by another worker
+    assert not index.exists(path)
+    assert index.get('generated_a_0.png') is None
+
+
+def _load_and_add(folders, manifest_path, name, barrier):
+    barrier.wait()
+    index = FileIndex(folders, manifest_path)
+    index.add('generated', os.path.join(folders['generated'], name))
+    PerceptualIndex(manifest_path + '.phash').add(name, 1)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='workers are forked')
+def test_workers_loading_at_once_keep_every_manifest_line(tmp_path):
+    index = make_index(tmp_path)
+    for i in range(100):
+        path = os.path.join(index.folders['generated'], f'generated_{i}_0.png')
+        with open(path, 'wb') as f:
+            f.write(b'png')
+        index.add('generated', path)
+
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(8)
+    workers = [
+        context.Process(target=_load_and_add,
+                        args=(index.folders, index.manifest_path, f'generated_{i}_0.png', barrier))
+        for i in range(8)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+    assert [worker.exitcode for worker in workers] == [0] * 8
+
+    assert len(FileIndex(index.folders, index.manifest_path).list(limit=1000)[1]) == 100
+    assert len(PerceptualIndex(index.manifest_path + '.phash')) == 8
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
@@ -0,0 +1,18 @@
+import os
+from services.image_service import ImageService
+from tests.fakes import png_bytes
+
+
+def test_model_output_does_not_count_towards_the_rendition_cap(tmp_path):
+    generated = tmp_path / 'generated'
+    generated.mkdir()
+    # model output alone is well over the cap and must never push renditions out
+    (generated / 'generated_model_output_0.png').write_bytes(b'\0' * 200_000)
+    source = tmp_path / 'photo.png'
+    source.write_bytes(png_bytes())
+    service = ImageService(str(tmp_path / 'uploads'), str(generated), max_generated_bytes=100_000)
+
+    paths = [service.resize_for_social_media(str(source), platform)
+             for platform in ('instagram', 'twitter', 'facebook')]
+    assert [os.path.exists(path) for path in paths] == [True, True, True]
+    assert (generated / 'generated_model_output_0.png').exists()
@@ -0,0 +1,79 @@
+import io
+import os
+import time
+from services.file_index import FileIndex
+from services.image_service import ImageService
+from services.janitor import StorageJanitor
+from services.shared_state import SQLiteState
+from tests.fakes import png_bytes
+
+DAY = 24 * 3600
+
+
+def make_index(tmp_path, state=None):
+    folders = {'uploads': str(tmp_path / 'uploads'), 'generated': str(tmp_path / 'generated')}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    return FileIndex(folders, manifest_path=str(tmp_path / 'file_index.jsonl'), state=state)
+
+
+def age(index, file_id, seconds):
+    """Pretend the file was written and last read seconds ago."""
+    entry = index.get(file_id)
+    path = index.path_of(entry)
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+    entry['mtime'] = entry['accessed'] = old
+
+
+def janitor(index):
+    return StorageJanitor(index, policies={'uploads': {'ttl': DAY, 'quota': 0}})
+
+
+def test_duplicate_upload_renews_the_stored_blob(tmp_path):
+    index = make_index(tmp_path)
+    service = ImageService(index.folders['uploads'], index.folders['generated'], file_index=index)
+    path = service.save_upload_stream(io.BytesIO(png_bytes()))
+    age(index, os.path.basename(path), 2 * DAY)
+
+    assert service.save_upload_stream(io.BytesIO(png_bytes())) == path
+    assert janitor(index).collect()['files_deleted'] == 0
+    assert os.path.exists(path)
+    assert time.time() - os.path.getmtime(path) < 60
+
+
+def test_expired_upload_is_collected(tmp_path):
+    index = make_index(tmp_path)
+    service = ImageService(index.folders['uploads'], index.folders['generated'], file_index=index)
+    path = service.save_upload_stream(io.BytesIO(png_bytes()))
+    age(index, os.path.basename(path), 2 * DAY)
+
+    assert janitor(index).collect()['files_deleted'] == 1
+    assert not os.path.exists(path)
+
+
+def test_access_time_survives_restart(tmp_path):
+    index = make_index(tmp_path)
+    service = ImageService(index.folders['uploads'], index.folders['generated'], file_index=index)
+    file_id = os.path.basename(service.save_upload_stream(io.BytesIO(png_bytes())))
+    age(index, file_id, 2 * DAY)
+    index.touch(file_id)
+
+    reloaded = make_index(tmp_path)
+    assert time.time() - reloaded.get(file_id)['accessed'] < 60
+    assert janitor(reloaded).collect()['files_deleted'] == 0
+
+
+def test_access_in_another_worker_is_seen_through_shared_state(tmp_path):
+    state = SQLiteState(str(tmp_path / 'shared_state.sqlite3'))
+    index = make_index(tmp_path, state)
+    service = ImageService(index.folders['uploads'], index.folders['generated'], file_index=index)
+    file_id = os.path.basename(service.save_upload_stream(io.BytesIO(png_bytes())))
+
+    other_worker = make_index(tmp_path, state)
+    age(index, file_id, 2 * DAY)
+    other_worker.touch(file_id)  # read in the other process after this one loaded its index
+
+    report = janitor(index).collect()
+    assert report['files_deleted'] == 0
+    assert report['folders']['uploads']['skipped_recent'] == 1
@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+import time
+from services.job_service import JobQueue
+
+
+def wait_for(queue, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job['status'] == status:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} stayed {queue.get(job_id)['status']}")
+
+
+def test_a_running_job_survives_while_its_owner_heartbeats(tmp_path):
+    release = threading.Event()
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    owner = JobQueue(db_path, {'slow': lambda params: release.wait(5)}, lease_ttl=0.3)
+    job_id = owner.submit('slow', {})
+    wait_for(owner, job_id, 'running')
+
+    # a restarted worker, possibly reusing the owner's pid, must not take the job over
+    other = JobQueue(db_path, {'slow': lambda params: 'stolen'}, lease_ttl=0.3)
+    time.sleep(0.6)
+    other.resume()
+    assert owner.get(job_id)['status'] == 'running'
+
+    release.set()
+    assert wait_for(owner, job_id, 'succeeded')['result'] is True
+    owner.stop()
+    other.stop()
+
+
+def test_jobs_of_a_dead_owner_are_requeued_once_its_lease_expires(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    owner = JobQueue(db_path, {'slow': lambda params: time.sleep(1)}, lease_ttl=0.3)
+    owner.stop()  # behaves like a worker that died after claiming
+    job_id = owner.submit('slow', {})
+    wait_for(owner, job_id, 'running')
+
+    survivor = JobQueue(db_path, {'slow': lambda params: 'done'}, lease_ttl=0.3)
+    assert wait_for(survivor, job_id, 'succeeded')['result'] == 'done'
+    time.sleep(1)  # the stale run finishes too, but no longer owns the row
+    assert survivor.get(job_id)['result'] == 'done'
+    survivor.stop()
+
+
+def test_rows_claimed_before_leases_existed_are_requeued(tmp_path):
+    db_path = str(tmp_path / 'jobs.sqlite3')
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            'CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, '
+            'status TEXT NOT NULL, result TEXT, error TEXT, callback_url TEXT, owner_pid INTEGER, '
+            'created_at REAL NOT NULL, started_at REAL, finished_at REAL)'
+        )
+        conn.execute("INSERT INTO jobs (id, kind, params, status, owner_pid, created_at) "
+                     "VALUES ('old', 'quick', '{}', 'running', 1, 0)")
+    conn.close()
+
+    queue = JobQueue(db_path, {'quick': lambda params: 'done'})
+    queue.resume()
+    assert wait_for(queue, 'old', 'succeeded')['result'] == 'done'
+    queue.stop()
@@ -0,0 +1,50 @@
+import io
+import random
+from PIL import Image
+from services.preprocess import ImagePreprocessor
+
+
+def encode(img, fmt, **params):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def noise(size):
+    rng = random.Random(7)
+    return Image.frombytes('RGB', size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * 3)))
+
+
+def test_an_image_within_the_cap_is_sent_as_is():
+    data = encode(noise((64, 48)), 'PNG')
+    preprocessor = ImagePreprocessor(max_sides={'caption': 512})
+
+    assert preprocessor.prepare('photo.png', 'caption', data) == (data, 'image/png')
+    assert preprocessor.stats()['passed_through'] == 1
+    assert preprocessor.stats()['entries'] == 0
+
+
+def test_exif_orientation_is_applied_and_the_metadata_dropped():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees clockwise
+    data = encode(noise((64, 48)), 'JPEG', exif=exif.tobytes())
+    preprocessor = ImagePreprocessor(max_sides={'caption': 512})
+
+    prepared, mime_type = preprocessor.prepare('photo.jpg', 'caption', data)
+    assert mime_type == 'image/webp'
+    with Image.open(io.BytesIO(prepared)) as img:
+        assert img.size == (48, 64)
+        assert 'exif' not in img.info
+
+
+def test_a_downscale_is_sent_unless_the_original_is_smaller():
+    preprocessor = ImagePreprocessor(max_sides={'edit': 100})
+    large = encode(noise((400, 300)), 'PNG')
+    prepared, mime_type = preprocessor.prepare('photo.png', 'edit', large)
+    assert mime_type == 'image/webp' and len(prepared) < len(large)
+    with Image.open(io.BytesIO(prepared)) as img:
+        assert img.size == (100, 75)
+
+    # a heavily compressed JPEG barely over the cap would grow as WebP q85
+    small = encode(noise((120, 90)), 'JPEG', quality=5)
+    assert preprocessor.prepare('photo.jpg', 'edit', small) == (small, 'image/jpeg')
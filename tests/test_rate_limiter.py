@@ -0,0 +1,165 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from services import rate_limiter
+from services.rate_limiter import AdaptiveLimiter, RateLimiter, UpstreamBusyError, UpstreamRateLimitedError
+from tests.fakes import rate_limited, unavailable
+
+
+class Clock:
+    """time.monotonic stand-in that only moves when a test advances it."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'time', SimpleNamespace(monotonic=clock, time=time.time, sleep=time.sleep))
+    return clock
+
+
+def hold(limiter, release):
+    """Thread occupying one of limiter's slots until release is set."""
+    entered = threading.Event()
+
+    def run():
+        with limiter.acquire():
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert entered.wait(5)
+    return thread
+
+
+def test_concurrency_above_the_limit_waits_then_is_rejected():
+    limiter = AdaptiveLimiter('image', initial_limit=2, max_wait=0.05)
+    release = threading.Event()
+    threads = [hold(limiter, release), hold(limiter, release)]
+    try:
+        with pytest.raises(UpstreamBusyError) as error:
+            with limiter.acquire():
+                pass
+        assert error.value.retry_after >= 1
+        assert limiter.stats()['rejected'] == 1
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    with limiter.acquire():
+        assert limiter.stats()['in_flight'] == 1
+
+
+def test_full_queue_rejects_immediately():
+    limiter = AdaptiveLimiter('image', initial_limit=1, max_queue=1, max_wait=5)
+    release = threading.Event()
+    holder = hold(limiter, release)
+    waiter = threading.Thread(target=lambda: limiter.acquire().__enter__(), daemon=True)
+    waiter.start()
+    while limiter.stats()['waiting'] < 1:
+        time.sleep(0.005)
+    started = time.monotonic()
+    with pytest.raises(UpstreamBusyError):
+        with limiter.acquire():
+            pass
+    assert time.monotonic() - started < 1
+    release.set()
+    holder.join()
+    waiter.join()
+
+
+def test_rate_limit_paces_calls():
+    limiter = AdaptiveLimiter('caption', rate=20, burst=1)
+    started = time.monotonic()
+    for _ in range(3):
+        with limiter.acquire():
+            pass
+    assert time.monotonic() - started >= 0.09  # the 2nd and 3rd call wait 1/20 s each
+
+
+def test_upstream_429_halves_the_limit_and_pauses_the_model():
+    limiter = AdaptiveLimiter('image', initial_limit=8, max_wait=0.1)
+    with pytest.raises(UpstreamRateLimitedError) as error:
+        with limiter.acquire():
+            raise rate_limited(retry_after=3)
+    assert error.value.retry_after == 3
+    stats = limiter.stats()
+    assert stats['limit'] == 4
+    assert stats['rate_limited'] == 1
+    assert stats['in_flight'] == 0
+    assert 2 < stats['blocked_for'] <= 3
+
+    # paused for longer than max_wait: refused right away with the remaining pause as hint
+    with pytest.raises(UpstreamBusyError) as error:
+        with limiter.acquire():
+            pass
+    assert error.value.retry_after == 3
+
+
+def test_other_errors_release_the_slot_without_shrinking():
+    limiter = AdaptiveLimiter('image', initial_limit=4)
+    with pytest.raises(Exception):
+        with limiter.acquire():
+            raise unavailable()
+    stats = limiter.stats()
+    assert (stats['limit'], stats['in_flight'], stats['failed']) == (4, 0, 1)
+
+
+def call(limiter, clock, latency):
+    with limiter.acquire():
+        clock.now += latency
+
+
+def test_fast_calls_grow_the_limit_and_slow_ones_shrink_it(clock):
+    limiter = AdaptiveLimiter('image', initial_limit=4, max_limit=6, latency_tolerance=2.0)
+    for _ in range(40):
+        call(limiter, clock, 1.0)
+    assert limiter.stats()['limit'] == 6  # capped at max_limit
+
+    call(limiter, clock, 5.0)  # beyond 2x the ~1 s baseline
+    assert limiter.stats()['limit'] == pytest.approx(5.4)
+
+
+def test_rate_limiter_keeps_one_limiter_per_key():
+    limiter = RateLimiter(settings={'image': {'rate': 2}}, defaults={'rate': 5})
+    with limiter.acquire('image'), limiter.acquire('caption'):
+        pass
+    stats = limiter.stats()
+    assert (stats['image']['rate'], stats['caption']['rate']) == (2, 5)
+    assert limiter.limiter('image') is limiter.limiter('image')
+
+
+class SlowState:
+    """Shared state whose token bucket blocks, like a SQLite write lock held by another worker."""
+    def __init__(self):
+        self.entered, self.release = threading.Event(), threading.Event()
+
+    def take_tokens(self, key, rate, burst, count=1):
+        self.entered.set()
+        self.release.wait(5)
+        return burst - 1
+
+    def get(self, key):
+        return None
+
+
+def test_a_slow_shared_bucket_does_not_block_the_other_callers():
+    state = SlowState()
+    limiter = AdaptiveLimiter('image', rate=5, initial_limit=4, state=state)
+    waiter = threading.Thread(target=lambda: limiter.acquire().__enter__(), daemon=True)
+    waiter.start()
+    assert state.entered.wait(5)
+
+    started = time.monotonic()
+    stats = limiter.stats()  # needs the condition the waiter used to hold while taking tokens
+    assert time.monotonic() - started < 1
+    assert (stats['in_flight'], stats['admitted']) == (1, 0)
+    state.release.set()
+    waiter.join()
+    assert limiter.stats()['admitted'] == 1
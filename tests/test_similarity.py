@@ -0,0 +1,67 @@
+import pytest
+from services.cache_service import ResultCache
+from services.file_index import FileIndex
+from services.gemini_service import GeminiService
+from services.similarity import PerceptualIndex, hash_image
+from tests.fakes import FakeClient
+
+
+def picture(path, swap=False, fmt='PNG'):
+    """Structure in the green channel over a red/blue cast; swap exchanges red and blue."""
+    import random
+    from PIL import Image
+
+    rng = random.Random(7)
+    green = Image.new('L', (12, 8))
+    green.putdata([rng.randrange(40, 220) for _ in range(12 * 8)])
+    green = green.resize((96, 64), Image.Resampling.BILINEAR)
+    red, blue = Image.new('L', green.size, 220), Image.new('L', green.size, 30)
+    img = Image.merge('RGB', (blue, green, red) if swap else (red, green, blue))
+    img.save(path, fmt, quality=90)
+    return str(path)
+
+
+@pytest.fixture
+def service(tmp_path):
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    index = FileIndex({'uploads': str(uploads), 'generated': str(tmp_path / 'generated')}, manifest_path=None)
+    client = FakeClient()
+    service = GeminiService(client=client, caption_cache=ResultCache(), file_index=index,
+                            similarity=PerceptualIndex(), similarity_distance=4,
+                            generated_folder=str(tmp_path / 'generated'))
+    return service, client, uploads
+
+
+def caption(service, path):
+    service.file_index.add('uploads', path)
+    return service.generate_caption_result(path, 'instagram', 'playful')
+
+
+def test_re_encoded_copy_reuses_the_caption(service):
+    service, client, uploads = service
+    original = picture(uploads / 'original.png')
+    copy = picture(uploads / 'copy.jpg', fmt='JPEG')
+    caption(service, original)
+    result = caption(service, copy)
+    assert client.calls == 1
+    assert result['near_duplicate_of'] == 'original.png'
+
+
+def test_recoloured_image_with_a_close_hash_is_captioned_afresh(service):
+    service, client, uploads = service
+    original = picture(uploads / 'original.png')
+    swapped = picture(uploads / 'swapped.png', swap=True)
+    assert (hash_image(original) ^ hash_image(swapped)).bit_count() <= 4  # dHash alone can't tell them apart
+    caption(service, original)
+    result = caption(service, swapped)
+    assert client.calls == 2
+    assert 'near_duplicate_of' not in result
+
+
+def test_reuse_is_off_at_distance_zero(service):
+    service, client, uploads = service
+    service.similarity_distance = 0
+    caption(service, picture(uploads / 'original.png'))
+    caption(service, picture(uploads / 'copy.jpg', fmt='JPEG'))
+    assert client.calls == 2
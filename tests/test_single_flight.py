@@ -0,0 +1,175 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from services.gemini_service import GeminiService
+from services.rate_limiter import RateLimiter, UpstreamRateLimitedError
+from services.call_policy import CallPolicy
+from services.shared_state import SQLiteState
+from services.single_flight import SingleFlight
+from tests.fakes import FakeClient, rate_limited
+
+
+def run_together(count, fn):
+    """fn() from count threads started at once; returns results or exceptions in order."""
+    barrier = threading.Barrier(count)
+
+    def call():
+        barrier.wait()
+        try:
+            return fn()
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        return list(executor.map(lambda _: call(), range(count)))
+
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.1)
+        return {'value': 42}
+
+    results = run_together(6, lambda: flights.do('generate', ('model', 'prompt'), work))
+    assert len(calls) == 1
+    assert all(result == {'value': 42} for result, _ in results)
+    assert sorted(shared for _, shared in results) == [False] + [True] * 5
+    stats = flights.stats()['generate']
+    assert (stats['calls'], stats['deduplicated'], stats['in_flight']) == (1, 5, 0)
+
+
+def test_different_keys_are_not_coalesced():
+    flights = SingleFlight()
+    assert flights.do('generate', 'a', lambda: 1) == (1, False)
+    assert flights.do('generate', 'b', lambda: 2) == (2, False)
+
+
+def test_finished_calls_are_not_reused():
+    flights = SingleFlight()
+    calls = []
+    flights.do('caption', 'key', lambda: calls.append(1))
+    flights.do('caption', 'key', lambda: calls.append(1))
+    assert len(calls) == 2
+
+
+def test_followers_get_the_leaders_error():
+    flights = SingleFlight()
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.1)
+        raise ValueError('upstream failed')
+
+    results = run_together(4, lambda: flights.do('edit', 'key', work))
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flights.do('edit', 'key', lambda: 'fresh') == ('fresh', False)
+
+
+def test_followers_retry_when_the_leader_gives_up():
+    flights = SingleFlight()
+    leading = threading.Event()
+    follower_result = []
+
+    def follower():
+        leading.wait()
+        follower_result.append(flights.do('generate', 'key', lambda: 'second try'))
+
+    thread = threading.Thread(target=follower)
+    thread.start()
+    with flights.flight('generate', 'key') as flight:
+        assert flight.leader
+        leading.set()
+        while flights.stats()['generate']['waiting'] < 1:
+            time.sleep(0.005)
+        # e.g. a streaming client disconnected: leave without resolve()
+    thread.join(5)
+    assert follower_result == [('second try', False)]
+    assert flights.stats()['generate']['abandoned'] == 1
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """Two SingleFlights on one shared state, standing in for two worker processes."""
+    state = SQLiteState(str(tmp_path / 'shared_state.sqlite3'))
+    return SingleFlight(state=state, poll_interval=0.01), SingleFlight(state=state, poll_interval=0.01)
+
+
+def test_concurrent_call_in_another_worker_is_shared(workers):
+    first, second = workers
+    started = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append('first')
+        started.set()
+        time.sleep(0.2)
+        return {'value': 1}
+
+    leader = threading.Thread(target=lambda: first.do('generate', 'key', slow))
+    leader.start()
+    started.wait(5)
+    assert second.do('generate', 'key', lambda: calls.append('second')) == ({'value': 1}, True)
+    leader.join()
+    assert calls == ['first']
+    assert second.stats()['generate']['remote_deduplicated'] == 1
+
+
+def test_finished_call_in_another_worker_is_not_reused(workers):
+    first, second = workers
+    assert first.do('generate', 'key', lambda: {'value': 1}) == ({'value': 1}, False)
+    assert second.do('generate', 'key', lambda: {'value': 2}) == ({'value': 2}, False)
+    assert first.do('generate', 'key', lambda: {'value': 3}) == ({'value': 3}, False)
+
+
+def test_error_in_another_worker_lets_waiters_call_themselves(workers):
+    first, second = workers
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('upstream failed')
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, first.do, 'caption', 'key', failing))
+    leader.start()
+    started.wait(5)
+    assert second.do('caption', 'key', lambda: 'own call') == ('own call', False)
+    leader.join()
+
+
+def make_service(tmp_path, client, **kwargs):
+    return GeminiService(client=client, single_flight=SingleFlight(), generated_folder=str(tmp_path / 'generated'),
+                         **kwargs)
+
+
+def test_identical_generations_make_one_model_call(tmp_path):
+    client = FakeClient(latency=0.2)
+    service = make_service(tmp_path, client)
+    results = run_together(5, lambda: service.generate_image('a red square', 'flat'))
+    assert client.calls == 1
+    assert len({tuple(result['image_paths']) for result in results}) == 1
+    assert sum(bool(result.get('coalesced')) for result in results) == 4
+
+
+def test_use_cache_false_opts_out(tmp_path):
+    client = FakeClient(latency=0.1)
+    service = make_service(tmp_path, client)
+    run_together(3, lambda: service.generate_image('a red square', use_cache=False))
+    assert client.calls == 3
+
+
+def test_coalesced_callers_share_a_429(tmp_path):
+    client = FakeClient(latency=0.1, errors=[rate_limited(retry_after=5)])
+    service = make_service(tmp_path, client, rate_limiter=RateLimiter(),
+                           call_policy=CallPolicy(deadlines={'image': 1.0}))
+    results = run_together(4, lambda: service.generate_image('a red square'))
+    assert client.calls == 1
+    assert all(isinstance(result, UpstreamRateLimitedError) for result in results)
+    assert service.rate_limiter.stats()['image']['rate_limited'] == 1
+    assert service.single_flight.stats()['generate']['in_flight'] == 0  # the error isn't kept
@@ -0,0 +1,115 @@
+import os
+import shutil
+import sys
+import types
+import pytest
+from services.storage import S3Storage
+from services.janitor import StorageJanitor
+from tests.test_janitor import DAY, age, make_index
+
+
+class FakeS3Client:
+    """In-memory stand-in for a boto3 S3 client (AWS or MinIO)."""
+
+    def __init__(self):
+        self.objects = {}  # key -> bytes
+        self.deleted = []
+
+    def upload_file(self, path, bucket, key, Config=None):
+        with open(path, 'rb') as f:
+            self.objects[key] = f.read()
+
+    def download_file(self, bucket, key, path, Config=None):
+        if key not in self.objects:
+            raise _not_found()
+        with open(path, 'wb') as f:
+            f.write(self.objects[key])
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise _not_found()
+        return {'ContentLength': len(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.deleted.append(Key)
+        self.objects.pop(Key, None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.example/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+
+def _not_found():
+    error = Exception('Not Found')
+    error.response = {'Error': {'Code': '404'}}
+    return error
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3Client()
+    boto3 = types.ModuleType('boto3')
+    boto3.client = lambda service, endpoint_url=None, region_name=None: client
+    transfer = types.ModuleType('boto3.s3.transfer')
+    transfer.TransferConfig = lambda **kwargs: kwargs
+    monkeypatch.setitem(sys.modules, 'boto3', boto3)
+    monkeypatch.setitem(sys.modules, 'boto3.s3', types.ModuleType('boto3.s3'))
+    monkeypatch.setitem(sys.modules, 'boto3.s3.transfer', transfer)
+    return client
+
+
+def stored_file(index, storage, name, data=b'png'):
+    path = os.path.join(index.folders['generated'], name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    storage.save('generated', path)
+    index.add('generated', path)
+    return path
+
+
+def test_janitor_evicts_the_local_copy_and_keeps_the_object(tmp_path, s3):
+    index = make_index(tmp_path)
+    storage = S3Storage(index.folders, bucket='images', prefix='app', file_index=index)
+    path = stored_file(index, storage, 'generated_a_0.png')
+    age(index, 'generated_a_0.png', 2 * DAY)
+
+    janitor = StorageJanitor(index, policies={'generated': {'ttl': DAY, 'quota': 0}}, storage=storage)
+    assert janitor.collect()['folders']['generated']['files_deleted'] == 1
+    assert not os.path.exists(path)
+    assert s3.deleted == []
+    assert 'app/generated/generated_a_0.png' in s3.objects
+
+    # another node (or this one later) fetches it back from the bucket
+    assert storage.available(path)
+    assert open(path, 'rb').read() == b'png'
+    assert index.get('generated_a_0.png') is not None
+
+
+def test_a_missing_local_copy_is_fetched_instead_of_trusting_the_index(tmp_path, s3):
+    index = make_index(tmp_path)
+    storage = S3Storage(index.folders, bucket='images', file_index=index)
+    path = stored_file(index, storage, 'generated_b_0.png')
+    shutil.rmtree(index.folders['generated'])
+
+    assert storage.available(path)
+    assert os.path.exists(path)
+    assert not storage.available(os.path.join(index.folders['generated'], 'generated_missing_0.png'))
+
+
+def test_presigned_download_counts_as_an_access(tmp_path, s3):
+    from app import create_app
+
+    app = create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'), 'GENERATED_FOLDER': str(tmp_path / 'generated'),
+        'STATE_FOLDER': str(tmp_path / 'state'), 'VARIANT_FOLDER': str(tmp_path / 'variants'),
+        'STORAGE_BACKEND': 's3', 'S3_BUCKET': 'images', 'JANITOR_ENABLED': False,
+    })
+    client = app.test_client()
+    assert client.get('/api/health').status_code == 200  # loads the runtime state
+    index, storage = app.extensions['file_index'], app.extensions['storage']
+    stored_file(index, storage, 'generated_c_0.png')
+    age(index, 'generated_c_0.png', DAY)
+
+    response = client.get('/api/images/download/generated/generated_c_0.png')
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith('https://s3.example/images/generated/generated_c_0.png')
+    assert index.get('generated_c_0.png')['accessed'] > index.get('generated_c_0.png')['mtime'] + DAY / 2
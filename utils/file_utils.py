@@ -0,0 +1,138 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the dev server runs a single process, nothing to serialize against
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+
+# (abs path, size, mtime_ns) -> strong ETag of that file version
+_etag_memo = {}
+_etag_lock = threading.Lock()
+_ETAG_MEMO_MAX = 65536
+
+# Content-addressed uploads are named "<sha256 hex><ext>", e.g. "3f2a...9c.jpg"
+_CONTENT_ID_RE = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+def normalize_path(path):
+    """Accept forward or back slashes in client-supplied paths."""
+    return path.replace('/', os.sep).replace('\\', os.sep)
+
+
+def is_content_id(value):
+    """True if value is a content-addressed image handle."""
+    return bool(value) and bool(_CONTENT_ID_RE.match(value))
+
+
+def content_relpath(image_id):
+    """Sharded location of a content-addressed blob, relative to its folder."""
+    return os.path.join(image_id[:2], image_id[2:4], image_id)
+
+
+def content_path(folder, image_id):
+    return os.path.join(folder, content_relpath(image_id))
+
+
+def resolve_image_path(value, upload_folder):
+    """Map an image handle (content id or path) to a local file path."""
+    if is_content_id(value):
+        return content_path(upload_folder, value)
+    return normalize_path(value)
+
+
+def write_stream_hashed(stream, dest_dir, chunk_size=CHUNK_SIZE, prefix=b''):
+    """
+    Copy a stream into a temp file in dest_dir, hashing it on the way.
+    prefix holds bytes already read from the stream (e.g. a sniffed header).
+    Returns (temp_path, sha256 hex digest, size in bytes).
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    hasher = hashlib.sha256(prefix)
+    size = len(prefix)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.incoming_', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(prefix)
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest(), size
+
+
+@contextmanager
+def manifest_lock(manifest_path, exclusive=False):
+    """
+    flock on "<manifest>.lock", shared by every worker process. Appends hold it shared;
+    a rewrite holds it exclusively, so no append lands in a file that is being replaced.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{manifest_path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def rewrite_manifest(manifest_path, lines):
+    """Atomically replace a manifest with lines, via a uniquely named temp file beside it."""
+    directory, name = os.path.split(os.path.abspath(manifest_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        os.replace(tmp_path, manifest_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def file_etag(path, stat=None):
+    """
+    Strong ETag (content SHA-256) for a file, computed at most once per file version.
+    Content-addressed uploads already carry their digest in the name.
+    """
+    name = os.path.basename(path)
+    if is_content_id(name):
+        return name.split('.', 1)[0]
+
+    stat = stat or os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    etag = _etag_memo.get(key)
+    if etag is None:
+        etag = file_sha256(path)
+        _store_etag(key, etag)
+    return etag
+
+
+def _store_etag(key, etag):
+    with _etag_lock:
+        if len(_etag_memo) >= _ETAG_MEMO_MAX:
+            _etag_memo.clear()
+        _etag_memo[key] = etag
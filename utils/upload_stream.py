@@ -0,0 +1,97 @@
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+from utils.file_utils import CHUNK_SIZE
+
+# Leading bytes of the formats we accept -> canonical extension
+_MAGIC = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+
+def sniff_image_type(head):
+    """Canonical extension for the magic bytes at the start of head, or None."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for magic, ext in _MAGIC:
+        if head.startswith(magic):
+            return ext
+    return None
+
+
+class MultipartFileStream:
+    """
+    Read-only file object over one file field of a multipart/form-data body, decoded
+    incrementally from the raw request stream. Only one chunk of the body is held in
+    memory at a time, and nothing after the file is read unless the caller asks for it.
+    """
+    def __init__(self, stream, boundary, field_name, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary, max_form_memory_size=500 * 1024, max_parts=100)
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._in_file = False
+        self._finished = False
+        self.filename = None
+        self._open(field_name)
+
+    @classmethod
+    def from_request(cls, request, field_name, chunk_size=CHUNK_SIZE):
+        mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            raise BadRequest('Expected a multipart/form-data body')
+        return cls(request.stream, options['boundary'].encode('latin-1'), field_name, chunk_size)
+
+    def _events(self):
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                if self._decoder.complete:
+                    raise BadRequest('Truncated multipart body')
+                chunk = self._stream.read(self._chunk_size)
+                self._decoder.receive_data(chunk or None)  # None marks the end of the body
+                continue
+            yield event
+            if isinstance(event, Epilogue):
+                return
+
+    def _open(self, field_name):
+        self._iter = self._events()
+        for event in self._iter:
+            if isinstance(event, File) and event.name == field_name:
+                self.filename = event.filename
+                self._in_file = True
+                return
+            if isinstance(event, Epilogue):
+                break
+        self._finished = True
+
+    def _fill(self, size):
+        while self._in_file and (size < 0 or len(self._buffer) < size):
+            try:
+                event = next(self._iter)
+            except StopIteration:
+                raise BadRequest('Truncated multipart body')
+            if not isinstance(event, Data):
+                raise BadRequest('Malformed multipart body')
+            self._buffer += event.data
+            if not event.more_data:
+                self._in_file = False
+                self._finished = True
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0 or size >= len(self._buffer):
+            data, self._buffer = bytes(self._buffer), bytearray()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    @property
+    def found(self):
+        """True if the requested file field was present in the body."""
+        return self.filename is not None